@@ -0,0 +1,211 @@
+"""
+Invoice Amount Normalization
+Parses extracted amount strings into integer minor units and ISO 4217 currency codes.
+"""
+
+import os
+import re
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+
+
+# Currencies without 2 decimal places; everything else uses cents-style minor units
+MINOR_UNIT_EXPONENTS = {
+    'JPY': 0, 'KRW': 0, 'VND': 0, 'CLP': 0, 'ISK': 0, 'HUF': 0,
+    'BHD': 3, 'KWD': 3, 'OMR': 3, 'JOD': 3, 'TND': 3
+}
+
+# Checked in order, so prefixed dollar signs come before the bare '$'
+CURRENCY_SYMBOLS = [
+    ('US$', 'USD'), ('CA$', 'CAD'), ('C$', 'CAD'), ('AU$', 'AUD'), ('A$', 'AUD'), ('NZ$', 'NZD'),
+    ('HK$', 'HKD'), ('S$', 'SGD'), ('R$', 'BRL'), ('MX$', 'MXN'), ('$', 'USD'),
+    ('€', 'EUR'), ('£', 'GBP'), ('₹', 'INR'), ('¥', 'JPY'), ('₩', 'KRW'), ('₱', 'PHP'),
+    ('₺', 'TRY'), ('₪', 'ILS'), ('₫', 'VND'), ('฿', 'THB'), ('zł', 'PLN')
+]
+
+CURRENCY_CODES = {
+    'USD', 'EUR', 'GBP', 'INR', 'JPY', 'CNY', 'KRW', 'CAD', 'AUD', 'NZD', 'CHF', 'SEK', 'NOK', 'DKK',
+    'PLN', 'CZK', 'HUF', 'SGD', 'HKD', 'BRL', 'MXN', 'ZAR', 'AED', 'SAR', 'THB', 'PHP', 'IDR', 'MYR',
+    'TRY', 'ILS', 'VND', 'CLP', 'ISK', 'BHD', 'KWD', 'OMR', 'JOD', 'TND', 'RUB', 'NGN', 'KES', 'EGP', 'PKR'
+}
+
+# Words/abbreviations extracted invoices use instead of a symbol or code
+CURRENCY_WORDS = {
+    'rs': 'INR', 'rs.': 'INR', 'inr': 'INR', 'rupees': 'INR', 'dollars': 'USD', 'euros': 'EUR',
+    'euro': 'EUR', 'pounds': 'GBP', 'yen': 'JPY', 'yuan': 'CNY', 'rmb': 'CNY', 'fr.': 'CHF', 'kr': 'SEK'
+}
+
+# Report currency and FX rates (units of REPORT_CURRENCY per unit of currency).
+# FX_RATES overrides/extends the defaults, e.g. "EUR=1.09,GBP=1.27,INR=0.012"
+REPORT_CURRENCY = os.environ.get('REPORT_CURRENCY', 'USD').upper()
+DEFAULT_CURRENCY = os.environ.get('DEFAULT_CURRENCY', 'USD').upper()
+DEFAULT_FX_RATES = {'USD': 1.0, 'EUR': 1.09, 'GBP': 1.27, 'INR': 0.012}
+
+# A number starts with a digit, or with a decimal point directly before one (".99", ",50");
+# the separator must not end a word, so "Rs.500" is 500
+_NUMBER_PATTERN = re.compile(r"(?:\d|(?<!\w)[.,](?=\d))[\d.,'   ]*")
+
+
+def minor_unit_exponent(currency):
+    """Decimal places of a currency's minor unit (2 unless listed in MINOR_UNIT_EXPONENTS)."""
+    return MINOR_UNIT_EXPONENTS.get(currency, 2)
+
+
+def detect_currency(text):
+    """
+    Find the currency an amount string is written in.
+    
+    Returns:
+        str or None: ISO 4217 code, or None if the string names no currency
+    """
+    upper = text.upper()
+    for code in re.findall(r'(?<![A-Z])([A-Z]{3})(?![A-Z])', upper):
+        if code in CURRENCY_CODES:
+            return code
+    for symbol, code in CURRENCY_SYMBOLS:
+        if symbol.upper() in upper:
+            return code
+    for word in re.findall(r'[a-z]+\.?', text.lower()):
+        if word in CURRENCY_WORDS:
+            return CURRENCY_WORDS[word]
+    return None
+
+
+def parse_decimal(number, exponent=2):
+    """
+    Parse a number written with any common grouping/decimal convention.
+    
+    Handles "1,234.50", "1.234,50", "1 234,50", "1'234.50", Indian lakh
+    grouping ("1,23,456.00") and a leading decimal point (".99"). With a
+    single separator, it is a decimal point unless exactly three digits
+    follow it (then it groups thousands), except for 3-decimal currencies
+    where "1.250" stays 1.25.
+    
+    Args:
+        number (str): Digits and separators only
+        exponent (int): Minor-unit decimals of the currency, used for ambiguous input
+    
+    Returns:
+        Decimal or None
+    """
+    number = re.sub(r"['   ]", '', number).rstrip('.,')
+    if number[:1] in ('.', ','):
+        # A leading separator can only be a decimal point: ".99", ",50"
+        fraction = number[1:]
+        return Decimal('0.' + fraction) if fraction.isdigit() else None
+    if not number:
+        return None
+    
+    last_dot, last_comma = number.rfind('.'), number.rfind(',')
+    if last_dot >= 0 and last_comma >= 0:
+        # Both present: whichever comes last is the decimal separator
+        decimal_sep = '.' if last_dot > last_comma else ','
+    elif last_dot >= 0 or last_comma >= 0:
+        separator = '.' if last_dot >= 0 else ','
+        decimals = len(number) - number.rfind(separator) - 1
+        if number.count(separator) > 1:
+            decimal_sep = None
+        elif decimals == 3 and exponent != 3:
+            decimal_sep = None
+        else:
+            decimal_sep = separator
+    else:
+        decimal_sep = None
+    
+    if decimal_sep:
+        whole, _, fraction = number.rpartition(decimal_sep)
+        number = re.sub(r'[.,]', '', whole) + '.' + fraction
+    else:
+        number = re.sub(r'[.,]', '', number)
+    try:
+        return Decimal(number)
+    except InvalidOperation:
+        return None
+
+
+def parse_amount(text, currency=None):
+    """
+    Parse an extracted amount string into integer minor units.
+    
+    Args:
+        text: Amount as extracted, e.g. "$1,234.50", "1.234,50 €", "₹1,23,456", "(12.00)"
+        currency (str, optional): Currency to assume when the string names none
+    
+    Returns:
+        tuple: (minor_units, currency) - minor_units is None when no number was
+               found; currency is None when neither the string nor the hint names one
+    """
+    if text is None or isinstance(text, bool):
+        return None, currency
+    if isinstance(text, (int, float)):
+        # Already a number; no separators to interpret
+        value = Decimal(str(text))
+        return int((value * (10 ** minor_unit_exponent(currency))).quantize(Decimal('1'), rounding=ROUND_HALF_UP)), currency
+    text = str(text).strip()
+    
+    currency = detect_currency(text) or currency
+    match = _NUMBER_PATTERN.search(text)
+    if not match:
+        return None, currency
+    
+    exponent = minor_unit_exponent(currency)
+    value = parse_decimal(match.group(0), exponent)
+    if value is None:
+        return None, currency
+    
+    prefix = text[:match.start()]
+    if '-' in prefix or '−' in prefix or (text.startswith('(') and text.rstrip().endswith(')')):
+        value = -value
+    minor = int((value * (10 ** exponent)).quantize(Decimal('1'), rounding=ROUND_HALF_UP))
+    return minor, currency
+
+
+def normalize_amounts(data, default_currency=None):
+    """
+    Parse an invoice's total, subtotal and tax into minor units.
+    
+    The invoice has one currency: the first one named by total, subtotal
+    or tax, else default_currency. Amounts that name a different currency
+    than the total are left unparsed rather than mixed.
+    
+    Args:
+        data (dict): Invoice with free-text 'total', 'subtotal', 'tax'
+        default_currency (str, optional): Currency for amounts with no symbol/code (default: DEFAULT_CURRENCY)
+    
+    Returns:
+        dict: total_minor, subtotal_minor, tax_minor (int or None) and currency
+    """
+    default_currency = default_currency or DEFAULT_CURRENCY
+    fields = ('total', 'subtotal', 'tax')
+    named = [detect_currency(str(data.get(field))) for field in fields if data.get(field) is not None]
+    currency = next((code for code in named if code), default_currency)
+    
+    amounts = {'currency': currency}
+    for field in fields:
+        minor, field_currency = parse_amount(data.get(field), currency)
+        amounts[f'{field}_minor'] = minor if field_currency == currency else None
+    return amounts
+
+
+def format_minor(minor, currency):
+    """Format minor units for display, e.g. (123450, 'USD') -> '1,234.50 USD'."""
+    if minor is None:
+        return None
+    exponent = minor_unit_exponent(currency)
+    value = Decimal(minor) / (10 ** exponent)
+    return f"{value:,.{exponent}f} {currency}"
+
+
+def get_fx_rates():
+    """
+    Return the configured FX rates: DEFAULT_FX_RATES updated from FX_RATES.
+    
+    Returns:
+        dict: currency code -> units of REPORT_CURRENCY per one unit of that currency
+    """
+    rates = dict(DEFAULT_FX_RATES)
+    for pair in os.environ.get('FX_RATES', '').split(','):
+        code, _, rate = pair.partition('=')
+        if code.strip() and rate.strip():
+            rates[code.strip().upper()] = float(rate)
+    rates[REPORT_CURRENCY] = 1.0
+    return rates
@@ -0,0 +1,168 @@
+"""
+Extraction Result Cache
+Content-addressed cache for normalized invoice extraction results.
+"""
+
+import os
+import json
+import copy
+import time
+import sqlite3
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+
+
+class ExtractionCache:
+    """
+    Two-tier cache keyed on (SHA-256 of file bytes, model name, prompt version).
+    
+    The first tier is an in-process LRU bounded by entry count and TTL. The
+    second tier is a SQLite file that survives restarts and is shared by every
+    worker on the same host. Disk hits are promoted into the memory tier.
+    """
+    
+    def __init__(self, max_entries=256, ttl=86400, db_path=None):
+        """
+        Args:
+            max_entries (int): Max entries held in the in-process LRU
+            ttl (float): Seconds an entry stays valid in either tier
+            db_path (str, optional): SQLite file for the persistent tier (None disables it)
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.db_path = db_path
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._counters = {
+            'memory_hits': 0,
+            'disk_hits': 0,
+            'misses': 0,
+            'evictions': 0,
+            'expirations': 0
+        }
+        
+        self.conn = None
+        if db_path:
+            self.conn = sqlite3.connect(db_path, check_same_thread=False)
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS extraction_cache (
+                    cache_key TEXT PRIMARY KEY,
+                    data TEXT,
+                    created_at REAL
+                )
+            ''')
+            self.conn.commit()
+    
+    @staticmethod
+    def make_key(file_bytes, model, prompt_version):
+        """Build the content-addressed key for a file/model/prompt combination."""
+        digest = hashlib.sha256(file_bytes).hexdigest()
+        return f"{digest}:{model}:v{prompt_version}"
+    
+    def get(self, key):
+        """
+        Look up a cached extraction result.
+        
+        Returns:
+            dict or None: A copy of the stored result, or None on a miss
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                data, expires_at = entry
+                if expires_at > now:
+                    self._entries.move_to_end(key)
+                    self._counters['memory_hits'] += 1
+                    return copy.deepcopy(data)
+                del self._entries[key]
+                self._counters['expirations'] += 1
+            
+            if self.conn is not None:
+                row = self.conn.execute(
+                    'SELECT data, created_at FROM extraction_cache WHERE cache_key = ?', (key,)
+                ).fetchone()
+                if row:
+                    created_at = row[1]
+                    if created_at + self.ttl > now:
+                        data = json.loads(row[0])
+                        self._store_memory(key, data, created_at + self.ttl)
+                        self._counters['disk_hits'] += 1
+                        return copy.deepcopy(data)
+                    self.conn.execute('DELETE FROM extraction_cache WHERE cache_key = ?', (key,))
+                    self.conn.commit()
+                    self._counters['expirations'] += 1
+            
+            self._counters['misses'] += 1
+            return None
+    
+    def put(self, key, data):
+        """Store an extraction result in both tiers."""
+        now = time.time()
+        with self._lock:
+            self._store_memory(key, copy.deepcopy(data), now + self.ttl)
+            if self.conn is not None:
+                self.conn.execute(
+                    'INSERT OR REPLACE INTO extraction_cache (cache_key, data, created_at) VALUES (?, ?, ?)',
+                    (key, json.dumps(data), now)
+                )
+                self.conn.commit()
+    
+    def _store_memory(self, key, data, expires_at):
+        """Insert into the LRU tier, evicting the least recently used entries. Caller holds the lock."""
+        self._entries[key] = (data, expires_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self._counters['evictions'] += 1
+    
+    def clear(self):
+        """Drop every entry from both tiers."""
+        with self._lock:
+            self._entries.clear()
+            if self.conn is not None:
+                self.conn.execute('DELETE FROM extraction_cache')
+                self.conn.commit()
+    
+    def stats(self):
+        """Return hit/miss/eviction counters and current sizes."""
+        with self._lock:
+            stats = dict(self._counters)
+            stats['hits'] = stats['memory_hits'] + stats['disk_hits']
+            stats['memory_entries'] = len(self._entries)
+            stats['max_entries'] = self.max_entries
+            stats['ttl'] = self.ttl
+            stats['persistent'] = self.conn is not None
+            return stats
+
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+def get_extraction_cache():
+    """
+    Return the process-wide ExtractionCache, or None when disabled.
+    
+    Configured once from EXTRACTION_CACHE_ENABLED, EXTRACTION_CACHE_SIZE,
+    EXTRACTION_CACHE_TTL and EXTRACTION_CACHE_PATH (empty string keeps the
+    cache in memory only).
+    """
+    global _default_cache
+    if os.environ.get('EXTRACTION_CACHE_ENABLED', 'true').lower() != 'true':
+        return None
+    if _default_cache is None:
+        with _default_cache_lock:
+            if _default_cache is None:
+                db_path = os.environ.get(
+                    'EXTRACTION_CACHE_PATH',
+                    os.path.join(tempfile.gettempdir(), 'invoice_extraction_cache.sqlite3')
+                )
+                _default_cache = ExtractionCache(
+                    max_entries=int(os.environ.get('EXTRACTION_CACHE_SIZE', '256')),
+                    ttl=float(os.environ.get('EXTRACTION_CACHE_TTL', '86400')),
+                    db_path=db_path or None
+                )
+    return _default_cache
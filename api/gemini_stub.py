@@ -0,0 +1,358 @@
+"""
+Local Gemini Stand-in Server
+Implements generateContent and streamGenerateContent with canned invoice
+responses, configurable latency and injected errors, for load testing the
+API without quota or network access.
+
+Usage:
+    python api/gemini_stub.py --port 8089 --latency lognormal:0.8,0.4 --error-rate 0.02
+    GEMINI_BASE_URL=http://127.0.0.1:8089/v1 GEMINI_API_KEY=stub python api/index.py
+"""
+
+import re
+import json
+import math
+import time
+import random
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+DEFAULT_INVOICE = {
+    "vendor": "Acme Office Supplies",
+    "invoice_number": "INV-2024-0042",
+    "date": "2024-03-15",
+    "subtotal": "$120.00",
+    "tax": "$9.60",
+    "total": "$129.60",
+    "summary": "Office supplies order of paper, toner and pens",
+    "line_items": [
+        {"description": "A4 copy paper (5 reams)", "quantity": "2", "price": "$25.00"},
+        {"description": "Toner cartridge", "quantity": "1", "price": "$60.00"},
+        {"description": "Ballpoint pens (box)", "quantity": "2", "price": "$5.00"}
+    ]
+}
+
+# Gemini bills each inline image at a flat token count
+IMAGE_TOKENS = 258
+
+ROUTE = re.compile(r'/models/(?P<model>[^/:]+):(?P<method>generateContent|streamGenerateContent)$')
+
+
+def parse_latency(spec):
+    """
+    Build a latency sampler from a distribution spec (all values in seconds).
+    
+    Supported specs:
+        fixed:S, uniform:LOW,HIGH, normal:MEAN,STDDEV,
+        lognormal:MEDIAN,SIGMA, exponential:MEAN
+    
+    Returns:
+        callable: Zero-argument function returning a latency in seconds
+    """
+    kind, _, args = spec.partition(':')
+    try:
+        values = [float(v) for v in args.split(',')] if args else []
+    except ValueError:
+        raise ValueError(f"Invalid latency spec '{spec}'")
+    
+    if kind == 'fixed' and len(values) == 1:
+        return lambda: values[0]
+    if kind == 'uniform' and len(values) == 2:
+        return lambda: random.uniform(values[0], values[1])
+    if kind == 'normal' and len(values) == 2:
+        return lambda: max(0.0, random.gauss(values[0], values[1]))
+    if kind == 'lognormal' and len(values) == 2:
+        return lambda: random.lognormvariate(math.log(values[0]), values[1])
+    if kind == 'exponential' and len(values) == 1:
+        return lambda: random.expovariate(1 / values[0]) if values[0] > 0 else 0.0
+    raise ValueError(f"Invalid latency spec '{spec}'")
+
+
+class StubSettings:
+    """Behaviour of the stand-in server; shared by all request handlers."""
+    
+    def __init__(self, latency='fixed:0', error_rate=0.0, error_codes=(429, 500, 503), retry_after=1,
+                 truncate_rate=0.0, responses=None, stream_chunks=8):
+        """
+        Args:
+            latency (str): Latency distribution spec (see parse_latency)
+            error_rate (float): Fraction of requests answered with an injected error
+            error_codes (tuple): HTTP statuses picked at random for injected errors
+            retry_after (float): Retry-After seconds sent with injected 429/503s (0 omits it)
+            truncate_rate (float): Fraction of responses cut off mid-JSON, as at maxOutputTokens
+            responses (list, optional): Canned invoice dicts served round-robin (default: DEFAULT_INVOICE)
+            stream_chunks (int): Chunks each streamGenerateContent response is split into
+        """
+        self.latency_spec = latency
+        self.sample_latency = parse_latency(latency)
+        self.error_rate = error_rate
+        self.error_codes = tuple(error_codes)
+        self.retry_after = retry_after
+        self.truncate_rate = truncate_rate
+        self.responses = list(responses or [DEFAULT_INVOICE])
+        self.stream_chunks = max(1, stream_chunks)
+        self._next_response = 0
+        self._counters = {'requests': 0, 'streamed': 0, 'errors': 0, 'truncated': 0, 'images': 0}
+        self._lock = threading.Lock()
+    
+    def next_invoices(self, count):
+        """Take the next count canned invoices, round-robin."""
+        with self._lock:
+            start = self._next_response
+            self._next_response = (start + count) % len(self.responses)
+        return [self.responses[(start + i) % len(self.responses)] for i in range(count)]
+    
+    def count(self, name, amount=1):
+        with self._lock:
+            self._counters[name] += amount
+    
+    def stats(self):
+        """Return request counters and the active settings."""
+        with self._lock:
+            stats = dict(self._counters)
+        stats.update({
+            'latency': self.latency_spec,
+            'error_rate': self.error_rate,
+            'error_codes': list(self.error_codes),
+            'truncate_rate': self.truncate_rate,
+            'canned_responses': len(self.responses)
+        })
+        return stats
+
+
+def build_generated_text(request_body, settings):
+    """
+    Produce the model text for a generateContent request body.
+    
+    One inline file gets one invoice object; several get a JSON array with
+    an "index" per file, like a packed request. Without a JSON
+    responseMimeType the text is wrapped in a ```json fence, as the real
+    model tends to do.
+    
+    Returns:
+        tuple: (generated text, prompt token estimate)
+    """
+    parts = [p for content in request_body.get('contents', []) for p in content.get('parts', [])]
+    images = sum(1 for p in parts if 'inline_data' in p or 'inlineData' in p)
+    prompt_chars = sum(len(p.get('text', '')) for p in parts)
+    settings.count('images', images)
+    
+    invoices = settings.next_invoices(max(1, images))
+    if images > 1:
+        data = [dict(invoice, index=i) for i, invoice in enumerate(invoices)]
+    else:
+        data = invoices[0]
+    text = json.dumps(data, indent=2)
+    
+    config = request_body.get('generationConfig', {})
+    if config.get('responseMimeType') != 'application/json':
+        text = f"```json\n{text}\n```"
+    
+    if settings.truncate_rate and random.random() < settings.truncate_rate:
+        settings.count('truncated')
+        text = text[:random.randint(1, max(1, len(text) - 1))]
+    
+    return text, images * IMAGE_TOKENS + prompt_chars // 4
+
+
+def make_response_chunk(text, prompt_tokens=None, finished=True, output_chars=None):
+    """
+    Wrap generated text in a GenerateContentResponse dict.
+    
+    The finished chunk carries usageMetadata; output_chars is the length of
+    the whole generated text when text is only the last streamed piece.
+    """
+    chunk = {
+        'candidates': [{
+            'content': {'role': 'model', 'parts': [{'text': text}]},
+            'index': 0
+        }]
+    }
+    if finished:
+        output_tokens = (len(text) if output_chars is None else output_chars) // 4
+        chunk['candidates'][0]['finishReason'] = 'STOP'
+        chunk['usageMetadata'] = {
+            'promptTokenCount': prompt_tokens,
+            'candidatesTokenCount': output_tokens,
+            'totalTokenCount': prompt_tokens + output_tokens
+        }
+    return chunk
+
+
+class GeminiStubHandler(BaseHTTPRequestHandler):
+    """Request handler; settings come from the server instance."""
+    
+    protocol_version = 'HTTP/1.1'
+    # Small SSE writes would otherwise sit behind Nagle + delayed ACK for ~40ms each
+    disable_nagle_algorithm = True
+    
+    def log_message(self, format, *args):
+        pass
+    
+    def do_HEAD(self):
+        self._send_json(200, {'status': 'ok'}, head=True)
+    
+    def do_GET(self):
+        if self.path.rstrip('/').endswith('/stats'):
+            self._send_json(200, self.server.settings.stats())
+        else:
+            self._send_json(200, {'status': 'ok'})
+    
+    def do_POST(self):
+        settings = self.server.settings
+        body = self._read_body()
+        match = ROUTE.search(self.path.split('?', 1)[0])
+        if not match:
+            self._send_json(404, {'error': {'code': 404, 'message': f'Unknown route {self.path}', 'status': 'NOT_FOUND'}})
+            return
+        
+        settings.count('requests')
+        latency = settings.sample_latency()
+        
+        if settings.error_rate and random.random() < settings.error_rate:
+            settings.count('errors')
+            time.sleep(latency)
+            self._send_error(random.choice(settings.error_codes))
+            return
+        
+        try:
+            request_body = json.loads(body or b'{}')
+        except json.JSONDecodeError as e:
+            self._send_json(400, {'error': {'code': 400, 'message': f'Invalid JSON payload: {e}', 'status': 'INVALID_ARGUMENT'}})
+            return
+        
+        text, prompt_tokens = build_generated_text(request_body, settings)
+        
+        if match.group('method') == 'streamGenerateContent':
+            settings.count('streamed')
+            self._send_stream(text, prompt_tokens, latency)
+        else:
+            time.sleep(latency)
+            self._send_json(200, make_response_chunk(text, prompt_tokens))
+    
+    def _read_body(self):
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(b';', 1)[0].strip() or b'0', 16)
+                if size == 0:
+                    self.rfile.readline()
+                    return b''.join(chunks)
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+    
+    def _send_error(self, status):
+        names = {429: 'RESOURCE_EXHAUSTED', 500: 'INTERNAL', 502: 'UNAVAILABLE', 503: 'UNAVAILABLE', 504: 'DEADLINE_EXCEEDED'}
+        headers = {}
+        retry_after = self.server.settings.retry_after
+        if status in (429, 503) and retry_after:
+            headers['Retry-After'] = str(retry_after)
+        self._send_json(status, {'error': {'code': status, 'message': 'Injected error from Gemini stub',
+                                           'status': names.get(status, 'UNKNOWN')}}, headers=headers)
+    
+    def _send_json(self, status, data, headers=None, head=False):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=UTF-8')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if not head:
+            self.wfile.write(body)
+    
+    def _send_stream(self, text, prompt_tokens, latency):
+        """Send text as server-sent events, spreading the latency across chunks."""
+        count = self.server.settings.stream_chunks
+        size = max(1, math.ceil(len(text) / count))
+        pieces = [text[i:i + size] for i in range(0, len(text), size)] or ['']
+        
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        for i, piece in enumerate(pieces):
+            time.sleep(latency / len(pieces))
+            chunk = make_response_chunk(piece, prompt_tokens, finished=i == len(pieces) - 1, output_chars=len(text))
+            event = f"data: {json.dumps(chunk)}\r\n\r\n".encode('utf-8')
+            self.wfile.write(b'%x\r\n%s\r\n' % (len(event), event))
+            self.wfile.flush()
+        self.wfile.write(b'0\r\n\r\n')
+
+
+class GeminiStubServer(ThreadingHTTPServer):
+    """Threaded HTTP server with a deep accept backlog for load tests."""
+    
+    daemon_threads = True
+    request_queue_size = 1024
+    
+    def __init__(self, address, settings):
+        self.settings = settings
+        super().__init__(address, GeminiStubHandler)
+
+
+def make_stub_server(host='127.0.0.1', port=8089, **settings):
+    """
+    Create (but do not start) a stand-in server.
+    
+    Args:
+        host (str): Interface to bind
+        port (int): Port to bind (0 picks a free port)
+        **settings: StubSettings arguments
+    
+    Returns:
+        GeminiStubServer: Call serve_forever() (e.g. in a thread) to run it
+    """
+    return GeminiStubServer((host, port), StubSettings(**settings))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local stand-in for the Gemini generateContent API')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8089)
+    parser.add_argument('--latency', default='fixed:0',
+                        help='fixed:S | uniform:LOW,HIGH | normal:MEAN,STDDEV | lognormal:MEDIAN,SIGMA | exponential:MEAN')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of requests that fail')
+    parser.add_argument('--error-codes', default='429,500,503', help='Comma-separated statuses for injected errors')
+    parser.add_argument('--retry-after', type=float, default=1, help='Retry-After seconds on injected 429/503 (0 omits it)')
+    parser.add_argument('--truncate-rate', type=float, default=0.0, help='Fraction of responses cut off mid-JSON')
+    parser.add_argument('--responses', help='JSON file with an invoice object or a list of them to serve round-robin')
+    parser.add_argument('--stream-chunks', type=int, default=8, help='Chunks per streamGenerateContent response')
+    parser.add_argument('--seed', type=int, help='Random seed for repeatable runs')
+    args = parser.parse_args()
+    
+    if args.seed is not None:
+        random.seed(args.seed)
+    
+    responses = None
+    if args.responses:
+        with open(args.responses) as f:
+            responses = json.load(f)
+        if isinstance(responses, dict):
+            responses = [responses]
+    
+    server = make_stub_server(
+        args.host, args.port,
+        latency=args.latency,
+        error_rate=args.error_rate,
+        error_codes=[int(code) for code in args.error_codes.split(',') if code],
+        retry_after=args.retry_after,
+        truncate_rate=args.truncate_rate,
+        responses=responses,
+        stream_chunks=args.stream_chunks
+    )
+    print(f"Gemini stub listening on http://{args.host}:{server.server_port}/v1 (latency {args.latency})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -4,13 +4,24 @@ Advanced features: Database storage, Authentication, Batch processing, Analytics
 """
 
 import os
+import re
 import sys
+import time
+import html
+import logging
 import tempfile
 import uuid
 import json
 import secrets
+import sqlite3
+import base64
+import binascii
+import hashlib
+import threading
 import urllib.parse
-from flask import Flask, request, jsonify, send_file, send_from_directory, redirect, session
+from collections import OrderedDict
+from contextlib import contextmanager
+from flask import Flask, Response, request, jsonify, send_file, send_from_directory, redirect, session, stream_with_context
 from werkzeug.utils import secure_filename
 from io import BytesIO
 import requests
@@ -18,21 +29,434 @@ import requests
 # Add the parent directory to sys.path
 sys.path.insert(0, os.path.dirname(__file__))
 
-from processor import extract_invoice_data
+from processor import (extract_invoice_data, extract_invoice_data_stream, extract_packed_invoices,
+                       get_extraction_backend, get_gemini_client, guess_mime_type)
+from extraction_cache import get_extraction_cache
+from timing import collect_stage_timings, current_timings, record_stage, stage
+from near_duplicates import NearDuplicateIndex, fingerprint, get_near_duplicate_settings, thumbnails_match
+from amounts import REPORT_CURRENCY, get_fx_rates, minor_unit_exponent, normalize_amounts
+
+# Levelled logging for the extraction pipeline; LOG_LEVEL=DEBUG shows per-request detail
+logging.basicConfig(
+    level=os.environ.get('LOG_LEVEL', 'INFO').upper(),
+    format='%(asctime)s %(levelname)s %(name)s: %(message)s'
+)
+# HTTP client loggers print request URLs, which carry the Gemini API key
+logging.getLogger('urllib3').setLevel(logging.WARNING)
+logging.getLogger('httpx').setLevel(logging.WARNING)
+logger = logging.getLogger(__name__)
+
+# SQLite file for invoices; empty keeps them in memory (lost on restart, single worker only)
+DATABASE_PATH = os.environ.get('DATABASE_PATH', '')
+DB_BUSY_TIMEOUT_MS = int(os.environ.get('DB_BUSY_TIMEOUT_MS', '5000'))
+DB_CACHE_SIZE_KB = int(os.environ.get('DB_CACHE_SIZE_KB', '16384'))
+DB_MMAP_SIZE = int(os.environ.get('DB_MMAP_SIZE', str(256 * 1024 * 1024)))
+
+
+def encode_cursor(*key):
+    """Opaque keyset cursor for the sort key of the last row on a page, e.g. (created_at, id)."""
+    raw = json.dumps(list(key), separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor, types):
+    """
+    Decode a cursor from encode_cursor.
+    
+    Args:
+        cursor (str): Cursor from a previous page
+        types (tuple): Expected type (or tuple of types) of each key part
+    
+    Returns:
+        tuple: The sort key
+    
+    Raises:
+        ValueError: If the cursor is malformed
+    """
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except (TypeError, ValueError, binascii.Error):
+        raise ValueError('Invalid cursor')
+    if (not isinstance(key, list) or len(key) != len(types)
+            or not all(isinstance(part, kind) and not isinstance(part, bool) for part, kind in zip(key, types))):
+        raise ValueError('Invalid cursor')
+    return tuple(key)
+
+
+def parse_fields(value):
+    """Split a "fields=a,b,c" query parameter into column names (None when absent or empty)."""
+    fields = [field.strip() for field in (value or '').split(',') if field.strip()]
+    return fields or None
 
-# Placeholder classes for removed modules
-import sqlite3
-import hashlib
 
 class InvoiceDatabase:
-    def __init__(self):
-        self.conn = sqlite3.connect(':memory:', check_same_thread=False)
-        self.conn.row_factory = sqlite3.Row
+    # Columns added after the original invoices schema: (name, SQL type)
+    INVOICE_COLUMNS = [
+        ('extraction_method', 'TEXT'),
+        ('prompt_tokens', 'INTEGER'),
+        ('output_tokens', 'INTEGER'),
+        ('total_tokens', 'INTEGER'),
+        ('extraction_ms', 'REAL'),
+        ('request_bytes', 'INTEGER'),
+        ('perceptual_hash', 'TEXT'),
+        # Grayscale thumbnail confirming perceptual matches (see near_duplicates.thumbnails_match)
+        ('perceptual_thumbnail', 'BLOB'),
+        # Parsed from total/subtotal/tax at save time (see amounts.normalize_amounts)
+        ('total_minor', 'INTEGER'),
+        ('subtotal_minor', 'INTEGER'),
+        ('tax_minor', 'INTEGER'),
+        ('currency', 'TEXT'),
+        # The row as returned by the API, serialized by triggers (see _create_payloads)
+        ('payload_json', 'TEXT')
+    ]
+    
+    # Stored for the database's own use; never returned by the API
+    INTERNAL_COLUMNS = ('perceptual_thumbnail', 'payload_json')
+    
+    # (name, table and columns); see _create_indexes
+    INVOICE_INDEXES = [
+        ('idx_invoices_user_created', 'invoices (user_id, created_at)'),
+        ('idx_invoices_user_type_created', 'invoices (user_id, upload_type, created_at)'),
+        ('idx_invoices_user_status_created', 'invoices (user_id, status, created_at)'),
+        ('idx_invoices_type_created', 'invoices (upload_type, created_at)'),
+        ('idx_invoices_created', 'invoices (created_at)'),
+        # A user's image invoices, for the per-user near-duplicate index
+        ('idx_invoices_user_phash', 'invoices (user_id, id) WHERE perceptual_hash IS NOT NULL'),
+        # Only rows still waiting for backfill_amounts
+        ('idx_invoices_amounts_pending', 'invoices (id) WHERE currency IS NULL')
+    ]
+    
+    def __init__(self, path=None, near_duplicate_distance=None):
+        """
+        Args:
+            path (str, optional): SQLite file (default: DATABASE_PATH; empty or ':memory:' keeps
+                the database in memory)
+            near_duplicate_distance (int, optional): Max dHash Hamming distance for near-duplicate
+                candidates (None disables perceptual matching)
+        """
+        self.path = (DATABASE_PATH if path is None else path) or ':memory:'
+        self._local = threading.local()
+        # One writer at a time per process; WAL lets readers run alongside it
+        self._write_lock = threading.RLock()
+        self._shared_conn = None
+        if self.path == ':memory:':
+            # An in-memory database only exists on its own connection, so all threads share it
+            self._shared_conn = self._connect()
         self._init_db()
+        self.backfill_amounts()
+        self._migrate()
+        self.near_duplicate_distance = near_duplicate_distance
+        # user_id -> (signature, NearDuplicateIndex), least recently used first
+        self._near_duplicate_indexes = OrderedDict()
+        self._near_duplicate_lock = threading.Lock()
+    
+    @property
+    def conn(self):
+        """This thread's connection (the shared one for in-memory databases)."""
+        if self._shared_conn is not None:
+            return self._shared_conn
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+        return conn
+    
+    def _connect(self):
+        """Open a connection with the WAL/cache pragmas for file-backed databases."""
+        conn = sqlite3.connect(self.path, check_same_thread=False, timeout=DB_BUSY_TIMEOUT_MS / 1000)
+        conn.row_factory = sqlite3.Row
+        if self.path != ':memory:':
+            conn.execute('PRAGMA journal_mode=WAL')
+            # Durable at checkpoints; a power loss can drop the last commits but never corrupts
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute(f'PRAGMA busy_timeout={int(DB_BUSY_TIMEOUT_MS)}')
+            conn.execute(f'PRAGMA cache_size=-{int(DB_CACHE_SIZE_KB)}')
+            conn.execute(f'PRAGMA mmap_size={int(DB_MMAP_SIZE)}')
+            conn.execute('PRAGMA temp_store=MEMORY')
+        return conn
+    
+    @contextmanager
+    def writing(self):
+        """
+        Run the enclosed block as this process's single writer.
+        
+        Yields a cursor; commits when the block finishes, rolls back if it raises.
+        File-backed databases take the write lock up front (BEGIN IMMEDIATE) so
+        writers in other processes wait on busy_timeout instead of failing mid-transaction.
+        """
+        with self._write_lock:
+            conn = self.conn
+            if self._shared_conn is None and not conn.in_transaction:
+                conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield conn.cursor()
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
     
     def _init_db(self):
         """Initialize database tables"""
-        cursor = self.conn.cursor()
+        with self.writing() as cursor:
+            self._create_tables(cursor)
+        self._create_indexes()
+        self.fts_enabled = self._create_search_index()
+        self._create_rollups()
+        self.payloads_enabled = self._create_payloads()
+        self.set_fx_rates(get_fx_rates())
+    
+    # Rollup table -> (key column -> expression, measure column -> (type, per-row value)).
+    # Expressions are written against an invoices row alias; NULL keys are stored as ''.
+    ROLLUP_MEASURES = {
+        'invoices': ('INTEGER', '1'),
+        'priced_invoices': ('INTEGER', '{row}.total_minor IS NOT NULL'),
+        'total_minor': ('INTEGER', 'COALESCE({row}.total_minor, 0)')
+    }
+    ROLLUPS = {
+        'invoice_rollups': ({
+            'user_id': "COALESCE({row}.user_id, '')",
+            'day': "COALESCE(date({row}.created_at), '')",
+            'status': "COALESCE({row}.status, '')",
+            'upload_type': "COALESCE({row}.upload_type, '')",
+            'currency': "COALESCE({row}.currency, '')"
+        }, dict(ROLLUP_MEASURES, **{
+            'metered_invoices': ('INTEGER', '{row}.total_tokens IS NOT NULL'),
+            'prompt_tokens': ('INTEGER', 'COALESCE({row}.prompt_tokens, 0)'),
+            'output_tokens': ('INTEGER', 'COALESCE({row}.output_tokens, 0)'),
+            'total_tokens': ('INTEGER', 'COALESCE({row}.total_tokens, 0)'),
+            'timed_invoices': ('INTEGER', '{row}.extraction_ms IS NOT NULL'),
+            'extraction_ms': ('REAL', 'COALESCE({row}.extraction_ms, 0)'),
+            'request_bytes': ('INTEGER', 'COALESCE({row}.request_bytes, 0)')
+        })),
+        'vendor_rollups': ({
+            'user_id': "COALESCE({row}.user_id, '')",
+            'vendor': "COALESCE({row}.vendor, '')",
+            'currency': "COALESCE({row}.currency, '')"
+        }, ROLLUP_MEASURES)
+    }
+    
+    def _create_rollups(self):
+        """
+        Create the analytics rollup tables and the triggers that maintain them.
+        
+        invoice_rollups holds invoice counts, exact total_minor sums and Gemini
+        usage sums per (user_id, day, status, upload_type, currency);
+        vendor_rollups holds counts and amounts per (user_id, vendor, currency).
+        Triggers on invoices apply every insert/update/delete inside the
+        writing transaction, so analytics read buckets instead of invoices.
+        Tables created here (new database or upgrade) are filled by
+        rebuild_rollups().
+        """
+        created = False
+        with self.writing() as cursor:
+            for table, (keys, measures) in self.ROLLUPS.items():
+                exists = cursor.execute(
+                    "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)
+                ).fetchone()
+                if not exists:
+                    columns = [f'{key} TEXT NOT NULL' for key in keys]
+                    columns += [f'{name} {kind} NOT NULL DEFAULT 0' for name, (kind, _) in measures.items()]
+                    cursor.execute(f'''
+                        CREATE TABLE {table} (
+                            {', '.join(columns)},
+                            PRIMARY KEY ({', '.join(keys)})
+                        ) WITHOUT ROWID
+                    ''')
+                    created = True
+                
+                def apply(row, sign):
+                    key_values = [expression.format(row=row) for expression in keys.values()]
+                    match = ' AND '.join(f'{key} = {value}' for key, value in zip(keys, key_values))
+                    return f'''
+                        INSERT INTO {table} ({', '.join(keys)}, {', '.join(measures)})
+                        VALUES ({', '.join(key_values)},
+                                {', '.join(f'{sign}({value.format(row=row)})' for _, value in measures.values())})
+                        ON CONFLICT ({', '.join(keys)}) DO UPDATE SET
+                            {', '.join(f'{name} = {name} + excluded.{name}' for name in measures)};
+                        DELETE FROM {table} WHERE {match} AND invoices <= 0;
+                    '''
+                
+                cursor.execute(f'''
+                    CREATE TRIGGER IF NOT EXISTS {table}_insert AFTER INSERT ON invoices BEGIN
+                        {apply('new', '+')}
+                    END
+                ''')
+                cursor.execute(f'''
+                    CREATE TRIGGER IF NOT EXISTS {table}_delete AFTER DELETE ON invoices BEGIN
+                        {apply('old', '-')}
+                    END
+                ''')
+                cursor.execute(f'''
+                    CREATE TRIGGER IF NOT EXISTS {table}_update
+                    AFTER UPDATE OF user_id, created_at, status, upload_type, vendor, currency, total_minor,
+                                    prompt_tokens, output_tokens, total_tokens, extraction_ms, request_bytes
+                    ON invoices
+                    BEGIN
+                        {apply('old', '-')}
+                        {apply('new', '+')}
+                    END
+                ''')
+        if created:
+            self.rebuild_rollups()
+    
+    def rebuild_rollups(self):
+        """
+        Recompute every rollup table from the invoices table.
+        
+        Returns:
+            dict: Rollup table -> buckets written
+        """
+        counts = {}
+        with self.writing() as cursor:
+            for table, (keys, measures) in self.ROLLUPS.items():
+                key_values = ', '.join(expression.format(row='invoices') for expression in keys.values())
+                sums = ', '.join(f"SUM({value.format(row='invoices')})" for _, value in measures.values())
+                cursor.execute(f'DELETE FROM {table}')
+                cursor.execute(f'''
+                    INSERT INTO {table} ({', '.join(keys)}, {', '.join(measures)})
+                    SELECT {key_values}, {sums} FROM invoices GROUP BY {key_values}
+                ''')
+                counts[table] = cursor.rowcount
+        return counts
+    
+    def _create_search_index(self):
+        """
+        Create the FTS5 index over vendor, invoice number, summary and line-item
+        descriptions, kept in sync with invoices by triggers.
+        
+        Returns:
+            bool: False when this SQLite build has no FTS5 (search falls back to LIKE)
+        """
+        descriptions = (
+            "(SELECT group_concat(json_extract(value, '$.description'), ' ') "
+            "FROM json_each(CASE WHEN json_valid({row}.line_items) THEN {row}.line_items ELSE '[]' END) "
+            "WHERE type = 'object')"
+        )
+        insert = (
+            "INSERT INTO invoices_fts (rowid, vendor, invoice_number, summary, line_items) "
+            f"VALUES (new.id, new.vendor, new.invoice_number, new.summary, {descriptions.format(row='new')});"
+        )
+        with self.writing() as cursor:
+            exists = cursor.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'invoices_fts'"
+            ).fetchone()
+            if not exists:
+                try:
+                    cursor.execute('''
+                        CREATE VIRTUAL TABLE invoices_fts USING fts5(
+                            vendor, invoice_number, summary, line_items,
+                            tokenize = 'unicode61 remove_diacritics 2',
+                            prefix = '2 3'
+                        )
+                    ''')
+                except sqlite3.OperationalError as e:
+                    logger.warning("Full-text search unavailable (%s); search uses LIKE", e)
+                    return False
+                cursor.execute(
+                    "INSERT INTO invoices_fts (rowid, vendor, invoice_number, summary, line_items) "
+                    f"SELECT id, vendor, invoice_number, summary, {descriptions.format(row='invoices')} FROM invoices"
+                )
+            cursor.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS invoices_fts_insert AFTER INSERT ON invoices BEGIN
+                    {insert}
+                END
+            ''')
+            cursor.execute('''
+                CREATE TRIGGER IF NOT EXISTS invoices_fts_delete AFTER DELETE ON invoices BEGIN
+                    DELETE FROM invoices_fts WHERE rowid = old.id;
+                END
+            ''')
+            cursor.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS invoices_fts_update
+                AFTER UPDATE OF vendor, invoice_number, summary, line_items ON invoices BEGIN
+                    DELETE FROM invoices_fts WHERE rowid = old.id;
+                    {insert}
+                END
+            ''')
+        return True
+    
+    def _create_payloads(self):
+        """
+        Keep invoices.payload_json equal to the invoice as the API returns it.
+        
+        Triggers serialize the row (line_items as decoded JSON) on insert and
+        whenever any other column changes, so status updates and amount
+        backfills refresh it too. List and get endpoints splice the stored
+        text into their response instead of decoding and re-encoding rows.
+        When the column set changes, the triggers are replaced and every
+        payload is rewritten.
+        
+        Returns:
+            bool: False when this SQLite build has no JSON functions (reads build dicts instead)
+        """
+        line_items = (
+            "CASE WHEN {row}.line_items IS NULL OR {row}.line_items = '' THEN {row}.line_items "
+            "WHEN json_valid({row}.line_items) THEN json({row}.line_items) ELSE json_array() END"
+        )
+        
+        def payload(row):
+            values = ', '.join(
+                f"'{field}', " + (line_items.format(row=row) if field == 'line_items' else f'{row}.{field}')
+                for field in self.invoice_fields
+            )
+            return f'json_object({values})'
+        
+        triggers = {
+            'invoices_payload_insert': f'''
+                CREATE TRIGGER invoices_payload_insert AFTER INSERT ON invoices BEGIN
+                    UPDATE invoices SET payload_json = {payload('new')} WHERE id = new.id;
+                END
+            ''',
+            'invoices_payload_update': f'''
+                CREATE TRIGGER invoices_payload_update
+                AFTER UPDATE OF {', '.join(self.invoice_fields)} ON invoices BEGIN
+                    UPDATE invoices SET payload_json = {payload('new')} WHERE id = new.id;
+                END
+            '''
+        }
+        with self.writing() as cursor:
+            try:
+                cursor.execute("SELECT json_object('id', 1)")
+            except sqlite3.OperationalError as e:
+                logger.warning("JSON functions unavailable (%s); invoice reads build responses per row", e)
+                for name in triggers:
+                    cursor.execute(f'DROP TRIGGER IF EXISTS {name}')
+                return False
+            
+            changed = False
+            for name, sql in triggers.items():
+                existing = cursor.execute(
+                    "SELECT sql FROM sqlite_master WHERE type = 'trigger' AND name = ?", (name,)
+                ).fetchone()
+                if existing is None or existing['sql'] != sql.strip():
+                    cursor.execute(f'DROP TRIGGER IF EXISTS {name}')
+                    cursor.execute(sql.strip())
+                    changed = True
+            if changed:
+                cursor.execute(f"UPDATE invoices SET payload_json = {payload('invoices')}")
+        return True
+    
+    def _create_indexes(self):
+        """
+        Create indexes for the query shapes InvoiceDatabase runs.
+        
+        Listing filters by user_id and optionally upload_type or status and
+        orders by created_at; each combination has an index ending in
+        created_at so rows come out already sorted. SQLite appends the rowid
+        to every index entry, so scanning one backwards yields exactly
+        ORDER BY created_at DESC, id DESC (keyset pagination) with no sort step.
+        """
+        with self.writing() as cursor:
+            for name, definition in self.INVOICE_INDEXES:
+                cursor.execute(f'CREATE INDEX IF NOT EXISTS {name} ON {definition}')
+            # Invoices saved before this index existed may repeat a file per user
+            try:
+                cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_invoices_file_hash_user '
+                               'ON invoices (file_hash, user_id)')
+            except sqlite3.IntegrityError:
+                logger.warning("Duplicate invoices per user exist; file_hash index created without UNIQUE")
+                cursor.execute('CREATE INDEX IF NOT EXISTS idx_invoices_file_hash ON invoices (file_hash, user_id)')
+    
+    def _create_tables(self, cursor):
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS invoices (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -51,6 +475,9 @@ class InvoiceDatabase:
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
         ''')
+        self._add_missing_columns(cursor, 'invoices', self.INVOICE_COLUMNS)
+        self.invoice_fields = [row[1] for row in cursor.execute('PRAGMA table_info(invoices)')
+                               if row[1] not in self.INTERNAL_COLUMNS]
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS users (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -59,7 +486,158 @@ class InvoiceDatabase:
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
         ''')
-        self.conn.commit()
+        # Units of REPORT_CURRENCY per unit of currency, for converting totals in SQL
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS fx_rates (
+                currency TEXT PRIMARY KEY,
+                rate REAL NOT NULL,
+                minor_units INTEGER NOT NULL DEFAULT 100
+            )
+        ''')
+    
+    def set_fx_rates(self, rates):
+        """
+        Store FX rates used by report totals.
+        
+        Args:
+            rates (dict): currency code -> units of REPORT_CURRENCY per one unit of that currency
+        """
+        with self.writing() as cursor:
+            cursor.executemany(
+                'INSERT OR REPLACE INTO fx_rates (currency, rate, minor_units) VALUES (?, ?, ?)',
+                [(code, rate, 10 ** minor_unit_exponent(code)) for code, rate in rates.items()]
+            )
+    
+    def backfill_amounts(self, batch_size=500):
+        """
+        Parse amounts for invoices saved before the minor-unit columns existed.
+        
+        Every processed row gets a currency (the default when none is named),
+        so rows are only visited once even when their amounts cannot be parsed.
+        
+        Returns:
+            int: Rows updated
+        """
+        cursor = self.conn.cursor()
+        updated = 0
+        while True:
+            rows = cursor.execute(
+                'SELECT id, total, subtotal, tax FROM invoices WHERE currency IS NULL LIMIT ?', (batch_size,)
+            ).fetchall()
+            if not rows:
+                break
+            with self.writing() as write_cursor:
+                write_cursor.executemany(
+                    'UPDATE invoices SET total_minor = ?, subtotal_minor = ?, tax_minor = ?, currency = ? WHERE id = ?',
+                    [(amounts['total_minor'], amounts['subtotal_minor'], amounts['tax_minor'], amounts['currency'], row['id'])
+                     for row, amounts in ((row, normalize_amounts(dict(row))) for row in rows)]
+                )
+            updated += len(rows)
+        return updated
+    
+    # PRAGMA user_version: one-off data repairs already applied to this database
+    SCHEMA_VERSION = 1
+    
+    def _migrate(self):
+        """Run the data repairs this database has not had yet, then record SCHEMA_VERSION."""
+        version = self.conn.execute('PRAGMA user_version').fetchone()[0]
+        if version >= self.SCHEMA_VERSION:
+            return
+        if version < 1:
+            self.repair_leading_decimal_amounts()
+        with self.writing() as cursor:
+            cursor.execute(f'PRAGMA user_version = {self.SCHEMA_VERSION}')
+    
+    def repair_leading_decimal_amounts(self):
+        """
+        Re-parse amounts written with a leading decimal point, e.g. "$.99".
+        
+        parse_amount used to skip the separator and read them as whole units,
+        100x too large. Runs once per database (see _migrate); only rows whose
+        stored minor units differ from a fresh parse are rewritten.
+        
+        Returns:
+            int: Rows updated
+        """
+        fields = ('total', 'subtotal', 'tax')
+        condition = ' OR '.join(f"{field} GLOB '[.,][0-9]*' OR {field} GLOB '*[^0-9A-Za-z_][.,][0-9]*'"
+                                for field in fields)
+        rows = self.conn.execute(
+            f'SELECT id, total, subtotal, tax, total_minor, subtotal_minor, tax_minor, currency FROM invoices '
+            f'WHERE currency IS NOT NULL AND ({condition})'
+        ).fetchall()
+        updates = []
+        for row in rows:
+            amounts = normalize_amounts(dict(row), default_currency=row['currency'])
+            minor = tuple(amounts[f'{field}_minor'] for field in fields)
+            if minor != tuple(row[f'{field}_minor'] for field in fields):
+                updates.append(minor + (row['id'],))
+        if updates:
+            with self.writing() as cursor:
+                cursor.executemany(
+                    'UPDATE invoices SET total_minor = ?, subtotal_minor = ?, tax_minor = ? WHERE id = ?', updates
+                )
+            logger.info("Re-parsed %d invoices with leading-decimal amounts", len(updates))
+        return len(updates)
+    
+    # Users whose near-duplicate index is kept in memory
+    NEAR_DUPLICATE_CACHED_USERS = 256
+    
+    def _near_duplicate_index(self, user_id):
+        """
+        Return a user's near-duplicate index, rebuilt from the database when stale.
+        
+        The cached index is reused only while the user's (count, max id) of
+        hashed invoices matches the database. Inserts made through this
+        instance are added to the cached index and move its signature forward
+        (see _index_near_duplicate); ids only grow, so deletes and writes from
+        another worker sharing the database file force a rebuild.
+        """
+        signature = tuple(self.conn.execute(
+            'SELECT COUNT(*), MAX(id) FROM invoices WHERE user_id = ? AND perceptual_hash IS NOT NULL', (user_id,)
+        ).fetchone())
+        with self._near_duplicate_lock:
+            cached = self._near_duplicate_indexes.get(user_id)
+            if cached and cached[0] == signature:
+                self._near_duplicate_indexes.move_to_end(user_id)
+                return cached[1]
+        
+        index = NearDuplicateIndex(self.near_duplicate_distance)
+        rows = self.conn.execute(
+            'SELECT id, perceptual_hash FROM invoices WHERE user_id = ? AND perceptual_hash IS NOT NULL', (user_id,)
+        )
+        for row in rows:
+            index.add(int(row['perceptual_hash'], 16), row['id'])
+        with self._near_duplicate_lock:
+            self._near_duplicate_indexes[user_id] = (signature, index)
+            self._near_duplicate_indexes.move_to_end(user_id)
+            while len(self._near_duplicate_indexes) > self.NEAR_DUPLICATE_CACHED_USERS:
+                self._near_duplicate_indexes.popitem(last=False)
+        return index
+    
+    def _index_near_duplicate(self, user_id, invoice_id, perceptual_hash):
+        """
+        Add a just-inserted invoice to the user's cached near-duplicate index.
+        
+        Called with the write lock still held after the insert commits, so the
+        cached (count, max id) signature moves forward by exactly that insert.
+        If anything else changed the user's rows since the index was built, the
+        signature still differs from the database and the next lookup rebuilds.
+        """
+        with self._near_duplicate_lock:
+            cached = self._near_duplicate_indexes.get(user_id)
+            if cached is None:
+                return
+            (count, _), index = cached
+            index.add(perceptual_hash, invoice_id)
+            self._near_duplicate_indexes[user_id] = ((count + 1, invoice_id), index)
+    
+    def _add_missing_columns(self, cursor, table, columns):
+        """Add any of (name, type) columns that an existing table does not have yet."""
+        existing = {row[1] for row in cursor.execute(f'PRAGMA table_info({table})')}
+        for name, column_type in columns:
+            if name not in existing:
+                cursor.execute(f'ALTER TABLE {table} ADD COLUMN {name} {column_type}')
     
     def get_connection(self):
         return self.conn
@@ -67,26 +645,172 @@ class InvoiceDatabase:
     def calculate_file_hash(self, data):
         return hashlib.md5(data).hexdigest()
     
-    def check_duplicate(self, file_hash):
-        cursor = self.conn.cursor()
-        cursor.execute('SELECT id FROM invoices WHERE file_hash = ?', (file_hash,))
-        return cursor.fetchone() is not None
+    def calculate_fingerprint(self, source):
+        """
+        Perceptual fingerprint of an image upload (bytes or path).
+        
+        Returns:
+            tuple or None: (dHash, thumbnail) - None when near-duplicate detection is off
+                           or for PDFs/unreadable files
+        """
+        if self.near_duplicate_distance is None:
+            return None
+        return fingerprint(source)
     
-    def save_invoice(self, data, user_id, file_hash, upload_type='single', status='processed'):
+    def check_duplicate(self, file_hash, user_id):
+        """Return this user's stored invoice with exactly this file hash, or None."""
         cursor = self.conn.cursor()
+        cursor.execute('SELECT id FROM invoices WHERE file_hash = ? AND user_id = ? LIMIT 1', (file_hash, user_id))
+        row = cursor.fetchone()
+        return self.get_invoice(row['id']) if row else None
+    
+    def find_near_duplicate(self, image_fingerprint, user_id):
+        """
+        Find the user's stored invoice that shows the same image.
+        
+        Candidates within near_duplicate_distance of the dHash are confirmed
+        by comparing thumbnails, closest first; invoices saved without a
+        thumbnail are never matched.
+        
+        Args:
+            image_fingerprint (tuple): (dHash, thumbnail) of the uploaded image
+            user_id (str): Only this user's invoices are considered
+        
+        Returns:
+            tuple: (invoice dict, Hamming distance), or None when nothing matches
+        """
+        if self.near_duplicate_distance is None or image_fingerprint is None:
+            return None
+        perceptual_hash, thumbnail = image_fingerprint
+        for distance, invoice_id in self._near_duplicate_index(user_id).find(perceptual_hash):
+            row = self.conn.execute(
+                'SELECT perceptual_thumbnail FROM invoices WHERE id = ? AND user_id = ?', (invoice_id, user_id)
+            ).fetchone()
+            if row and thumbnails_match(row['perceptual_thumbnail'], thumbnail):
+                return self.get_invoice(invoice_id), distance
+        return None
+    
+    def save_invoice(self, data, user_id, file_hash, upload_type='single', status='processed',
+                     image_fingerprint=None):
+        """
+        Store an extracted invoice.
+        
+        A file is stored once per user; saving the same file_hash for the
+        same user again returns the existing invoice's id.
+        
+        Args:
+            image_fingerprint (tuple, optional): (dHash, thumbnail) from calculate_fingerprint
+        
+        Returns:
+            int: Invoice id
+        """
         line_items_json = json.dumps(data.get('line_items', []))
-        cursor.execute('''
-            INSERT INTO invoices (user_id, vendor, date, total, invoice_number, tax, subtotal, summary, line_items, file_hash, upload_type, status)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (user_id, data.get('vendor'), data.get('date'), data.get('total'), 
-              data.get('invoice_number'), data.get('tax'), data.get('subtotal'),
-              data.get('summary'), line_items_json, file_hash, upload_type, status))
-        self.conn.commit()
-        return cursor.lastrowid
-    
-    def list_invoices(self, user_id=None, status=None, upload_type=None, limit=50, offset=0):
+        usage = data.get('_usage') or {}
+        amounts = normalize_amounts(data)
+        try:
+            invoice_id = self._insert_invoice(data, user_id, file_hash, upload_type, status,
+                                              image_fingerprint, line_items_json, usage, amounts)
+        except sqlite3.IntegrityError:
+            row = self.conn.execute('SELECT id FROM invoices WHERE file_hash = ? AND user_id = ?',
+                                    (file_hash, user_id)).fetchone()
+            if row is None:
+                raise
+            return row['id']
+        return invoice_id
+    
+    def _insert_invoice(self, data, user_id, file_hash, upload_type, status, image_fingerprint,
+                        line_items_json, usage, amounts):
+        perceptual_hash, thumbnail = image_fingerprint or (None, None)
+        with self._write_lock:
+            with self.writing() as cursor:
+                cursor.execute('''
+                    INSERT INTO invoices (user_id, vendor, date, total, invoice_number, tax, subtotal, summary, line_items, file_hash, upload_type, status,
+                                          extraction_method, prompt_tokens, output_tokens, total_tokens, extraction_ms, request_bytes,
+                                          perceptual_hash, perceptual_thumbnail, total_minor, subtotal_minor, tax_minor, currency)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ''', (user_id, data.get('vendor'), data.get('date'), data.get('total'), 
+                      data.get('invoice_number'), data.get('tax'), data.get('subtotal'),
+                      data.get('summary'), line_items_json, file_hash, upload_type, status,
+                      data.get('_method'), usage.get('prompt_tokens'), usage.get('output_tokens'),
+                      usage.get('total_tokens'), usage.get('latency_ms'), usage.get('request_bytes'),
+                      f'{perceptual_hash:016x}' if perceptual_hash is not None else None, thumbnail,
+                      amounts['total_minor'], amounts['subtotal_minor'], amounts['tax_minor'], amounts['currency']))
+            invoice_id = cursor.lastrowid
+            if perceptual_hash is not None:
+                self._index_near_duplicate(user_id, invoice_id, perceptual_hash)
+        return invoice_id
+    
+    # Always selected by a projection: the row key and the keyset cursor columns
+    REQUIRED_FIELDS = ('id', 'created_at')
+    
+    def select_columns(self, fields=None, alias=None):
+        """
+        Turn a field projection into an SQL column list.
+        
+        Args:
+            fields (list, optional): Invoice columns to return (None: all but
+                INTERNAL_COLUMNS); id and created_at are always included
+            alias (str, optional): Table alias to qualify the columns with
+        
+        Returns:
+            str: Column list for a SELECT
+        
+        Raises:
+            ValueError: If a field is not an invoices column
+        """
+        prefix = f'{alias}.' if alias else ''
+        if not fields:
+            return ', '.join(prefix + column for column in self.invoice_fields)
+        unknown = [field for field in fields if field not in self.invoice_fields]
+        if unknown:
+            raise ValueError(f"Unknown field(s): {', '.join(unknown)}")
+        columns = list(self.REQUIRED_FIELDS) + [field for field in fields if field not in self.REQUIRED_FIELDS]
+        return ', '.join(prefix + column for column in dict.fromkeys(columns))
+    
+    def count_invoices(self, user_id=None, status=None, upload_type=None):
+        """Count invoices from invoice_rollups, without touching the invoices table."""
+        query = 'SELECT COALESCE(SUM(invoices), 0) FROM invoice_rollups WHERE 1=1'
+        params = []
+        for column, value in (('user_id', user_id), ('status', status), ('upload_type', upload_type)):
+            if value:
+                query += f' AND {column} = ?'
+                params.append(value)
+        return self.conn.execute(query, params).fetchone()[0]
+    
+    def list_invoices(self, user_id=None, status=None, upload_type=None, limit=50, offset=0, after=None,
+                      fields=None):
+        """
+        List invoices newest first.
+        
+        Args:
+            after (str, optional): Keyset cursor (see encode_cursor); returns the invoices
+                after it and ignores offset. Pages stay fast at any depth and do not
+                shift when invoices are added while paging.
+            fields (list, optional): Columns to return (see select_columns); line_items
+                is only decoded when selected
+        """
         cursor = self.conn.cursor()
-        query = 'SELECT * FROM invoices WHERE 1=1'
+        query, params = self._list_query(self.select_columns(fields), user_id, status, upload_type, limit,
+                                         offset, after)
+        cursor.execute(query, params)
+        return self._rows_to_invoices(cursor.fetchall())
+    
+    def list_invoice_payloads(self, user_id=None, status=None, upload_type=None, limit=50, offset=0, after=None):
+        """
+        List invoices like list_invoices, as their stored JSON text.
+        
+        Only valid while payloads_enabled.
+        
+        Returns:
+            list: Rows of (id, created_at, payload_json)
+        """
+        query, params = self._list_query('id, created_at, payload_json', user_id, status, upload_type, limit,
+                                         offset, after)
+        return self.conn.execute(query, params).fetchall()
+    
+    def _list_query(self, columns, user_id, status, upload_type, limit, offset, after):
+        """Build the filtered, newest-first, keyset-paginated invoices query for list_invoices."""
+        query = f'SELECT {columns} FROM invoices WHERE 1=1'
         params = []
         if user_id:
             query += ' AND user_id = ?'
@@ -97,31 +821,79 @@ class InvoiceDatabase:
         if upload_type:
             query += ' AND upload_type = ?'
             params.append(upload_type)
-        query += ' ORDER BY created_at DESC LIMIT ? OFFSET ?'
+        if after:
+            query += ' AND (created_at, id) < (?, ?)'
+            params.extend(decode_cursor(after, (str, int)))
+            offset = 0
+        query += ' ORDER BY created_at DESC, id DESC LIMIT ? OFFSET ?'
         params.extend([limit, offset])
-        cursor.execute(query, params)
-        rows = cursor.fetchall()
-        invoices = []
-        for row in rows:
-            invoice = dict(row)
-            # Parse line_items JSON string back to list
-            if invoice.get('line_items'):
-                try:
-                    invoice['line_items'] = json.loads(invoice['line_items'])
-                except:
-                    invoice['line_items'] = []
-            invoices.append(invoice)
+        return query, params
+    
+    # bm25 weights for (vendor, invoice_number, summary, line_items)
+    SEARCH_WEIGHTS = (10.0, 8.0, 2.0, 1.0)
+    
+    def search_invoices(self, search_term, user_id=None, limit=50, after=None, fields=None):
+        """
+        Full-text search over vendor, invoice number, summary and line-item descriptions.
+        
+        Every word in search_term must match, as a prefix ("acm inv" finds
+        "Acme Invoice"). Results are ranked by bm25, best first, and carry a
+        'snippet' with matches wrapped in <mark> (the rest HTML-escaped).
+        
+        Args:
+            search_term (str): Words to search for
+            user_id (str, optional): Only this user's invoices
+            limit (int): Max results
+            after (str, optional): Keyset cursor (see encode_cursor) of (rank, id)
+                from the last result of the previous page
+            fields (list, optional): Columns to return (see select_columns)
+        
+        Returns:
+            list: Invoices, each with 'rank' and 'snippet'
+        """
+        if not self.fts_enabled:
+            return self._search_invoices_like(search_term, user_id, limit, fields)
+        
+        words = re.findall(r'\w+', search_term or '')
+        if not words:
+            return []
+        match = ' '.join('"' + word.replace('"', '""') + '"*' for word in words)
+        
+        query = f'''
+            SELECT * FROM (
+                SELECT {self.select_columns(fields, 'i')}, bm25(invoices_fts, {', '.join(map(str, self.SEARCH_WEIGHTS))}) AS rank,
+                       snippet(invoices_fts, -1, char(2), char(3), '…', 12) AS snippet
+                FROM invoices_fts CROSS JOIN invoices i ON i.id = invoices_fts.rowid
+                WHERE invoices_fts MATCH ?{' AND i.user_id = ?' if user_id else ''}
+            )
+        '''
+        # CROSS JOIN keeps the FTS match as the outer loop instead of probing it per user invoice
+        params = [match] + ([user_id] if user_id else [])
+        if after:
+            query += ' WHERE (rank, id) > (?, ?)'
+            params.extend(decode_cursor(after, ((int, float), int)))
+        query += ' ORDER BY rank, id LIMIT ?'
+        params.append(limit)
+        
+        invoices = self._rows_to_invoices(self.conn.execute(query, params).fetchall())
+        for invoice in invoices:
+            invoice['snippet'] = html.escape(invoice['snippet'] or '').replace('\x02', '<mark>').replace('\x03', '</mark>')
         return invoices
     
-    def search_invoices(self, search_term, user_id=None):
+    def _search_invoices_like(self, search_term, user_id=None, limit=50, fields=None):
+        """Substring search on vendor and invoice number, for SQLite builds without FTS5."""
         cursor = self.conn.cursor()
-        query = 'SELECT * FROM invoices WHERE (vendor LIKE ? OR invoice_number LIKE ?)'
+        query = f'SELECT {self.select_columns(fields)} FROM invoices WHERE (vendor LIKE ? OR invoice_number LIKE ?)'
         params = [f'%{search_term}%', f'%{search_term}%']
         if user_id:
             query += ' AND user_id = ?'
             params.append(user_id)
+        query += ' ORDER BY created_at DESC, id DESC LIMIT ?'
+        params.append(limit)
         cursor.execute(query, params)
-        rows = cursor.fetchall()
+        return self._rows_to_invoices(cursor.fetchall())
+    
+    def _rows_to_invoices(self, rows):
         invoices = []
         for row in rows:
             invoice = dict(row)
@@ -134,62 +906,191 @@ class InvoiceDatabase:
             invoices.append(invoice)
         return invoices
     
-    def get_invoice(self, invoice_id):
+    def get_invoice(self, invoice_id, fields=None):
         cursor = self.conn.cursor()
-        cursor.execute('SELECT * FROM invoices WHERE id = ?', (invoice_id,))
-        row = cursor.fetchone()
-        if row:
-            invoice = dict(row)
-            # Parse line_items JSON string back to list
-            if invoice.get('line_items'):
-                try:
-                    invoice['line_items'] = json.loads(invoice['line_items'])
-                except:
-                    invoice['line_items'] = []
-            return invoice
-        return None
+        cursor.execute(f'SELECT {self.select_columns(fields)} FROM invoices WHERE id = ?', (invoice_id,))
+        invoices = self._rows_to_invoices(cursor.fetchall())
+        return invoices[0] if invoices else None
+    
+    def get_invoice_payload(self, invoice_id):
+        """Stored JSON text of an invoice, or None if it does not exist. Only valid while payloads_enabled."""
+        row = self.conn.execute('SELECT payload_json FROM invoices WHERE id = ?', (invoice_id,)).fetchone()
+        return row['payload_json'] if row else None
     
     def update_invoice_status(self, invoice_id, status, user_id=None):
-        cursor = self.conn.cursor()
-        if user_id:
-            cursor.execute('UPDATE invoices SET status = ? WHERE id = ? AND user_id = ?', 
-                         (status, invoice_id, user_id))
-        else:
-            cursor.execute('UPDATE invoices SET status = ? WHERE id = ?', (status, invoice_id))
-        self.conn.commit()
+        with self.writing() as cursor:
+            if user_id:
+                cursor.execute('UPDATE invoices SET status = ? WHERE id = ? AND user_id = ?', 
+                             (status, invoice_id, user_id))
+            else:
+                cursor.execute('UPDATE invoices SET status = ? WHERE id = ?', (status, invoice_id))
         return cursor.rowcount > 0
     
     def delete_invoice(self, invoice_id):
-        cursor = self.conn.cursor()
-        cursor.execute('DELETE FROM invoices WHERE id = ?', (invoice_id,))
-        self.conn.commit()
+        with self.writing() as cursor:
+            cursor.execute('DELETE FROM invoices WHERE id = ?', (invoice_id,))
         return cursor.rowcount > 0
     
-    def get_analytics(self, user_id=None):
+    def get_analytics(self, user_id=None, days=30):
+        """
+        Invoice counts and amounts, read from the rollup tables.
+        
+        Amounts are converted to REPORT_CURRENCY with fx_rates; invoices in
+        currencies without a rate are only reported under by_currency.
+        
+        Returns:
+            dict: Totals, per status/upload type/currency/day breakdowns, top
+                  vendors, the five most recent invoices and Gemini usage
+        """
+        cursor = self.conn.cursor()
+        where = ' WHERE r.user_id = ?' if user_id else ''
+        params = [user_id] if user_id else []
+        converted = 'COALESCE(SUM(r.total_minor * f.rate / f.minor_units), 0)'
+        rollups = 'invoice_rollups r LEFT JOIN fx_rates f ON f.currency = r.currency'
+        
+        def grouped(table, column, alias, order, limit=None):
+            query = f'''
+                SELECT {column} AS {alias}, SUM(r.invoices) AS count, ROUND({converted}, 2) AS total
+                FROM {table}{where} GROUP BY {column} ORDER BY {order}
+            '''
+            if limit:
+                query += f' LIMIT {int(limit)}'
+            return [dict(row) for row in cursor.execute(query, params).fetchall()]
+        
+        totals = cursor.execute(f'''
+            SELECT COALESCE(SUM(r.invoices), 0) AS invoices,
+                   {converted} AS amount,
+                   COALESCE(SUM(CASE WHEN f.currency IS NOT NULL THEN r.priced_invoices END), 0) AS converted_invoices,
+                   COALESCE(SUM(CASE WHEN r.day >= date('now', 'start of month') THEN r.invoices END), 0) AS monthly
+            FROM {rollups}{where}
+        ''', params).fetchone()
+        by_status = {row['status']: row['count'] for row in grouped(rollups, 'r.status', 'status', 'count DESC')}
+        by_currency = [dict(row) for row in cursor.execute(f'''
+            SELECT r.currency AS currency, SUM(r.invoices) AS count, SUM(r.total_minor) AS total_minor
+            FROM invoice_rollups r{where} GROUP BY r.currency ORDER BY count DESC
+        ''', params).fetchall()]
+        
+        return {
+            'total': totals['invoices'],
+            'total_invoices': totals['invoices'],
+            'pending': by_status.get('pending', 0),
+            'approved': by_status.get('approved', 0),
+            'monthly': totals['monthly'],
+            'currency': REPORT_CURRENCY,
+            'total_amount': round(totals['amount'], 2),
+            'average_amount': round(totals['amount'] / totals['converted_invoices'], 2)
+                              if totals['converted_invoices'] else 0,
+            'by_status': by_status,
+            'by_upload_type': grouped(rollups, 'r.upload_type', 'upload_type', 'count DESC'),
+            'by_currency': by_currency,
+            'by_day': grouped(rollups, 'r.day', 'day', 'day DESC', days),
+            'top_vendors': grouped('vendor_rollups r LEFT JOIN fx_rates f ON f.currency = r.currency',
+                                   "COALESCE(NULLIF(r.vendor, ''), 'Unknown')", 'vendor', 'count DESC, total DESC', 10),
+            'recent_invoices': self.list_invoices(user_id=user_id, limit=5),
+            'usage': self.get_usage_analytics(user_id)
+        }
+    
+    def get_usage_analytics(self, user_id=None, days=30):
+        """
+        Aggregate Gemini token usage, latency and payload size from invoice_rollups.
+        
+        Returns overall totals plus breakdowns per day (most recent `days`),
+        per upload_type and, when not filtered to one user, per user.
+        """
+        cursor = self.conn.cursor()
+        aggregates = '''
+            COALESCE(SUM(invoices), 0) AS invoices,
+            COALESCE(SUM(metered_invoices), 0) AS metered_invoices,
+            COALESCE(SUM(prompt_tokens), 0) AS prompt_tokens,
+            COALESCE(SUM(output_tokens), 0) AS output_tokens,
+            COALESCE(SUM(total_tokens), 0) AS total_tokens,
+            ROUND(SUM(extraction_ms) / NULLIF(SUM(timed_invoices), 0), 2) AS avg_extraction_ms,
+            COALESCE(SUM(request_bytes), 0) AS request_bytes
+        '''
+        where = ' WHERE user_id = ?' if user_id else ''
+        params = [user_id] if user_id else []
+        
+        def grouped(column, alias, order, limit=None):
+            query = f'SELECT {column} AS {alias}, {aggregates} FROM invoice_rollups{where} GROUP BY {alias} ORDER BY {order}'
+            if limit:
+                query += f' LIMIT {int(limit)}'
+            return [dict(row) for row in cursor.execute(query, params).fetchall()]
+        
+        usage = {
+            'totals': dict(cursor.execute(f'SELECT {aggregates} FROM invoice_rollups{where}', params).fetchone()),
+            'by_day': grouped('day', 'day', 'day DESC', days),
+            'by_upload_type': grouped('upload_type', 'upload_type', 'total_tokens DESC')
+        }
+        if not user_id:
+            usage['by_user'] = grouped('user_id', 'user_id', 'total_tokens DESC', 100)
+        return usage
+    
+    def get_amount_summary(self, user_id=None, upload_type=None, top_vendors=5):
+        """
+        Sum invoice totals in SQL.
+        
+        Returns:
+            dict: invoices, total in REPORT_CURRENCY (invoices in currencies
+                  without an FX rate are left out and counted as unconverted),
+                  exact per-currency totals in minor units, and the top vendors
+        """
         cursor = self.conn.cursor()
+        where = ' WHERE 1=1'
+        params = []
         if user_id:
-            cursor.execute('SELECT COUNT(*) as total FROM invoices WHERE user_id = ?', (user_id,))
-        else:
-            cursor.execute('SELECT COUNT(*) as total FROM invoices')
-        total = cursor.fetchone()[0]
+            where += ' AND i.user_id = ?'
+            params.append(user_id)
+        if upload_type:
+            where += ' AND i.upload_type = ?'
+            params.append(upload_type)
+        
+        totals = cursor.execute(f'''
+            SELECT COUNT(*) AS invoices,
+                   COALESCE(SUM(i.total_minor * f.rate / f.minor_units), 0) AS total,
+                   SUM(i.total_minor IS NOT NULL AND f.currency IS NULL) AS unconverted
+            FROM invoices i LEFT JOIN fx_rates f ON f.currency = i.currency{where}
+        ''', params).fetchone()
+        by_currency = cursor.execute(f'''
+            SELECT i.currency AS currency, COUNT(*) AS invoices, SUM(i.total_minor) AS total_minor
+            FROM invoices i{where} AND i.total_minor IS NOT NULL
+            GROUP BY i.currency ORDER BY total_minor DESC
+        ''', params).fetchall()
+        vendors = cursor.execute(f'''
+            SELECT COALESCE(i.vendor, 'Unknown') AS vendor, COUNT(*) AS invoices
+            FROM invoices i{where}
+            GROUP BY COALESCE(i.vendor, 'Unknown') ORDER BY invoices DESC LIMIT ?
+        ''', params + [top_vendors]).fetchall()
         return {
-            'total': total,
-            'pending': 0,
-            'approved': 0,
-            'monthly': 0
+            'invoices': totals['invoices'],
+            'currency': REPORT_CURRENCY,
+            'total': round(totals['total'], 2),
+            'unconverted_invoices': totals['unconverted'] or 0,
+            'by_currency': [dict(row) for row in by_currency],
+            'top_vendors': [(row['vendor'], row['invoices']) for row in vendors]
         }
     
     def get_stats(self, user_id=None):
         return self.get_analytics(user_id)
     
-    def clear_all(self, user_id=None):
-        cursor = self.conn.cursor()
+    def clear_all(self, user_id=None, upload_type=None):
+        """
+        Delete invoices, optionally only one user's and/or one upload type's.
+        
+        Returns:
+            int: Invoices deleted
+        """
+        query = 'DELETE FROM invoices WHERE 1=1'
+        params = []
         if user_id:
-            cursor.execute('DELETE FROM invoices WHERE user_id = ?', (user_id,))
-        else:
-            cursor.execute('DELETE FROM invoices')
-        self.conn.commit()
-        return True
+            query += ' AND user_id = ?'
+            params.append(user_id)
+        if upload_type:
+            query += ' AND upload_type = ?'
+            params.append(upload_type)
+        with self.writing() as cursor:
+            cursor.execute(query, params)
+            deleted = cursor.rowcount
+        return deleted
     
     def get_user_by_email(self, email):
         cursor = self.conn.cursor()
@@ -200,10 +1101,9 @@ class InvoiceDatabase:
         return None
     
     def create_user(self, email, name):
-        cursor = self.conn.cursor()
         try:
-            cursor.execute('INSERT INTO users (email, name) VALUES (?, ?)', (email, name))
-            self.conn.commit()
+            with self.writing() as cursor:
+                cursor.execute('INSERT INTO users (email, name) VALUES (?, ?)', (email, name))
             return cursor.lastrowid
         except:
             return None
@@ -240,30 +1140,144 @@ class AuthManager:
 
 auth_manager = AuthManager()
 
-def process_batch(files, api_key, extract_fn, max_workers=3):
-    import tempfile
-    from werkzeug.utils import secure_filename
+# Batch packing: small images are grouped into one Gemini call (opt-in per request with pack=true)
+BATCH_PACKING = os.environ.get('BATCH_PACKING', 'false').lower() == 'true'
+PACK_MAX_FILES = int(os.environ.get('PACK_MAX_FILES', '8'))
+PACK_MAX_BYTES = int(os.environ.get('PACK_MAX_BYTES', str(4 * 1024 * 1024)))
+PACK_MAX_FILE_BYTES = int(os.environ.get('PACK_MAX_FILE_BYTES', str(512 * 1024)))
+
+# Uploads above this many bytes spill to a temp file instead of being held in memory (0 = never spill)
+UPLOAD_SPILL_THRESHOLD = int(os.environ.get('UPLOAD_SPILL_THRESHOLD', '0'))
+
+# Attach the per-stage timing breakdown to /api/v2/process responses (or per request with debug=true)
+DEBUG_TIMINGS = os.environ.get('DEBUG_TIMINGS', 'false').lower() == 'true'
+
+
+def read_upload(file, chunk_size=1024 * 1024):
+    """
+    Read an uploaded file for extraction in a single pass, hashing as it goes.
+    
+    Small uploads stay in memory and are handed to the extractor as bytes.
+    Uploads larger than UPLOAD_SPILL_THRESHOLD (when set) are streamed to a
+    temp file instead, which the caller must delete.
+    
+    Args:
+        file: Werkzeug FileStorage
+        chunk_size (int): Bytes read from the upload stream at a time
+    
+    Returns:
+        tuple: (source, file_hash, temp_path) - source is bytes or a temp file path;
+               temp_path is None unless the upload was spilled to disk
+    """
+    stream = file.stream
+    hasher = hashlib.md5()
     
-    results = []
-    for f in files:
-        temp_path = None
+    spill = False
+    if UPLOAD_SPILL_THRESHOLD:
         try:
-            # Save to temp file
-            filename = secure_filename(f.filename)
-            with tempfile.NamedTemporaryFile(delete=False, suffix=os.path.splitext(filename)[1]) as temp_file:
-                temp_path = temp_file.name
-                f.save(temp_path)
-            
-            # Extract data from temp file path
-            data = extract_fn(temp_path, None, api_key)
-            results.append({'success': True, 'data': data, 'filename': f.filename})
-        except Exception as e:
-            results.append({'success': False, 'error': str(e), 'filename': f.filename})
-        finally:
-            # Clean up temp file
-            if temp_path:
+            stream.seek(0, os.SEEK_END)
+            spill = stream.tell() > UPLOAD_SPILL_THRESHOLD
+            stream.seek(0)
+        except (AttributeError, OSError):
+            spill = False
+    
+    if not spill:
+        with stage('upload_read'):
+            data = stream.read()
+        with stage('hash'):
+            hasher.update(data)
+        return data, hasher.hexdigest(), None
+    
+    started = time.perf_counter()
+    hash_seconds = 0.0
+    filename = secure_filename(file.filename or '')
+    with tempfile.NamedTemporaryFile(delete=False, suffix=os.path.splitext(filename)[1]) as temp_file:
+        temp_path = temp_file.name
+        while True:
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                break
+            hash_started = time.perf_counter()
+            hasher.update(chunk)
+            hash_seconds += time.perf_counter() - hash_started
+            temp_file.write(chunk)
+    record_stage('hash', hash_seconds)
+    record_stage('upload_read', time.perf_counter() - started - hash_seconds)
+    return temp_path, hasher.hexdigest(), temp_path
+
+
+def plan_packs(sizes, max_files, max_bytes):
+    """
+    Greedily group item indices into packs bounded by file count and total bytes.
+    
+    Args:
+        sizes (dict): index -> size in bytes for items eligible for packing
+        max_files (int): Max items per pack
+        max_bytes (int): Max total bytes per pack
+    
+    Returns:
+        list: Lists of indices; only packs with two or more items are returned
+    """
+    packs = []
+    current, current_bytes = [], 0
+    for index, size in sizes.items():
+        if current and (len(current) >= max_files or current_bytes + size > max_bytes):
+            packs.append(current)
+            current, current_bytes = [], 0
+        current.append(index)
+        current_bytes += size
+    if current:
+        packs.append(current)
+    return [pack for pack in packs if len(pack) > 1]
+
+
+def process_batch(files, api_key, extract_fn, max_workers=3, client=None, pack=False, backend=None):
+    results = [None] * len(files)
+    uploads = [None] * len(files)
+    try:
+        # Read uploads straight from the request stream (temp file only if spilled)
+        for i, f in enumerate(files):
+            try:
+                source, file_hash, temp_path = read_upload(f)
+                uploads[i] = (source, temp_path, guess_mime_type(f.filename), file_hash)
+            except Exception as e:
+                results[i] = {'success': False, 'error': str(e), 'filename': f.filename}
+        
+        # Pack small in-memory images into shared Gemini calls
+        if pack and (backend is None or backend.name == 'gemini'):
+            sizes = {
+                i: len(upload[0]) for i, upload in enumerate(uploads)
+                if upload and upload[1] is None and upload[2].startswith('image/')
+                and len(upload[0]) <= PACK_MAX_FILE_BYTES
+            }
+            for group in plan_packs(sizes, PACK_MAX_FILES, PACK_MAX_BYTES):
+                packed = extract_packed_invoices([(uploads[i][0], uploads[i][2]) for i in group], client=client)
+                for i, data in zip(group, packed):
+                    if data is not None:
+                        results[i] = {'success': True, 'data': data, 'filename': files[i].filename,
+                                      'file_hash': uploads[i][3]}
+        
+        # Everything else (and packed images missing from a response) goes one file per call
+        for i, f in enumerate(files):
+            if results[i] is not None:
+                continue
+            try:
+                source, _, mime_type, file_hash = uploads[i]
+                kwargs = {'mime_type': mime_type}
+                if backend is not None:
+                    kwargs['backend'] = backend
+                elif client is not None:
+                    kwargs['client'] = client
+                data = extract_fn(source, None, api_key, **kwargs)
+                results[i] = {'success': True, 'data': data, 'filename': f.filename, 'file_hash': file_hash}
+            except Exception as e:
+                results[i] = {'success': False, 'error': str(e), 'filename': f.filename}
+    finally:
+        # Clean up spilled temp files
+        for upload in uploads:
+            if upload and upload[1]:
                 try:
-                    os.unlink(temp_path)
+                    os.unlink(upload[1])
                 except:
                     pass
     return {'results': results}
@@ -474,8 +1488,15 @@ GITHUB_CLIENT_SECRET = os.environ.get('GITHUB_CLIENT_SECRET')
 # Vercel sets VERCEL_URL to deployment-specific URLs which change on every deploy
 VERCEL_URL = 'https://ai-invoice-automation-one.vercel.app'
 
+# Shared pooled Gemini client for all extraction endpoints
+gemini_client = get_gemini_client()
+if os.environ.get('GEMINI_WARMUP', 'false').lower() == 'true':
+    gemini_client.warm_up()
+extraction_backend = get_extraction_backend()
+extraction_cache = get_extraction_cache()
+
 # Initialize database
-db = InvoiceDatabase()
+db = InvoiceDatabase(near_duplicate_distance=get_near_duplicate_settings())
 export_manager = ExportManager()
 user_manager = UserManager(db) if USER_MANAGEMENT_ENABLED and UserManager else None
 
@@ -485,8 +1506,17 @@ def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
 
+def wants_debug_timings():
+    """Whether the current request should get the stage timing breakdown."""
+    flag = request.args.get('debug') or request.form.get('debug')
+    if flag is None:
+        return DEBUG_TIMINGS
+    return flag.lower() == 'true'
+
+
 @app.route('/api/v2/process', methods=['POST'])
 @optional_auth
+@collect_stage_timings
 def process_invoice_v2():
     """
     POST /api/v2/process - Process invoice with database storage
@@ -498,6 +1528,7 @@ def process_invoice_v2():
         - file: Invoice image/PDF
         - save: Whether to save to database (default: true)
         - user_id: User identifier (optional, overrides auth)
+        - debug: Include per-stage timings in the response (default: DEBUG_TIMINGS)
     
     Returns:
         JSON with extracted data and invoice ID if saved
@@ -517,84 +1548,224 @@ def process_invoice_v2():
         }), 400
     
     try:
-        # Read file data for duplicate detection
-        file_data = file.read()
-        file.seek(0)  # Reset file pointer
+        # Read upload once for both duplicate detection and extraction
+        source, file_hash, temp_path = read_upload(file)
+        
+        mime_type = guess_mime_type(file.filename)
         
-        # Check for duplicates
-        file_hash = db.calculate_file_hash(file_data)
-        duplicate = db.check_duplicate(file_hash)
+        # Check for duplicates (exact bytes, then the same image re-encoded)
+        with stage('duplicate_check'):
+            duplicate, image_fingerprint = find_duplicate(source, file_hash, mime_type, upload_owner(),
+                                                          should_save_upload())
         
         if duplicate:
-            return jsonify({
-                'success': True,
-                'duplicate': True,
-                'message': 'This invoice has already been processed',
-                'invoice_id': duplicate['id'],
-                'original_data': duplicate
-            }), 200
-        
-        # Save to temp file and process
-        filename = secure_filename(file.filename)
-        with tempfile.NamedTemporaryFile(delete=False, suffix=os.path.splitext(filename)[1]) as temp_file:
-            temp_path = temp_file.name
-            file.save(temp_path)
+            if temp_path:
+                os.unlink(temp_path)
+            body = duplicate_response(*duplicate)
+            if wants_debug_timings():
+                body['timings'] = current_timings().as_dict()
+            return jsonify(body), 200
         
         # Extract invoice data
-        result = extract_invoice_data(temp_path, None, OCR_API_KEY)
-        
-        # Clean up temp file
         try:
-            os.unlink(temp_path)
-        except:
-            pass
-        
-        if 'error' in result:
-            return jsonify({
-                'success': False,
-                'error': result['error']
-            }), 500
-        
-        # Get user ID from auth or request
-        user_id = getattr(request, 'user_id', None)
-        if not user_id:
-            user_id = request.form.get('user_id', 'anonymous')
-        
-        # Save to database if requested (default: FALSE for single, only save if explicitly requested)
-        should_save = request.form.get('save', 'false').lower() == 'true'
-        invoice_id = None
-        
-        if should_save:
-            # If saving from single page, mark as 'single' upload type
-            upload_type = request.form.get('upload_type', 'single')
-            invoice_id = db.save_invoice(result, user_id, file_hash, upload_type=upload_type)
-        
-        # Determine extraction method
-        ai_used = result.get('_ai_used', False)
-        extraction_method = result.get('_method', 'ai' if ai_used else 'regex')
+            result = extract_invoice_data(source, None, OCR_API_KEY, backend=extraction_backend,
+                                          mime_type=mime_type)
+        finally:
+            # Clean up spilled temp file
+            if temp_path:
+                try:
+                    os.unlink(temp_path)
+                except:
+                    pass
         
+        body, status = build_process_response(result, file_hash, image_fingerprint)
+        if wants_debug_timings():
+            body['timings'] = current_timings().as_dict()
+        return jsonify(body), status
+    
+    except Exception as e:
         return jsonify({
-            'success': True,
-            'duplicate': False,
-            'extraction_method': extraction_method,
-            'invoice_id': invoice_id,
-            'data': {
-                'vendor': result['vendor'],
-                'date': result['date'],
-                'total': result['total'],
-                'invoice_number': result.get('invoice_number'),
-                'tax': result.get('tax'),
-                'subtotal': result.get('subtotal'),
-                'summary': result.get('summary'),
-                'line_items': result.get('line_items', [])
-            }
-        }), 200
+            'success': False,
+            'error': str(e)
+        }), 500
+
+
+def upload_owner():
+    """User an upload belongs to: the authenticated user, else the form's user_id ('anonymous')."""
+    return getattr(request, 'user_id', None) or request.form.get('user_id', 'anonymous')
+
+
+def should_save_upload():
+    """Whether the process endpoints store the result (form field save, default false)."""
+    return request.form.get('save', 'false').lower() == 'true'
+
+
+def find_duplicate(source, file_hash, mime_type, user_id, save):
+    """
+    Look for a copy of an upload that this user already processed.
+    
+    An exact file hash match wins. When the result will be saved, images
+    are also matched perceptually, so a JPEG/PNG re-save of the same
+    invoice is caught too; without saving, the upload is always extracted.
+    
+    Args:
+        source: Upload bytes or temp file path (from read_upload)
+        file_hash (str): MD5 of the upload
+        mime_type (str): Mime type of the upload
+        user_id (str): Uploader; other users' invoices are never matched
+        save (bool): Whether the extraction result will be stored
+    
+    Returns:
+        tuple: ((invoice, match, distance) or None, fingerprint) - match is
+               'exact' or 'near'; fingerprint is None unless an image is being saved
+    """
+    invoice = db.check_duplicate(file_hash, user_id)
+    if invoice:
+        return (invoice, 'exact', 0), None
+    
+    image_fingerprint = None
+    if save and mime_type.startswith('image/'):
+        image_fingerprint = db.calculate_fingerprint(source)
+        near = db.find_near_duplicate(image_fingerprint, user_id)
+        if near:
+            return (near[0], 'near', near[1]), image_fingerprint
+    return None, image_fingerprint
+
+
+def duplicate_response(invoice, match, distance):
+    """Build the response body for an upload that matched a stored invoice."""
+    return {
+        'success': True,
+        'duplicate': True,
+        'match': match,
+        'distance': distance,
+        'message': 'This invoice has already been processed',
+        'invoice_id': invoice['id'],
+        'original_data': invoice
+    }
+
+
+def build_process_response(result, file_hash, image_fingerprint=None):
+    """
+    Save an extraction result if requested and build the /api/v2/process response body.
+    
+    Shared by the regular and streaming process endpoints; reads user_id,
+    save and upload_type from the current request.
+    
+    Returns:
+        tuple: (response dict, HTTP status)
+    """
+    if 'error' in result:
+        return {
+            'success': False,
+            'error': result['error']
+        }, 500
+    
+    # Get user ID from auth or request
+    user_id = upload_owner()
+    
+    # Save to database if requested (default: FALSE for single, only save if explicitly requested)
+    invoice_id = None
+    
+    if should_save_upload():
+        # If saving from single page, mark as 'single' upload type
+        upload_type = request.form.get('upload_type', 'single')
+        with stage('db_save'):
+            invoice_id = db.save_invoice(result, user_id, file_hash, upload_type=upload_type,
+                                         image_fingerprint=image_fingerprint)
+    
+    # Determine extraction method
+    ai_used = result.get('_ai_used', False)
+    extraction_method = result.get('_method', 'ai' if ai_used else 'regex')
+    
+    return {
+        'success': True,
+        'duplicate': False,
+        'extraction_method': extraction_method,
+        'invoice_id': invoice_id,
+        'usage': result.get('_usage'),
+        'data': {
+            'vendor': result['vendor'],
+            'date': result['date'],
+            'total': result['total'],
+            'invoice_number': result.get('invoice_number'),
+            'tax': result.get('tax'),
+            'subtotal': result.get('subtotal'),
+            'summary': result.get('summary'),
+            'line_items': result.get('line_items', [])
+        }
+    }, 200
+
+
+def sse_event(event, data):
+    """Format one server-sent event with a JSON payload."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+@app.route('/api/v2/process/stream', methods=['POST'])
+@optional_auth
+def process_invoice_v2_stream():
+    """
+    POST /api/v2/process/stream - Process invoice, streaming fields as they are extracted
+    
+    Same body as /api/v2/process. Responds with text/event-stream:
+        - event: field   data: {"field": ..., "value": ...} as each field completes
+        - event: result  data: the exact /api/v2/process response body, plus "status"
+    
+    Returns:
+        Server-sent event stream
+    """
+    if 'file' not in request.files:
+        return jsonify({'error': 'No file provided'}), 400
+    
+    file = request.files['file']
+    
+    if file.filename == '':
+        return jsonify({'error': 'Empty filename'}), 400
+    
+    if not allowed_file(file.filename):
+        return jsonify({
+            'error': 'Invalid file type',
+            'allowed': list(ALLOWED_EXTENSIONS)
+        }), 400
     
+    try:
+        source, file_hash, temp_path = read_upload(file)
     except Exception as e:
         return jsonify({
             'success': False,
             'error': str(e)
         }), 500
+    mime_type = guess_mime_type(file.filename)
+    
+    def generate():
+        try:
+            duplicate, image_fingerprint = find_duplicate(source, file_hash, mime_type, upload_owner(),
+                                                          should_save_upload())
+            if duplicate:
+                body = duplicate_response(*duplicate)
+                body['status'] = 200
+                yield sse_event('result', body)
+                return
+            
+            for event in extract_invoice_data_stream(source, backend=extraction_backend, mime_type=mime_type):
+                if event['event'] == 'field':
+                    yield sse_event('field', {'field': event['field'], 'value': event['value']})
+                else:
+                    body, status = build_process_response(event['data'], file_hash, image_fingerprint)
+                    body['status'] = status
+                    yield sse_event('result', body)
+        except Exception as e:
+            yield sse_event('result', {'success': False, 'error': str(e), 'status': 500})
+        finally:
+            if temp_path:
+                try:
+                    os.unlink(temp_path)
+                except:
+                    pass
+    
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 
 @app.route('/api/v2/batch', methods=['POST'])
@@ -605,6 +1776,7 @@ def process_batch_invoices():
     
     Body:
         - files[]: Multiple invoice files
+        - pack: Group small images into shared Gemini calls (default: BATCH_PACKING)
     
     Returns:
         JSON with batch processing results
@@ -625,7 +1797,9 @@ def process_batch_invoices():
                 }), 400
         
         # Process batch
-        result = process_batch(files, OCR_API_KEY, extract_invoice_data, max_workers=3)
+        pack = request.form.get('pack', str(BATCH_PACKING)).lower() == 'true'
+        result = process_batch(files, OCR_API_KEY, extract_invoice_data, max_workers=3, client=gemini_client,
+                               pack=pack, backend=extraction_backend)
         
         # Get user ID
         user_id = getattr(request, 'user_id', 'anonymous')
@@ -634,8 +1808,7 @@ def process_batch_invoices():
         for item in result['results']:
             if item['success'] and item.get('data') and not item['data'].get('error'):
                 try:
-                    # Create file hash from filename (as we don't have original file data here)
-                    file_hash = db.calculate_file_hash(item['filename'].encode())
+                    file_hash = item.get('file_hash') or db.calculate_file_hash(item['filename'].encode())
                     invoice_id = db.save_invoice(item['data'], user_id, file_hash, upload_type='batch')
                     item['invoice_id'] = invoice_id
                     item['invoice'] = item['data']  # Add full invoice data for display
@@ -656,6 +1829,24 @@ def process_batch_invoices():
         }), 500
 
 
+def spliced_json_response(data, key, raw, status=200):
+    """
+    JSON response with already-serialized JSON spliced in under `key`.
+    
+    Args:
+        data (dict): Other top-level fields, encoded as usual (must not be empty)
+        key (str): Field to hold the raw JSON
+        raw: One JSON text, or a list of them to send as an array
+        status (int): HTTP status
+    
+    Returns:
+        Response: application/json response
+    """
+    value = raw if isinstance(raw, str) else '[' + ','.join(raw) + ']'
+    body = json.dumps(data, separators=(',', ':'))
+    return app.response_class(f'{body[:-1]},{json.dumps(key)}:{value}}}', status=status, mimetype='application/json')
+
+
 @app.route('/api/v2/invoices', methods=['GET'])
 @optional_auth
 def list_invoices():
@@ -666,29 +1857,91 @@ def list_invoices():
         - status: Filter by status
         - upload_type: Filter by upload type (single/batch)
         - limit: Max results (default: 50)
-        - offset: Pagination offset (default: 0)
-        - search: Search query
+        - cursor: next_cursor from the previous page
+        - offset: Pagination offset (default: 0; kept for old clients, ignored with cursor)
+        - search: Full-text search (vendor, invoice number, summary, line items); results are
+          ranked best first and include a highlighted 'snippet'
+        - fields: Comma-separated columns to return, e.g. "vendor,total,status" (default: all;
+          id and created_at are always included, line_items only when listed)
     
     Returns:
-        JSON with list of invoices
+        JSON with list of invoices and next_cursor (null on the last page)
     """
     user_id = getattr(request, 'user_id', None)
     status = request.args.get('status')
     upload_type = request.args.get('upload_type')
     limit = int(request.args.get('limit', 50))
     offset = int(request.args.get('offset', 0))
+    after = request.args.get('cursor')
     search = request.args.get('search')
+    fields = parse_fields(request.args.get('fields'))
     
     try:
-        if search:
-            invoices = db.search_invoices(search, user_id)
-        else:
-            invoices = db.list_invoices(user_id, status, upload_type, limit, offset)
+        next_cursor = None
+        if db.payloads_enabled and not search and not fields:
+            # Full rows: send the stored payloads as-is rather than decoding and re-encoding them
+            try:
+                rows = db.list_invoice_payloads(user_id, status, upload_type, limit, offset, after=after)
+            except ValueError as e:
+                return jsonify({'success': False, 'error': str(e)}), 400
+            if rows and len(rows) == limit:
+                next_cursor = encode_cursor(rows[-1]['created_at'], rows[-1]['id'])
+            return spliced_json_response({
+                'success': True,
+                'count': len(rows),
+                'next_cursor': next_cursor
+            }, 'invoices', [row['payload_json'] for row in rows])
+        
+        try:
+            if search:
+                invoices = db.search_invoices(search, user_id, limit, after=after, fields=fields)
+            else:
+                invoices = db.list_invoices(user_id, status, upload_type, limit, offset, after=after,
+                                            fields=fields)
+        except ValueError as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
+        if invoices and len(invoices) == limit:
+            last = invoices[-1]
+            if search and 'rank' in last:
+                next_cursor = encode_cursor(last['rank'], last['id'])
+            elif not search:
+                next_cursor = encode_cursor(last['created_at'], last['id'])
         
         return jsonify({
             'success': True,
             'count': len(invoices),
-            'invoices': invoices
+            'invoices': invoices,
+            'next_cursor': next_cursor
+        }), 200
+    
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+
+@app.route('/api/v2/invoices/count', methods=['GET'])
+@optional_auth
+def count_invoices():
+    """
+    GET /api/v2/invoices/count - Count invoices without fetching them
+    
+    Query params:
+        - status: Filter by status
+        - upload_type: Filter by upload type (single/batch)
+    
+    Returns:
+        JSON with count
+    """
+    user_id = getattr(request, 'user_id', None)
+    
+    try:
+        count = db.count_invoices(user_id, request.args.get('status'), request.args.get('upload_type'))
+        
+        return jsonify({
+            'success': True,
+            'count': count
         }), 200
     
     except Exception as e:
@@ -704,11 +1957,24 @@ def get_invoice(invoice_id):
     """
     GET /api/v2/invoices/:id - Get invoice details
     
+    Query params:
+        - fields: Comma-separated columns to return (default: all)
+    
     Returns:
         JSON with invoice data including line items
     """
     try:
-        invoice = db.get_invoice(invoice_id)
+        fields = parse_fields(request.args.get('fields'))
+        if db.payloads_enabled and not fields:
+            payload = db.get_invoice_payload(invoice_id)
+            if payload:
+                return spliced_json_response({'success': True}, 'invoice', payload)
+            invoice = None
+        else:
+            try:
+                invoice = db.get_invoice(invoice_id, fields=fields)
+            except ValueError as e:
+                return jsonify({'success': False, 'error': str(e)}), 400
         
         if not invoice:
             return jsonify({
@@ -970,12 +2236,17 @@ def health_check_v2():
             'batch_processing': True,
             'analytics': True,
             'export': True,
-            'duplicate_detection': True
+            'duplicate_detection': True,
+            'near_duplicate_detection': db.near_duplicate_distance is not None
         },
         'api': {
             'gemini_configured': bool(gemini_key),
             'ocr_configured': bool(ocr_key)
         },
+        'extraction_backend': extraction_backend.state(),
+        'extraction_cache': extraction_cache.stats() if extraction_cache else None,
+        'rate_limiter': gemini_client.rate_limiter.state() if gemini_client.rate_limiter else None,
+        'gemini_resilience': gemini_client.resilience_state(),
         'oauth': {
             'google_enabled': bool(google_id and google_secret),
             'github_enabled': bool(github_id and github_secret),
@@ -1008,35 +2279,12 @@ def reset_database():
     try:
         upload_type = request.args.get('upload_type')
         user_id = getattr(request, 'user_id', None)
-        conn = db.get_connection()
-        cursor = conn.cursor()
-        
+        # Clear invoices of the specified type (or all types) for this user (or all if no user_id)
+        deleted = db.clear_all(user_id=user_id, upload_type=upload_type)
         if upload_type:
-            # Clear only invoices of specified type for this user
-            if user_id:
-                cursor.execute('SELECT id FROM invoices WHERE upload_type = ? AND user_id = ?', (upload_type, user_id))
-            else:
-                cursor.execute('SELECT id FROM invoices WHERE upload_type = ?', (upload_type,))
-            
-            invoice_ids = [row[0] for row in cursor.fetchall()]
-            
-            if invoice_ids:
-                placeholders = ','.join('?' * len(invoice_ids))
-                cursor.execute(f'DELETE FROM invoices WHERE id IN ({placeholders})', invoice_ids)
-            
-            message = f'{len(invoice_ids)} {upload_type} invoices cleared successfully'
+            message = f'{deleted} {upload_type} invoices cleared successfully'
         else:
-            # Clear all invoices for this user (or all if no user_id)
-            if user_id:
-                cursor.execute('DELETE FROM invoices WHERE user_id = ?', (user_id,))
-                deleted = cursor.rowcount
-                message = f'{deleted} invoices cleared successfully'
-            else:
-                cursor.execute('DELETE FROM invoices')
-                deleted = cursor.rowcount
-                message = f'{deleted} invoices cleared successfully'
-        
-        conn.commit()
+            message = f'{deleted} invoices cleared successfully'
         
         return jsonify({
             'success': True,
@@ -1816,10 +3064,12 @@ def send_email_report():
         
         # Get user's invoices - filtered by upload_type if provided
         invoices = db.list_invoices(user_id=user_id, upload_type=upload_type, limit=100) if user_id else []
+        report_user_id = user_id
         
         # If no invoices found with user_id, try using email as user_id (for OAuth users)
         if (not invoices or len(invoices) == 0) and recipient_email:
             invoices = db.list_invoices(user_id=recipient_email, upload_type=upload_type, limit=100)
+            report_user_id = recipient_email
         
         # If still no invoices, get all invoices of the specified type (for demo/testing)
         if not invoices or len(invoices) == 0:
@@ -1833,6 +3083,7 @@ def send_email_report():
             else:
                 # Use all invoices for the report
                 invoices = all_invoices
+                report_user_id = None
         
         # Use user manager if available AND user_id is numeric, otherwise send basic email
         if USER_MANAGEMENT_ENABLED and user_manager and user_id and str(user_id).isdigit():
@@ -1843,58 +3094,18 @@ def send_email_report():
             from email.mime.text import MIMEText
             import smtplib
             
-            # Currency conversion rates (approximate)
-            currency_rates = {
-                'INR': 0.012,  # INR to USD
-                'EUR': 1.09,   # EUR to USD
-                'GBP': 1.27,   # GBP to USD
-                'USD': 1.0,    # USD to USD
-            }
-            
-            # Calculate statistics
+            # Calculate statistics (amounts are parsed at save time and summed in SQL via fx_rates)
             from datetime import datetime
-            from collections import Counter
-            
-            total = len(invoices)
-            total_amount = 0
-            vendors = []
-            recent_invoices = []
             
-            for inv in invoices:
-                vendors.append(inv.get('vendor', inv.get('vendor_name', 'Unknown')))
-                
-                if inv.get('total'):
-                    try:
-                        # Detect currency and convert to USD
-                        amount_str = str(inv.get('total', '0'))
-                        currency = 'USD'  # Default
-                        
-                        # Detect currency
-                        if 'INR' in amount_str or '₹' in amount_str:
-                            currency = 'INR'
-                        elif 'EUR' in amount_str or '€' in amount_str:
-                            currency = 'EUR'
-                        elif 'GBP' in amount_str or '£' in amount_str:
-                            currency = 'GBP'
-                        
-                        # Remove all currency symbols and codes
-                        amount_str = amount_str.replace('$', '').replace('₹', '').replace('€', '').replace('£', '')
-                        amount_str = amount_str.replace('INR', '').replace('USD', '').replace('EUR', '').replace('GBP', '')
-                        amount_str = amount_str.replace(',', '').strip()
-                        
-                        # Convert to USD
-                        amount = float(amount_str)
-                        total_amount += amount * currency_rates.get(currency, 1.0)
-                    except (ValueError, AttributeError):
-                        # Skip if can't parse
-                        pass
+            summary = db.get_amount_summary(user_id=report_user_id, upload_type=upload_type)
+            total = summary['invoices']
+            total_amount = summary['total']
             
             # Get top 5 recent invoices
             recent_invoices = invoices[:5] if len(invoices) >= 5 else invoices
             
             # Get vendor breakdown
-            vendor_counts = Counter(vendors)
-            top_vendors = vendor_counts.most_common(5)
+            top_vendors = summary['top_vendors']
             
             # Build vendor breakdown HTML
             vendor_html = ''
@@ -1906,13 +3117,13 @@ def send_email_report():
             for inv in recent_invoices:
                 inv_num = inv.get('invoice_number', 'N/A')
                 vendor = inv.get('vendor', inv.get('vendor_name', 'N/A'))
-                total = inv.get('total', 'N/A')
+                amount = inv.get('total', 'N/A')
                 date = inv.get('date', 'N/A')
-                recent_html += f'<tr><td style="padding: 10px; border-bottom: 1px solid #eee;">{inv_num}</td><td style="padding: 10px; border-bottom: 1px solid #eee;">{vendor}</td><td style="padding: 10px; border-bottom: 1px solid #eee;">{date}</td><td style="padding: 10px; border-bottom: 1px solid #eee; text-align: right; font-weight: bold;">{total}</td></tr>'
+                recent_html += f'<tr><td style="padding: 10px; border-bottom: 1px solid #eee;">{inv_num}</td><td style="padding: 10px; border-bottom: 1px solid #eee;">{vendor}</td><td style="padding: 10px; border-bottom: 1px solid #eee;">{date}</td><td style="padding: 10px; border-bottom: 1px solid #eee; text-align: right; font-weight: bold;">{amount}</td></tr>'
             
             # Create email
             msg = MIMEMultipart('alternative')
-            msg['Subject'] = f'Invoice Report - {total} Invoices (${total_amount:,.2f})'
+            msg['Subject'] = f'Invoice Report - {total} Invoices ({total_amount:,.2f} {REPORT_CURRENCY})'
             msg['From'] = smtp_user
             msg['To'] = recipient_email
             
@@ -1950,8 +3161,8 @@ def send_email_report():
                                     <div class="stat-value">{total}</div>
                                 </div>
                                 <div class="stat-box">
-                                    <div class="stat-label">Total Amount (USD)</div>
-                                    <div class="stat-value">${total_amount:,.2f}</div>
+                                    <div class="stat-label">Total Amount ({REPORT_CURRENCY})</div>
+                                    <div class="stat-value">{total_amount:,.2f}</div>
                                 </div>
                             </div>
                             
@@ -2020,6 +3231,13 @@ def internal_error(error):
     }), 500
 
 
+@app.cli.command('rebuild-rollups')
+def rebuild_rollups_command():
+    """Recompute analytics rollups from the invoices table (flask --app api/index.py rebuild-rollups)."""
+    for table, buckets in db.rebuild_rollups().items():
+        print(f"{table}: {buckets} buckets")
+
+
 # For Vercel serverless deployment
 if __name__ == '__main__':
     app.run(debug=True, host='0.0.0.0', port=5000)
@@ -4,43 +4,878 @@ Extracts invoice data directly from images using Gemini Vision API.
 """
 
 import os
+import io
+import re
+import time
+import asyncio
+import logging
+import threading
 import requests
 import json
 import base64
+from requests.adapters import HTTPAdapter
+from extraction_cache import ExtractionCache, get_extraction_cache
+from amounts import normalize_amounts
+from rate_limiter import get_rate_limiter, parse_retry_after
+from resilience import LatencyHistogram, get_resilience_settings
+from timing import stage, submit_in_context
 
 
-def extract_invoice_data(image_path, known_vendors=None, ocr_api_key=None):
+logger = logging.getLogger(__name__)
+
+
+# Point GEMINI_BASE_URL at api/gemini_stub.py to run without quota or network
+GEMINI_MODEL = os.environ.get('GEMINI_MODEL', "gemini-2.0-flash")
+GEMINI_BASE_URL = os.environ.get('GEMINI_BASE_URL', "https://generativelanguage.googleapis.com/v1")
+
+# Bump PROMPT_VERSION whenever EXTRACTION_PROMPT changes so cached results are not reused
+PROMPT_VERSION = 1
+EXTRACTION_PROMPT = """Analyze this invoice image and extract all relevant information. Return ONLY valid JSON in this exact format:
+
+{
+  "vendor": "company/vendor name",
+  "invoice_number": "invoice or receipt number",
+  "date": "date in YYYY-MM-DD format",
+  "subtotal": "subtotal amount with currency symbol",
+  "tax": "tax amount with currency symbol",
+  "total": "total amount with currency symbol",
+  "summary": "brief 1-sentence summary of what this invoice is for",
+  "line_items": [
+    {"description": "item/service description", "quantity": "quantity", "price": "unit price with currency"}
+  ]
+}
+
+Important:
+- Return null for any field you cannot find
+- Keep currency symbols with amounts (e.g., "$150.00", "€45.50")
+- Format dates as YYYY-MM-DD
+- Extract ALL line items you can see
+- Be precise and accurate"""
+
+
+# Structured-output mode: the response shape is enforced with responseMimeType +
+# responseSchema, so the prompt no longer carries a JSON template
+STRUCTURED_OUTPUT = os.environ.get('GEMINI_STRUCTURED_OUTPUT', 'false').lower() == 'true'
+STRUCTURED_PROMPT_VERSION = 1
+
+STRUCTURED_EXTRACTION_PROMPT = """Analyze this invoice image and extract all relevant information.
+
+Important:
+- Use null for any field you cannot find
+- Keep currency symbols with amounts (e.g., "$150.00", "€45.50")
+- Format dates as YYYY-MM-DD
+- Summary is a brief 1-sentence description of what this invoice is for
+- Extract ALL line items you can see
+- Be precise and accurate"""
+
+# Same instructions for invoices sent as their extracted PDF text layer instead of a file
+TEXT_PROMPT_VERSION = 1
+TEXT_EXTRACTION_PROMPT = EXTRACTION_PROMPT.replace("Analyze this invoice image", "Analyze the invoice text below", 1)
+STRUCTURED_TEXT_EXTRACTION_PROMPT = STRUCTURED_EXTRACTION_PROMPT.replace(
+    "Analyze this invoice image", "Analyze the invoice text below", 1)
+
+INVOICE_RESPONSE_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "vendor": {"type": "STRING", "nullable": True},
+        "invoice_number": {"type": "STRING", "nullable": True},
+        "date": {"type": "STRING", "nullable": True},
+        "subtotal": {"type": "STRING", "nullable": True},
+        "tax": {"type": "STRING", "nullable": True},
+        "total": {"type": "STRING", "nullable": True},
+        "summary": {"type": "STRING", "nullable": True},
+        "line_items": {
+            "type": "ARRAY",
+            "items": {
+                "type": "OBJECT",
+                "properties": {
+                    "description": {"type": "STRING", "nullable": True},
+                    "quantity": {"type": "STRING", "nullable": True},
+                    "price": {"type": "STRING", "nullable": True}
+                }
+            }
+        }
+    },
+    "required": ["vendor", "date", "total", "line_items"]
+}
+
+
+# Prompt for packed multi-invoice requests; images are numbered in the order they are attached.
+# Packed results are cached under their own version so they never stand in for single-file results.
+PACKED_PROMPT_VERSION = 1
+PACKED_EXTRACTION_PROMPT = """You are given several separate invoice or receipt images, numbered from 0 in the order they appear. Extract each image independently. Return ONLY a valid JSON array with exactly one object per image, in this exact format:
+
+[
+  {
+    "index": 0,
+    "vendor": "company/vendor name",
+    "invoice_number": "invoice or receipt number",
+    "date": "date in YYYY-MM-DD format",
+    "subtotal": "subtotal amount with currency symbol",
+    "tax": "tax amount with currency symbol",
+    "total": "total amount with currency symbol",
+    "summary": "brief 1-sentence summary of what this invoice is for",
+    "line_items": [
+      {"description": "item/service description", "quantity": "quantity", "price": "unit price with currency"}
+    ]
+  }
+]
+
+Important:
+- "index" must be the image's number
+- Never mix data from different images
+- Return null for any field you cannot find
+- Keep currency symbols with amounts (e.g., "$150.00", "€45.50")
+- Format dates as YYYY-MM-DD
+- Extract ALL line items you can see
+- Be precise and accurate"""
+
+
+class StreamingJSONBody:
+    """
+    File-like JSON request body that base64-encodes binary fields lazily.
+    
+    Any bytes/bytearray/memoryview value in the payload is emitted as a base64
+    JSON string, encoded chunk by chunk while requests streams the body to the
+    socket. Only the raw file plus one small chunk is ever held in memory,
+    instead of the raw bytes, the base64 str, the payload dict and the
+    serialized JSON body all at once. The exact length is known up front so
+    the request is sent with a Content-Length rather than chunked encoding.
+    """
+    
+    # Raw bytes per encoded chunk; a multiple of 3 so chunks concatenate into valid base64
+    CHUNK_SIZE = 48 * 1024
+    
+    def __init__(self, payload):
+        """
+        Args:
+            payload (dict): generateContent payload with raw bytes in place of base64 strings
+        """
+        self._blobs = []
+        template = json.dumps(self._extract_blobs(payload)).encode('utf-8')
+        
+        # Split the serialized template around each blob marker
+        self._segments = []
+        for index, blob in enumerate(self._blobs):
+            before, template = template.split(self._marker(index).encode('utf-8'), 1)
+            self._segments.append(before)
+        self._segments.append(template)
+        
+        self._length = sum(len(segment) for segment in self._segments)
+        self._length += sum(4 * ((len(blob) + 2) // 3) for blob in self._blobs)
+        self.seek(0)
+    
+    @staticmethod
+    def _marker(index):
+        return f"@@inline-blob-{index}@@"
+    
+    def _extract_blobs(self, value):
+        """Copy the payload structure, replacing binary values with markers."""
+        if isinstance(value, (bytes, bytearray, memoryview)):
+            self._blobs.append(memoryview(value).cast('B'))
+            return self._marker(len(self._blobs) - 1)
+        if isinstance(value, dict):
+            return {key: self._extract_blobs(item) for key, item in value.items()}
+        if isinstance(value, (list, tuple)):
+            return [self._extract_blobs(item) for item in value]
+        return value
+    
+    def _iter_chunks(self):
+        for index, blob in enumerate(self._blobs):
+            yield self._segments[index]
+            for start in range(0, len(blob), self.CHUNK_SIZE):
+                yield base64.b64encode(blob[start:start + self.CHUNK_SIZE])
+        yield self._segments[-1]
+    
+    def __len__(self):
+        return self._length
+    
+    def __iter__(self):
+        return self._iter_chunks()
+    
+    def tell(self):
+        return self._position
+    
+    def seek(self, offset, whence=0):
+        """Rewind the body so it can be resent; only seeking to the start is supported."""
+        if offset != 0 or whence != 0:
+            raise OSError("StreamingJSONBody only supports seek(0)")
+        self._chunks = self._iter_chunks()
+        self._buffer = bytearray()
+        self._position = 0
+        return 0
+    
+    def read(self, size=-1):
+        """Read up to size bytes of the serialized body."""
+        while size is None or size < 0 or len(self._buffer) < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self._buffer += chunk
+        
+        if size is None or size < 0:
+            size = len(self._buffer)
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        self._position += len(data)
+        return data
+    
+    def copy(self):
+        """Return an independent reader over the same payload (blobs are shared, not copied)."""
+        clone = StreamingJSONBody.__new__(StreamingJSONBody)
+        clone._blobs = self._blobs
+        clone._segments = self._segments
+        clone._length = self._length
+        clone.seek(0)
+        return clone
+
+
+class GeminiClientBase:
+    """
+    Configuration and URLs shared by the sync and async Gemini clients.
+    
+    Subclasses add the HTTP transport and the request/retry loop.
+    """
+    
+    # Max connections to the API host when pool_size is not given
+    DEFAULT_POOL_SIZE = 10
+    
+    def __init__(self, api_key=None, model=GEMINI_MODEL, base_url=GEMINI_BASE_URL,
+                 pool_size=None, connect_timeout=5, read_timeout=30, rate_limiter=None,
+                 hedging=None, circuit_breaker=None, latency=None):
+        """
+        Args:
+            api_key (str, optional): Gemini API key (default: GEMINI_API_KEY env var)
+            model (str): Gemini model name
+            base_url (str): API base URL
+            pool_size (int, optional): Max connections to the API host (default: DEFAULT_POOL_SIZE)
+            connect_timeout (float): Seconds to wait for a connection
+            read_timeout (float): Seconds to wait for the response
+            rate_limiter (GeminiRateLimiter, optional): Shared limiter and retry policy (None sends directly)
+            hedging (HedgingPolicy, optional): Fire a duplicate request for slow calls (None disables)
+            circuit_breaker (CircuitBreaker, optional): Fail fast while upstream is erroring (None disables)
+            latency (LatencyHistogram, optional): Per-attempt latency recorder (default: hedging's histogram)
+        """
+        self.api_key = api_key if api_key is not None else os.environ.get('GEMINI_API_KEY')
+        self.model = model
+        self.base_url = base_url.rstrip('/')
+        self.pool_size = pool_size or self.DEFAULT_POOL_SIZE
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.rate_limiter = rate_limiter
+        self.hedging = hedging
+        self.circuit_breaker = circuit_breaker
+        self.latency = latency or (hedging.histogram if hedging else LatencyHistogram())
+    
+    def generate_content_url(self, api_key=None):
+        """Build the generateContent URL for the configured model."""
+        key = api_key or self.api_key
+        return f"{self.base_url}/models/{self.model}:generateContent?key={key}"
+    
+    def stream_generate_content_url(self, api_key=None):
+        """Build the server-sent-events streamGenerateContent URL for the configured model."""
+        key = api_key or self.api_key
+        return f"{self.base_url}/models/{self.model}:streamGenerateContent?alt=sse&key={key}"
+
+
+class GeminiVisionClient(GeminiClientBase):
+    """
+    Reusable Gemini API client backed by a pooled keep-alive requests.Session.
+    
+    Reusing one client across invoices means only the first request pays the
+    DNS + TCP + TLS handshake; later requests reuse a pooled connection.
+    Takes the GeminiClientBase arguments; pool_size bounds the keep-alive pool.
+    """
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._hedge_executor = None
+        
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+    
+    @property
+    def timeout(self):
+        """(connect, read) timeout tuple passed to requests."""
+        return (self.connect_timeout, self.read_timeout)
+    
+    def generate_content(self, payload, api_key=None):
+        """
+        POST a generateContent payload over the pooled session.
+        
+        With a rate limiter attached, each attempt waits for a token and a
+        concurrency slot, and 429/5xx responses are retried with backoff.
+        With hedging enabled, slow attempts race a duplicate request. While
+        the circuit breaker is open this raises CircuitOpenError without
+        calling the API.
+        
+        Args:
+            payload (dict or StreamingJSONBody): Request payload; dicts are JSON-encoded
+                by requests, StreamingJSONBody is streamed as-is
+            api_key (str, optional): Override the client's API key
+        """
+        url = self.generate_content_url(api_key)
+        breaker = self.circuit_breaker
+        token = breaker.before_request() if breaker is not None else None
+        
+        try:
+            response = self._generate_with_retries(url, payload)
+        except BaseException:
+            # Any error or interruption counts as a failure, so a half-open probe is always released
+            if breaker is not None:
+                breaker.record(False, token)
+            raise
+        if breaker is not None:
+            breaker.record(response.status_code < 500, token)
+        return response
+    
+    def stream_generate_content(self, payload, api_key=None):
+        """
+        POST a streamGenerateContent payload and return the open streaming response.
+        
+        Rate limiting, retries and the circuit breaker apply as for
+        generate_content; hedging does not, since a stream that has started
+        emitting cannot be raced. Read the response with iter_stream_text and
+        close it when done.
+        
+        Args:
+            payload (dict or StreamingJSONBody): Request payload
+            api_key (str, optional): Override the client's API key
+        """
+        url = self.stream_generate_content_url(api_key)
+        breaker = self.circuit_breaker
+        token = breaker.before_request() if breaker is not None else None
+        
+        try:
+            response = self._generate_with_retries(url, payload, stream=True)
+        except BaseException:
+            # Any error or interruption counts as a failure, so a half-open probe is always released
+            if breaker is not None:
+                breaker.record(False, token)
+            raise
+        if breaker is not None:
+            breaker.record(response.status_code < 500, token)
+        return response
+    
+    def _generate_with_retries(self, url, payload, stream=False):
+        limiter = self.rate_limiter
+        attempt = 0
+        while True:
+            if stream:
+                response = self._timed_post(url, payload, stream=True)
+            else:
+                response = self._post_hedged(url, payload)
+            if limiter is None or not limiter.should_retry(response.status_code, attempt):
+                return response
+            response.close()
+            retry_after = parse_retry_after(response.headers.get('Retry-After'))
+            delay = limiter.backoff_delay(attempt, retry_after)
+            logger.warning("Gemini returned %s, retrying in %.1fs", response.status_code, delay)
+            time.sleep(delay)
+            attempt += 1
+    
+    def _post_hedged(self, url, payload):
+        """Send one attempt, racing a duplicate if it outlives the hedging percentile."""
+        from concurrent.futures import wait, FIRST_COMPLETED, ThreadPoolExecutor
+        
+        hedge_after = self.hedging.hedge_delay() if self.hedging else None
+        if hedge_after is None:
+            return self._timed_post(url, payload)
+        
+        if self._hedge_executor is None:
+            self._hedge_executor = ThreadPoolExecutor(max_workers=self.pool_size * 2)
+        primary = submit_in_context(self._hedge_executor, self._timed_post, url, payload)
+        done, _ = wait([primary], timeout=hedge_after)
+        if done:
+            return primary.result()
+        
+        # Only hedge if the rate limiter has spare budget right now
+        limiter = self.rate_limiter
+        if limiter is not None and limiter.try_acquire() > 0:
+            return primary.result()
+        
+        hedge_payload = payload.copy() if isinstance(payload, StreamingJSONBody) else payload
+        hedge = submit_in_context(self._hedge_executor, self._timed_post, url, hedge_payload, True)
+        done, _ = wait([primary, hedge], return_when=FIRST_COMPLETED)
+        winner = hedge if hedge in done and primary not in done else primary
+        loser = primary if winner is hedge else hedge
+        
+        if winner.exception() is not None:
+            winner, loser = loser, winner
+        else:
+            # Free the losing request's connection once it finishes
+            loser.add_done_callback(lambda f: f.exception() is None and f.result().close())
+        self.hedging.record(winner is hedge)
+        return winner.result()
+    
+    def _timed_post(self, url, payload, acquired=False, stream=False):
+        """Send one HTTP attempt through the rate limiter, recording its latency."""
+        limiter = self.rate_limiter
+        if limiter is not None and not acquired:
+            limiter.acquire()
+        started = time.perf_counter()
+        try:
+            response = self._post(url, payload, stream=stream)
+        except BaseException:
+            if limiter is not None:
+                limiter.release(None)
+            raise
+        # Time-to-headers of a stream says nothing about full-call latency
+        if not stream:
+            self.latency.observe(time.perf_counter() - started)
+        if limiter is not None:
+            limiter.release(response.status_code, parse_retry_after(response.headers.get('Retry-After')))
+        return response
+    
+    def _post(self, url, payload, stream=False):
+        if isinstance(payload, StreamingJSONBody):
+            payload.seek(0)
+            return self.session.post(url, data=payload, headers={'Content-Type': 'application/json'},
+                                     timeout=self.timeout, stream=stream)
+        return self.session.post(url, json=payload, timeout=self.timeout, stream=stream)
+    
+    def resilience_state(self):
+        """Return latency, hedging and circuit breaker state for monitoring."""
+        return {
+            'latency': self.latency.snapshot(),
+            'hedging': self.hedging.state() if self.hedging else None,
+            'circuit_breaker': self.circuit_breaker.state() if self.circuit_breaker else None
+        }
+    
+    def warm_up(self):
+        """
+        Open a pooled connection to the API host ahead of the first invoice.
+        
+        Returns:
+            bool: True if the host was reachable
+        """
+        try:
+            self.session.head(self.base_url, timeout=self.timeout)
+            return True
+        except requests.RequestException as e:
+            logger.warning("Gemini warm-up failed: %s", e)
+            return False
+    
+    def close(self):
+        """Close all pooled connections."""
+        self.session.close()
+
+
+_default_client = None
+_default_client_lock = threading.Lock()
+
+
+def get_gemini_client():
+    """
+    Return the process-wide GeminiVisionClient, creating it on first use.
+    
+    Pool size and timeouts are read once from GEMINI_POOL_SIZE,
+    GEMINI_CONNECT_TIMEOUT and GEMINI_READ_TIMEOUT; rate limiting, hedging
+    and the circuit breaker from their own GEMINI_* settings.
+    """
+    global _default_client
+    if _default_client is None:
+        with _default_client_lock:
+            if _default_client is None:
+                latency, hedging, circuit_breaker = get_resilience_settings()
+                _default_client = GeminiVisionClient(
+                    pool_size=int(os.environ.get('GEMINI_POOL_SIZE', '10')),
+                    connect_timeout=float(os.environ.get('GEMINI_CONNECT_TIMEOUT', '5')),
+                    read_timeout=float(os.environ.get('GEMINI_READ_TIMEOUT', '30')),
+                    rate_limiter=get_rate_limiter(),
+                    hedging=hedging,
+                    circuit_breaker=circuit_breaker,
+                    latency=latency
+                )
+    return _default_client
+
+
+class ExtractionBackend:
+    """
+    Model backend that turns one invoice file into the normalized invoice dict.
+    
+    The cache, image pre-processing and PDF page splitting around a backend
+    are shared by all backends. Subclasses set name and model, implement
+    extract(), and are made selectable with register_extraction_backend
+    plus EXTRACTION_BACKEND.
+    """
+    
+    name = None
+    
+    def __init__(self, model=None):
+        self.model = model
+    
+    def missing_config(self):
+        """Return an error message if the backend cannot be used, else None."""
+        return None
+    
+    def extract(self, file_bytes, mime_type, api_key=None):
+        """
+        Extract one invoice file.
+        
+        Args:
+            file_bytes (bytes-like): File contents (already pre-processed)
+            mime_type (str): Mime type of file_bytes
+            api_key (str, optional): Per-call credential override
+        
+        Returns:
+            dict: Normalized invoice data (see normalize_invoice_data)
+        """
+        raise NotImplementedError
+    
+    def extract_text(self, text, api_key=None):
+        """
+        Extract an invoice from its plain text (e.g. a PDF text layer).
+        
+        Optional; backends that cannot do this leave it unimplemented and
+        PDFs are then always sent as files.
+        
+        Returns:
+            dict: Normalized invoice data (see normalize_invoice_data)
+        """
+        raise NotImplementedError
+    
+    def supports_text(self):
+        """Whether extract_text is implemented."""
+        return type(self).extract_text is not ExtractionBackend.extract_text
+    
+    def state(self):
+        """Return backend details for health checks."""
+        return {'name': self.name, 'model': self.model}
+    
+    def close(self):
+        """Release any connections held by the backend."""
+
+
+class GeminiBackend(ExtractionBackend):
+    """Gemini generateContent backend over a GeminiVisionClient."""
+    
+    name = 'gemini'
+    
+    def __init__(self, client=None):
+        """
+        Args:
+            client (GeminiVisionClient, optional): Client to use (default: shared client)
+        """
+        self.client = client or get_gemini_client()
+    
+    @property
+    def model(self):
+        return self.client.model
+    
+    def missing_config(self):
+        if not self.client.api_key:
+            return 'GEMINI_API_KEY environment variable not set'
+        return None
+    
+    def extract(self, file_bytes, mime_type, api_key=None):
+        # The image is base64-encoded while the body streams out, so no
+        # encoded copy of the file is held in memory; that work is part of
+        # the network stage rather than encode
+        with stage('encode'):
+            payload = build_extraction_payload(file_bytes, mime_type)
+        logger.debug("Sending %s to Gemini Vision API (model: %s)", mime_type, self.model)
+        started = time.perf_counter()
+        with stage('network'):
+            response = self.client.generate_content(payload, api_key=api_key)
+        latency = time.perf_counter() - started
+        result = parse_extraction_response(response)
+        record_call_usage(result, latency, len(payload))
+        return result
+    
+    def extract_text(self, text, api_key=None):
+        with stage('encode'):
+            payload = build_text_extraction_payload(text)
+        logger.debug("Sending %d chars of invoice text to Gemini (model: %s)", len(text), self.model)
+        started = time.perf_counter()
+        with stage('network'):
+            response = self.client.generate_content(payload, api_key=api_key)
+        latency = time.perf_counter() - started
+        result = parse_extraction_response(response)
+        record_call_usage(result, latency, len(payload))
+        return result
+    
+    def state(self):
+        state = super().state()
+        state['base_url'] = self.client.base_url
+        return state
+    
+    def close(self):
+        self.client.close()
+
+
+EXTRACTION_BACKENDS = {
+    'gemini': lambda: GeminiBackend(get_gemini_client())
+}
+
+
+def register_extraction_backend(name, factory):
+    """
+    Make a backend selectable with EXTRACTION_BACKEND=name.
+    
+    Args:
+        name (str): Backend name
+        factory (callable): Zero-argument callable returning an ExtractionBackend
+    """
+    EXTRACTION_BACKENDS[name] = factory
+
+
+_default_backend = None
+_default_backend_lock = threading.Lock()
+
+
+def get_extraction_backend(client=None):
+    """
+    Return the backend to extract with.
+    
+    A GeminiBackend over client when one is given, otherwise the
+    process-wide backend named by EXTRACTION_BACKEND (default: gemini).
+    """
+    global _default_backend
+    if client is not None:
+        return GeminiBackend(client)
+    if _default_backend is None:
+        with _default_backend_lock:
+            if _default_backend is None:
+                name = os.environ.get('EXTRACTION_BACKEND', 'gemini')
+                if name not in EXTRACTION_BACKENDS:
+                    raise ValueError(f"Unknown EXTRACTION_BACKEND '{name}' "
+                                     f"(available: {', '.join(sorted(EXTRACTION_BACKENDS))})")
+                _default_backend = EXTRACTION_BACKENDS[name]()
+    return _default_backend
+
+
+MIME_TYPES = {
+    'jpg': 'image/jpeg',
+    'jpeg': 'image/jpeg',
+    'png': 'image/png',
+    'gif': 'image/gif',
+    'webp': 'image/webp',
+    'bmp': 'image/bmp',
+    'tif': 'image/tiff',
+    'tiff': 'image/tiff',
+    'pdf': 'application/pdf'
+}
+
+# Multi-page PDFs are split into chunks of this many pages and extracted concurrently (0 = send whole PDF)
+PDF_PAGES_PER_CHUNK = int(os.environ.get('PDF_PAGES_PER_CHUNK', '0'))
+PDF_MAX_CONCURRENCY = int(os.environ.get('PDF_MAX_CONCURRENCY', '4'))
+
+# Digital PDFs with a usable text layer skip sending the file: 'off', 'prompt' (send only
+# the text) or 'parse' (deterministic parser first, text prompt when it is not confident)
+PDF_TEXT_MODE = os.environ.get('PDF_TEXT_MODE', 'off').lower()
+PDF_TEXT_MIN_CHARS_PER_PAGE = int(os.environ.get('PDF_TEXT_MIN_CHARS_PER_PAGE', '200'))
+PDF_TEXT_MAX_CHARS = int(os.environ.get('PDF_TEXT_MAX_CHARS', '30000'))
+
+# Image formats Gemini accepts as inline_data; anything else must be converted first
+GEMINI_IMAGE_MIME_TYPES = {'image/jpeg', 'image/png', 'image/webp', 'image/heic', 'image/heif'}
+
+
+class ImagePreprocessor:
+    """
+    Shrinks invoice images before upload: caps the longest edge, re-encodes to
+    JPEG/WebP, optionally converts to grayscale and drops EXIF metadata.
+    
+    Formats Gemini does not accept (BMP, TIFF, GIF) are always converted, even when
+    the optional shrinking stage is disabled. Requires Pillow; without it
+    images are sent untouched.
+    """
+    
+    def __init__(self, enabled=True, max_edge=2048, output_format='JPEG', quality=85, grayscale=False):
+        """
+        Args:
+            enabled (bool): Run the downscale/recompress stage (format conversion always runs)
+            max_edge (int): Longest edge in pixels after resizing
+            output_format (str): 'JPEG' or 'WEBP'
+            quality (int): Encoder quality (1-100)
+            grayscale (bool): Convert to single-channel grayscale
+        """
+        self.enabled = enabled
+        self.max_edge = max_edge
+        self.output_format = output_format.upper()
+        self.quality = quality
+        self.grayscale = grayscale
+    
+    def process(self, file_bytes, mime_type):
+        """
+        Pre-process an image for upload.
+        
+        Args:
+            file_bytes (bytes-like): Raw image bytes
+            mime_type (str): Mime type of file_bytes
+        
+        Returns:
+            tuple: (data, mime_type, report) - report is None when the file was left untouched,
+                   otherwise a dict with byte counts and per-stage timings in ms
+        """
+        needs_conversion = mime_type.startswith('image/') and mime_type not in GEMINI_IMAGE_MIME_TYPES
+        if not mime_type.startswith('image/'):
+            return file_bytes, mime_type, None
+        if not self.enabled and not needs_conversion:
+            return file_bytes, mime_type, None
+        
+        try:
+            from PIL import Image, ImageOps
+        except ImportError:
+            return file_bytes, mime_type, None
+        
+        timings = {}
+        
+        started = time.perf_counter()
+        try:
+            image = Image.open(io.BytesIO(file_bytes))
+            if self.enabled and image.format == 'JPEG':
+                # Let libjpeg decode at a reduced scale instead of resizing the full image later
+                image.draft('L' if self.grayscale else 'RGB', (self.max_edge, self.max_edge))
+            image.load()
+        except (OSError, ValueError, Image.DecompressionBombError) as e:
+            # Let Gemini see the original bytes rather than failing the extraction here
+            logger.warning("Image pre-processing skipped: %s", e)
+            return file_bytes, mime_type, None
+        timings['decode_ms'] = (time.perf_counter() - started) * 1000
+        
+        started = time.perf_counter()
+        # Apply the EXIF orientation before the metadata is dropped
+        image = ImageOps.exif_transpose(image)
+        if self.enabled and max(image.size) > self.max_edge:
+            image.thumbnail((self.max_edge, self.max_edge), Image.LANCZOS)
+        if self.enabled and self.grayscale:
+            image = image.convert('L')
+        elif image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        timings['transform_ms'] = (time.perf_counter() - started) * 1000
+        
+        started = time.perf_counter()
+        output_format = self.output_format if self.output_format in ('JPEG', 'WEBP') else 'JPEG'
+        buffer = io.BytesIO()
+        # Saving without an exif= argument strips EXIF metadata
+        image.save(buffer, format=output_format, quality=self.quality, optimize=True)
+        data = buffer.getvalue()
+        timings['encode_ms'] = (time.perf_counter() - started) * 1000
+        
+        # Keep the original if recompressing did not help (e.g. small PNG screenshots)
+        if len(data) >= len(file_bytes) and not needs_conversion:
+            data, new_mime_type = file_bytes, mime_type
+        else:
+            new_mime_type = 'image/webp' if output_format == 'WEBP' else 'image/jpeg'
+        
+        report = {
+            'original_bytes': len(file_bytes),
+            'processed_bytes': len(data),
+            'bytes_saved': len(file_bytes) - len(data),
+            'original_mime_type': mime_type,
+            'mime_type': new_mime_type,
+            'size': list(image.size)
+        }
+        report.update({key: round(value, 2) for key, value in timings.items()})
+        return data, new_mime_type, report
+
+
+_default_preprocessor = None
+
+
+def get_image_preprocessor():
+    """
+    Return the process-wide ImagePreprocessor configured from IMAGE_PREPROCESS,
+    IMAGE_MAX_EDGE, IMAGE_FORMAT, IMAGE_QUALITY and IMAGE_GRAYSCALE.
+    """
+    global _default_preprocessor
+    if _default_preprocessor is None:
+        _default_preprocessor = ImagePreprocessor(
+            enabled=os.environ.get('IMAGE_PREPROCESS', 'false').lower() == 'true',
+            max_edge=int(os.environ.get('IMAGE_MAX_EDGE', '2048')),
+            output_format=os.environ.get('IMAGE_FORMAT', 'JPEG'),
+            quality=int(os.environ.get('IMAGE_QUALITY', '85')),
+            grayscale=os.environ.get('IMAGE_GRAYSCALE', 'false').lower() == 'true'
+        )
+    return _default_preprocessor
+
+
+def guess_mime_type(filename):
+    """Guess an invoice's mime type from its file extension (default: image/jpeg)."""
+    ext = filename.lower().split('.')[-1] if filename else ''
+    return MIME_TYPES.get(ext, 'image/jpeg')
+
+
+def load_invoice_source(source, mime_type=None):
+    """
+    Normalize an invoice source into raw bytes plus a mime type.
+    
+    In-memory buffers are returned as-is (no copy), file-like objects are read
+    once, and only str/PathLike sources touch the filesystem.
+    
+    Args:
+        source: File path, bytes/bytearray/memoryview, or readable file-like object
+        mime_type (str, optional): Explicit mime type (default: guessed from the file name)
+    
+    Returns:
+        tuple: (bytes-like data, mime type)
+    """
+    name = None
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        data = source
+    elif hasattr(source, 'read'):
+        data = source.read()
+        name = getattr(source, 'filename', None) or getattr(source, 'name', None)
+    else:
+        name = os.fspath(source)
+        with open(name, 'rb') as f:
+            data = f.read()
+    
+    if mime_type is None:
+        mime_type = guess_mime_type(name if isinstance(name, str) else None)
+    return data, mime_type
+
+
+def extract_invoice_data(source, known_vendors=None, ocr_api_key=None, client=None, cache=None, mime_type=None,
+                         preprocessor=None, backend=None):
     """
     Extract key invoice information from an image using Gemini Vision API.
     
     Args:
-        image_path (str): Path to the invoice image file
+        source: Invoice file path, bytes/bytearray/memoryview, or file-like object
         known_vendors (list, optional): Deprecated - not used
         ocr_api_key (str, optional): Deprecated - not used
+        client (GeminiVisionClient, optional): Client to use (default: shared client)
+        cache (ExtractionCache, optional): Result cache (default: shared cache)
+        mime_type (str, optional): Mime type of in-memory sources (default: guessed from file name)
+        preprocessor (ImagePreprocessor, optional): Image pre-processing stage (default: shared)
+        backend (ExtractionBackend, optional): Backend to use (default: Gemini over client,
+            or the EXTRACTION_BACKEND backend when no client is given)
     
     Returns:
         dict: Dictionary containing vendor, date, total, and other invoice fields
     """
     # Use Gemini Vision API directly - no OCR needed
-    gemini_key = os.environ.get('GEMINI_API_KEY')
+    backend = backend or get_extraction_backend(client)
+    config_error = backend.missing_config()
     
-    if not gemini_key:
+    if config_error:
         return {
             'vendor': None,
             'date': None,
             'total': None,
-            'error': 'GEMINI_API_KEY environment variable not set'
+            'error': config_error
         }
     
     try:
-        print("🔍 Processing invoice with Gemini Vision API...")
-        result = extract_with_gemini_vision(image_path, gemini_key)
-        print("✅ Gemini Vision extraction successful!")
+        logger.debug("Processing invoice with %s backend", backend.name)
+        file_bytes, mime_type = load_invoice_source(source, mime_type)
+        result = None
+        if mime_type == 'application/pdf' and PDF_TEXT_MODE != 'off':
+            # Digital PDFs: extract from the text layer; None falls through to the file path
+            result = extract_pdf_text(file_bytes, cache=cache, backend=backend)
+        if result is None and mime_type == 'application/pdf' and PDF_PAGES_PER_CHUNK > 0:
+            result = extract_pdf_pages(file_bytes, cache=cache, pages_per_chunk=PDF_PAGES_PER_CHUNK,
+                                       max_concurrency=PDF_MAX_CONCURRENCY, backend=backend)
+        if result is None:
+            result = extract_with_gemini_vision(file_bytes, cache=cache, mime_type=mime_type,
+                                                preprocessor=preprocessor, backend=backend)
         return result
     except Exception as e:
-        print(f"❌ Gemini Vision extraction failed: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Gemini Vision extraction failed: %s", e)
         return {
             'vendor': None,
             'date': None,
@@ -49,146 +884,1519 @@ def extract_invoice_data(image_path, known_vendors=None, ocr_api_key=None):
         }
 
 
-def extract_with_gemini_vision(image_path, api_key):
+def extract_with_gemini_vision(source, api_key=None, client=None, cache=None, mime_type=None, preprocessor=None,
+                               backend=None):
     """
     Use Gemini Vision API to extract invoice data directly from image.
     Uses Gemini's multimodal capabilities to read and understand invoices.
     
     Args:
-        image_path (str): Path to the image file
-        api_key (str): Gemini API key
+        source: Image file path, bytes/bytearray/memoryview, or file-like object
+        api_key (str, optional): Gemini API key (default: the client's key)
+        client (GeminiVisionClient, optional): Client to use (default: shared client)
+        cache (ExtractionCache, optional): Result cache (default: shared cache)
+        mime_type (str, optional): Mime type of in-memory sources (default: guessed from file name)
+        preprocessor (ImagePreprocessor, optional): Image pre-processing stage (default: shared)
+        backend (ExtractionBackend, optional): Backend to use (default: Gemini over client,
+            or the EXTRACTION_BACKEND backend when no client is given)
     
     Returns:
         dict: Extracted invoice data with all fields
     """
-    # Read and encode image
-    with open(image_path, 'rb') as f:
-        image_data = base64.b64encode(f.read()).decode('utf-8')
-    
-    # Determine mime type from file extension
-    ext = image_path.lower().split('.')[-1]
-    mime_types = {
-        'jpg': 'image/jpeg',
-        'jpeg': 'image/jpeg',
-        'png': 'image/png',
-        'gif': 'image/gif',
-        'webp': 'image/webp',
-        'pdf': 'application/pdf'
-    }
-    mime_type = mime_types.get(ext, 'image/jpeg')
+    backend = backend or get_extraction_backend(client)
+    model = backend.model
+    cache = cache or get_extraction_cache()
+    
+    # Read image (no-op for in-memory uploads)
+    file_bytes, mime_type = load_invoice_source(source, mime_type)
     
-    # Configure Gemini API request
-    model = "gemini-2.0-flash"
-    url = f"https://generativelanguage.googleapis.com/v1/models/{model}:generateContent?key={api_key}"
+    # Same bytes + model + prompt always yield the same extraction
+    cache_key, cached = cached_extraction(cache, file_bytes, model, extraction_prompt_version())
+    if cached is not None:
+        return cached
     
-    prompt = """Analyze this invoice image and extract all relevant information. Return ONLY valid JSON in this exact format:
+    # Shrink/convert images before upload (smaller payload, fewer input tokens)
+    preprocessor = preprocessor or get_image_preprocessor()
+    with stage('preprocess'):
+        file_bytes, mime_type, preprocess_report = preprocessor.process(file_bytes, mime_type)
+    if preprocess_report:
+        logger.debug("Pre-processed image: %s bytes saved", preprocess_report['bytes_saved'])
+    
+    result = backend.extract(file_bytes, mime_type, api_key=api_key)
+    if preprocess_report:
+        result['_preprocessing'] = preprocess_report
+    
+    if cache is not None:
+        cache.put(cache_key, result)
+    return result
 
-{
-  "vendor": "company/vendor name",
-  "invoice_number": "invoice or receipt number",
-  "date": "date in YYYY-MM-DD format",
-  "subtotal": "subtotal amount with currency symbol",
-  "tax": "tax amount with currency symbol",
-  "total": "total amount with currency symbol",
-  "summary": "brief 1-sentence summary of what this invoice is for",
-  "line_items": [
-    {"description": "item/service description", "quantity": "quantity", "price": "unit price with currency"}
-  ]
-}
 
-Important:
-- Return null for any field you cannot find
-- Keep currency symbols with amounts (e.g., "$150.00", "€45.50")
-- Format dates as YYYY-MM-DD
-- Extract ALL line items you can see
-- Be precise and accurate"""
+def cached_extraction(cache, file_bytes, model, prompt_version, *fallback_versions):
+    """
+    Look up a cached extraction of file_bytes.
+    
+    Args:
+        cache (ExtractionCache or None): Result cache; None disables caching
+        file_bytes (bytes-like): File being extracted
+        model (str): Model name the result must come from
+        prompt_version: Cache key version of the prompt that will be sent
+        *fallback_versions: Other prompt versions whose results are also acceptable
+    
+    Returns:
+        tuple: (cache_key, cached) - the key to store a fresh result under (None
+               without a cache) and the cached result tagged _method='cache', or None
+    """
+    if cache is None:
+        return None, None
+    keys = []
+    for version in (prompt_version,) + fallback_versions:
+        with stage('hash'):
+            keys.append(ExtractionCache.make_key(file_bytes, model, version))
+        cached = cache.get(keys[-1])
+        if cached is not None:
+            logger.debug("Returning cached extraction result")
+            cached['_method'] = 'cache'
+            # A cache hit makes no API call, so it carries no token usage
+            cached.pop('_usage', None)
+            return keys[0], cached
+    return keys[0], None
 
-    # Build request payload with image and prompt
-    payload = {
-        "contents": [{
-            "parts": [
-                {"text": prompt},
-                {
-                    "inline_data": {
-                        "mime_type": mime_type,
-                        "data": image_data
-                    }
-                }
-            ]
-        }],
-        "generationConfig": {
-            "temperature": 0.1,
-            "maxOutputTokens": 4096
-        }
-    }
+
+def extraction_prompt_version(structured=None):
+    """Cache key version for single-invoice extraction in the given output mode."""
+    structured = STRUCTURED_OUTPUT if structured is None else structured
+    return f"s{STRUCTURED_PROMPT_VERSION}" if structured else PROMPT_VERSION
+
+
+def extract_invoice_data_stream(source, client=None, cache=None, mime_type=None, preprocessor=None, backend=None):
+    """
+    Streaming variant of extract_invoice_data.
     
-    print(f"📤 Sending {mime_type} to Gemini Vision API (model: {model})...")
-    response = requests.post(url, json=payload, timeout=30)
+    Yields {'event': 'field', 'field': name, 'value': value} for each invoice
+    field as soon as the model has finished writing it, then a single
+    {'event': 'result', 'data': result} whose data is exactly what
+    extract_invoice_data returns, including the error dict on failure.
+    PDFs handled by the text-layer fast path or split into page groups,
+    and backends other than Gemini, are not streamed; only the result
+    event is sent for them.
     
-    # Check for API errors
-    if response.status_code != 200:
-        error_text = response.text
-        print(f"❌ Gemini Vision API Error ({response.status_code}): {error_text}")
+    Args:
+        source: Invoice file path, bytes/bytearray/memoryview, or file-like object
+        client (GeminiVisionClient, optional): Client to use (default: shared client)
+        cache (ExtractionCache, optional): Result cache (default: shared cache)
+        mime_type (str, optional): Mime type of in-memory sources (default: guessed from file name)
+        preprocessor (ImagePreprocessor, optional): Image pre-processing stage (default: shared)
+        backend (ExtractionBackend, optional): Backend to use (default: Gemini over client,
+            or the EXTRACTION_BACKEND backend when no client is given)
+    """
+    backend = backend or get_extraction_backend(client)
+    if not isinstance(backend, GeminiBackend):
+        yield {'event': 'result', 'data': extract_invoice_data(source, cache=cache, mime_type=mime_type,
+                                                               preprocessor=preprocessor, backend=backend)}
+        return
+    client = backend.client
+    gemini_key = client.api_key
+    
+    if not gemini_key:
+        yield {'event': 'result', 'data': {
+            'vendor': None,
+            'date': None,
+            'total': None,
+            'error': 'GEMINI_API_KEY environment variable not set'
+        }}
+        return
+    
+    try:
+        file_bytes, mime_type = load_invoice_source(source, mime_type)
+        result = None
+        if mime_type == 'application/pdf' and PDF_TEXT_MODE != 'off':
+            result = extract_pdf_text(file_bytes, cache=cache, backend=backend)
+        if result is None and mime_type == 'application/pdf' and PDF_PAGES_PER_CHUNK > 0:
+            result = extract_pdf_pages(file_bytes, cache=cache, pages_per_chunk=PDF_PAGES_PER_CHUNK,
+                                       max_concurrency=PDF_MAX_CONCURRENCY, backend=backend)
+        if result is not None:
+            yield {'event': 'result', 'data': result}
+            return
+        yield from extract_with_gemini_vision_stream(file_bytes, gemini_key, client=client, cache=cache,
+                                                     mime_type=mime_type, preprocessor=preprocessor)
+    except Exception as e:
+        logger.exception("Gemini Vision streaming extraction failed: %s", e)
+        yield {'event': 'result', 'data': {
+            'vendor': None,
+            'date': None,
+            'total': None,
+            'error': f'Gemini Vision API failed: {str(e)}'
+        }}
+
+
+def extract_with_gemini_vision_stream(source, api_key=None, client=None, cache=None, mime_type=None,
+                                      preprocessor=None):
+    """
+    Extract invoice data over streamGenerateContent, yielding fields as they complete.
+    
+    Same caching, pre-processing and parsing as extract_with_gemini_vision;
+    see extract_invoice_data_stream for the events yielded.
+    """
+    client = client or get_gemini_client()
+    cache = cache or get_extraction_cache()
+    structured = STRUCTURED_OUTPUT
+    
+    file_bytes, mime_type = load_invoice_source(source, mime_type)
+    
+    cache_key, cached = cached_extraction(cache, file_bytes, client.model, extraction_prompt_version(structured))
+    if cached is not None:
+        yield {'event': 'result', 'data': cached}
+        return
+    
+    preprocessor = preprocessor or get_image_preprocessor()
+    file_bytes, mime_type, preprocess_report = preprocessor.process(file_bytes, mime_type)
+    payload = build_extraction_payload(file_bytes, mime_type, structured)
+    
+    logger.debug("Streaming %s to Gemini Vision API (model: %s)", mime_type, client.model)
+    started = time.perf_counter()
+    response = client.stream_generate_content(payload, api_key=api_key)
+    usage = {}
+    fragments = []
+    parser = IncrementalFieldParser()
+    properties = INVOICE_RESPONSE_SCHEMA['properties']
+    try:
+        for fragment in iter_stream_text(response, usage):
+            fragments.append(fragment)
+            for name, value in parser.feed(fragment):
+                if name not in properties:
+                    continue
+                if structured:
+                    value, _ = conform_to_schema(value, properties[name])
+                yield {'event': 'field', 'field': name, 'value': value}
+    finally:
+        response.close()
+    
+    latency = time.perf_counter() - started
+    result = parse_generated_text(strip_code_fences(''.join(fragments)), structured)
+    if usage:
+        result['_usage'] = usage
+    record_call_usage(result, latency, len(payload))
+    if preprocess_report:
+        result['_preprocessing'] = preprocess_report
+    
+    if cache is not None:
+        cache.put(cache_key, result)
+    yield {'event': 'result', 'data': result}
+
+
+def generation_config(structured, max_output_tokens=4096):
+    """
+    generationConfig shared by every extraction request.
+    
+    Args:
+        structured (bool): Request schema-constrained JSON (responseMimeType + responseSchema)
+        max_output_tokens (int): Output token limit for the call
+    """
+    config = {
+        "temperature": 0.1,
+        "maxOutputTokens": max_output_tokens
+    }
+    if structured:
+        config["responseMimeType"] = "application/json"
+        config["responseSchema"] = INVOICE_RESPONSE_SCHEMA
+    return config
+
+
+def build_extraction_payload(file_bytes, mime_type, structured=None):
+    """
+    Build the streaming generateContent body for a single invoice file.
+    
+    Args:
+        file_bytes (bytes-like): File to extract
+        mime_type (str): Mime type of file_bytes
+        structured (bool, optional): Request schema-constrained JSON (default: GEMINI_STRUCTURED_OUTPUT)
+    """
+    structured = STRUCTURED_OUTPUT if structured is None else structured
+    return StreamingJSONBody({
+        "contents": [{
+            "parts": [
+                {"text": STRUCTURED_EXTRACTION_PROMPT if structured else EXTRACTION_PROMPT},
+                {
+                    "inline_data": {
+                        "mime_type": mime_type,
+                        "data": file_bytes
+                    }
+                }
+            ]
+        }],
+        "generationConfig": generation_config(structured)
+    })
+
+
+def build_text_extraction_payload(text, structured=None):
+    """
+    Build the generateContent body for an invoice given as plain text.
+    
+    Args:
+        text (str): Invoice text, e.g. a PDF text layer
+        structured (bool, optional): Request schema-constrained JSON (default: GEMINI_STRUCTURED_OUTPUT)
+    """
+    structured = STRUCTURED_OUTPUT if structured is None else structured
+    return StreamingJSONBody({
+        "contents": [{
+            "parts": [
+                {"text": STRUCTURED_TEXT_EXTRACTION_PROMPT if structured else TEXT_EXTRACTION_PROMPT},
+                {"text": f"Invoice text:\n{text}"}
+            ]
+        }],
+        "generationConfig": generation_config(structured)
+    })
+
+
+def parse_extraction_response(response, structured=None):
+    """
+    Turn a single-invoice generateContent response into the normalized invoice dict.
+    
+    Output that is not valid JSON as-is (stray text around it, or cut off at
+    maxOutputTokens) goes through repair_json before giving up. In structured
+    mode the result is also checked against INVOICE_RESPONSE_SCHEMA; fields
+    that do not match are dropped and listed under '_schema_errors'.
+    
+    Args:
+        response: requests.Response or httpx.Response from generateContent
+        structured (bool, optional): Response was requested with a schema (default: GEMINI_STRUCTURED_OUTPUT)
+    
+    Returns:
+        dict: Normalized invoice data
+    """
+    body = read_response_json(response)
+    result = parse_generated_text(generated_text_from(body), structured)
+    usage = usage_from_response(body)
+    if usage:
+        result['_usage'] = usage
+    return result
+
+
+def parse_generated_text(generated_text, structured=None):
+    """
+    Parse the model's (fence-stripped) text output into the normalized invoice dict.
+    
+    Shared by the regular and streaming paths so both yield the same result.
+    
+    Args:
+        generated_text (str): Text generated for a single-invoice request
+        structured (bool, optional): Response was requested with a schema (default: GEMINI_STRUCTURED_OUTPUT)
+    
+    Returns:
+        dict: Normalized invoice data
+    """
+    structured = STRUCTURED_OUTPUT if structured is None else structured
+    repaired = False
+    with stage('parse'):
+        try:
+            data = json.loads(generated_text)
+        except json.JSONDecodeError as e:
+            data = repair_json(generated_text)
+            if not data:
+                logger.error("Failed to parse JSON response: %s", e)
+                logger.debug("Raw response: %.500s", generated_text)
+                raise Exception(f"Invalid JSON response from Gemini: {str(e)}")
+            logger.warning("Repaired malformed JSON response (%s)", e)
+            repaired = True
+        
+        if not isinstance(data, dict):
+            raise Exception(f"Expected a JSON object from Gemini, got {type(data).__name__}")
+        
+        schema_errors = []
+        if structured:
+            data, schema_errors = conform_to_schema(data, INVOICE_RESPONSE_SCHEMA)
+            if schema_errors:
+                logger.warning("Response did not match schema: %s", '; '.join(schema_errors))
+    
+    with stage('normalize'):
+        result = normalize_invoice_data(data)
+    if repaired:
+        result['_repaired'] = True
+    if schema_errors:
+        result['_schema_errors'] = schema_errors
+    return result
+
+
+def read_generated_text(response):
+    """
+    Validate a generateContent HTTP response and return the model's text output
+    with markdown code fences stripped.
+    
+    Args:
+        response: requests.Response or httpx.Response from generateContent
+    
+    Returns:
+        str: Generated text
+    """
+    return generated_text_from(read_response_json(response))
+
+
+def read_response_json(response):
+    """
+    Check a generateContent HTTP response for errors and decode its JSON body.
+    
+    Args:
+        response: requests.Response or httpx.Response from generateContent
+    
+    Returns:
+        The decoded response body
+    """
+    # Check for API errors
+    if response.status_code != 200:
+        error_text = response.text
+        logger.error("Gemini Vision API error (%s): %s", response.status_code, error_text)
         raise Exception(f"Gemini Vision API returned status {response.status_code}: {error_text}")
     
     try:
-        result = response.json()
-        print(f"📥 Received response from Gemini - Type: {type(result)}")
-        print(f"🔍 Response structure: {str(result)[:500]}")
+        with stage('parse'):
+            return response.json()
     except Exception as e:
-        print(f"❌ Failed to parse JSON response: {e}")
-        print(f"Raw response text: {response.text[:1000]}")
+        logger.error("Failed to parse Gemini response as JSON: %s", e)
+        logger.debug("Raw response text: %.1000s", response.text)
         raise Exception(f"Failed to parse Gemini response as JSON: {e}")
-    
+
+
+def generated_text_from(result):
+    """
+    Return the first candidate's text from a decoded generateContent body,
+    with markdown code fences stripped.
+    """
     # Check if result is a list instead of dict (error case)
     if isinstance(result, list):
-        print(f"❌ Gemini returned a list instead of dict: {result}")
+        logger.error("Gemini returned a list instead of dict: %.500s", result)
         raise Exception(f"Unexpected response format from Gemini API: {result}")
     
     # Extract and parse the response
     if 'candidates' in result and len(result['candidates']) > 0:
         candidate = result['candidates'][0]
         if 'content' not in candidate or 'parts' not in candidate['content']:
-            print(f"❌ Invalid candidate structure: {candidate}")
+            logger.error("Invalid candidate structure: %.500s", candidate)
             raise Exception(f"Invalid response structure from Gemini API")
         
         parts = candidate['content']['parts']
         if not isinstance(parts, list) or len(parts) == 0:
-            print(f"❌ Parts is not a list or is empty: {parts}")
+            logger.error("Parts is not a list or is empty: %.500s", parts)
             raise Exception(f"Invalid parts structure from Gemini API")
         
         first_part = parts[0]
         if not isinstance(first_part, dict) or 'text' not in first_part:
-            print(f"❌ First part is not a dict or has no text: {first_part}")
+            logger.error("First part is not a dict or has no text: %.500s", first_part)
             raise Exception(f"Invalid part structure from Gemini API")
         
         generated_text = first_part['text']
-        print(f"📄 Generated text length: {len(generated_text)} chars")
+        logger.debug("Generated text length: %d chars", len(generated_text))
         
         # Clean up markdown formatting
-        generated_text = generated_text.replace('```json', '').replace('```', '').strip()
+        return strip_code_fences(generated_text)
+    
+    logger.error("No candidates in Gemini response")
+    raise Exception("No valid response from Gemini Vision API")
+
+
+def usage_from_response(body):
+    """
+    Read token counts from a generateContent body's usageMetadata.
+    
+    Returns:
+        dict or None: prompt_tokens, output_tokens and total_tokens, or None if absent
+    """
+    metadata = body.get('usageMetadata') if isinstance(body, dict) else None
+    if not metadata:
+        return None
+    prompt_tokens = metadata.get('promptTokenCount') or 0
+    output_tokens = metadata.get('candidatesTokenCount') or 0
+    return {
+        'prompt_tokens': prompt_tokens,
+        'output_tokens': output_tokens,
+        'total_tokens': metadata.get('totalTokenCount') or prompt_tokens + output_tokens
+    }
+
+
+def record_call_usage(result, latency, request_bytes, shared_by=1):
+    """
+    Attach per-call cost data to an extraction result as '_usage'.
+    
+    Token counts already parsed from usageMetadata are kept; latency and
+    request size are added. When one call served shared_by invoices (a
+    packed request), tokens and bytes are split evenly between them.
+    
+    Args:
+        result (dict): Extraction result to update
+        latency (float): Seconds spent waiting on the API call
+        request_bytes (int): Request body size in bytes
+        shared_by (int): Invoices extracted by the same call
+    """
+    usage = dict(result.get('_usage') or {})
+    if shared_by > 1:
+        for field in ('prompt_tokens', 'output_tokens', 'total_tokens'):
+            if field in usage:
+                usage[field] = round(usage[field] / shared_by)
+        usage['shared_by'] = shared_by
+    usage['latency_ms'] = round(latency * 1000, 2)
+    usage['request_bytes'] = round(request_bytes / shared_by)
+    usage['calls'] = 1
+    result['_usage'] = usage
+
+
+def combine_usage(usages):
+    """Sum '_usage' dicts from several calls (e.g. PDF page groups); None if there are none."""
+    usages = [u for u in usages if u]
+    if not usages:
+        return None
+    combined = {}
+    for usage in usages:
+        for field in ('prompt_tokens', 'output_tokens', 'total_tokens', 'latency_ms', 'request_bytes', 'calls'):
+            if field in usage:
+                combined[field] = combined.get(field, 0) + usage[field]
+    if 'latency_ms' in combined:
+        combined['latency_ms'] = round(combined['latency_ms'], 2)
+    return combined
+
+
+def strip_code_fences(text):
+    """Remove markdown code fences the model wraps around JSON output."""
+    return text.replace('```json', '').replace('```', '').strip()
+
+
+def iter_stream_text(response, usage=None):
+    """
+    Yield generated text fragments from a streamGenerateContent SSE response.
+    
+    Args:
+        response: Open streaming requests.Response from stream_generate_content
+        usage (dict, optional): Updated with token counts from the final chunk's usageMetadata
+    """
+    if response.status_code != 200:
+        error_text = response.text
+        logger.error("Gemini Vision API error (%s): %s", response.status_code, error_text)
+        raise Exception(f"Gemini Vision API returned status {response.status_code}: {error_text}")
+    
+    for line in response.iter_lines(decode_unicode=True):
+        if not line or not line.startswith('data:'):
+            continue
+        try:
+            chunk = json.loads(line[5:])
+        except json.JSONDecodeError as e:
+            raise Exception(f"Failed to parse Gemini stream chunk as JSON: {e}")
+        if 'error' in chunk:
+            raise Exception(f"Gemini Vision API stream error: {chunk['error']}")
+        if usage is not None:
+            usage.update(usage_from_response(chunk) or {})
+        for candidate in chunk.get('candidates', [])[:1]:
+            for part in candidate.get('content', {}).get('parts', []):
+                if isinstance(part, dict) and part.get('text'):
+                    yield part['text']
+
+
+class IncrementalFieldParser:
+    """
+    Incremental parser for a streamed JSON object.
+    
+    Text fragments are fed in arrival order; each call returns the top-level
+    (key, value) pairs whose values completed within that fragment, so
+    vendor/date/total can be reported before line_items has finished.
+    Anything before the opening brace (e.g. a ```json fence) is ignored.
+    """
+    
+    def __init__(self):
+        self._text = ''
+        self._pos = 0
+        self._depth = 0
+        self._started = False
+        self._in_string = False
+        self._escaped = False
+        self._expect_key = False
+        self._key_start = None
+        self._key = None
+        self._value_start = None
+    
+    def feed(self, fragment):
+        """
+        Consume the next text fragment.
         
+        Returns:
+            list: (key, value) tuples completed by this fragment
+        """
+        self._text += fragment
+        text = self._text
+        fields = []
+        
+        while self._pos < len(text):
+            index = self._pos
+            char = text[index]
+            self._pos += 1
+            
+            if not self._started:
+                if char == '{':
+                    self._started = True
+                    self._depth = 1
+                    self._expect_key = True
+                continue
+            if self._depth == 0:
+                continue
+            
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == '\\':
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+                    if self._key_start is not None:
+                        self._key = json.loads(text[self._key_start:index + 1])
+                        self._key_start = None
+                continue
+            
+            if char == '"':
+                self._in_string = True
+                if self._depth == 1 and self._expect_key:
+                    self._key_start = index
+                    self._expect_key = False
+                elif self._depth == 1 and self._value_start is None:
+                    self._value_start = index
+            elif char in '{[':
+                if self._depth == 1 and self._value_start is None:
+                    self._value_start = index
+                self._depth += 1
+            elif char in '}]':
+                self._depth -= 1
+                if self._depth == 0:
+                    self._complete_field(index, fields)
+            elif self._depth == 1:
+                if char == ',':
+                    self._complete_field(index, fields)
+                    self._expect_key = True
+                elif char != ':' and not char.isspace() and self._key is not None and self._value_start is None:
+                    # Start of a number or true/false/null
+                    self._value_start = index
+        return fields
+    
+    def _complete_field(self, end, fields):
+        if self._key is not None and self._value_start is not None:
+            try:
+                fields.append((self._key, json.loads(self._text[self._value_start:end])))
+            except json.JSONDecodeError:
+                pass
+        self._key = None
+        self._value_start = None
+
+
+def repair_json(text):
+    """
+    Recover a JSON value from model output that json.loads rejects.
+    
+    Leading/trailing prose is skipped, and output that stops mid-document
+    (e.g. truncated at maxOutputTokens) is cut back to the last complete
+    value inside an open container, then closed. Incomplete strings, numbers
+    and keys are dropped rather than guessed, so a half-written total never
+    turns into a wrong one.
+    
+    Args:
+        text (str): Generated text
+    
+    Returns:
+        dict or list or None: Parsed value, or None if nothing can be recovered
+    """
+    starts = [i for i in (text.find('{'), text.find('[')) if i >= 0]
+    if not starts:
+        return None
+    text = text[min(starts):]
+    
+    stack = []
+    in_string = False
+    escaped = False
+    string_is_key = False
+    expect_key = False
+    # (cut index, open brackets) of the latest prefix that ends on a value boundary
+    safe_point = None
+    
+    for index, char in enumerate(text):
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == '\\':
+                escaped = True
+            elif char == '"':
+                in_string = False
+                if not string_is_key:
+                    safe_point = (index + 1, stack[:])
+            continue
+        
+        if char == '"':
+            in_string = True
+            string_is_key = expect_key
+            expect_key = False
+        elif char in '{[':
+            stack.append('}' if char == '{' else ']')
+            expect_key = char == '{'
+            # A nested object cut off before its first value is dropped, not kept as {}
+            if char == '[' or len(stack) == 1:
+                safe_point = (index + 1, stack[:])
+        elif char in '}]':
+            if not stack or stack[-1] != char:
+                break
+            stack.pop()
+            if not stack:
+                try:
+                    return json.loads(text[:index + 1])
+                except json.JSONDecodeError:
+                    break
+            safe_point = (index + 1, stack[:])
+        elif char == ',':
+            safe_point = (index, stack[:])
+            expect_key = stack[-1] == '}'
+        elif char == ':':
+            expect_key = False
+    
+    if safe_point is None:
+        return None
+    
+    cut, open_brackets = safe_point
+    try:
+        return json.loads(text[:cut] + ''.join(reversed(open_brackets)))
+    except json.JSONDecodeError:
+        return None
+
+
+def conform_to_schema(data, schema, path='$'):
+    """
+    Check a parsed value against a generateContent response schema.
+    
+    Supports the subset used by INVOICE_RESPONSE_SCHEMA (OBJECT, ARRAY, STRING,
+    NUMBER, INTEGER, BOOLEAN, nullable, required). Values that do not match are
+    replaced with None (or dropped from arrays) so one bad field does not
+    fail the whole extraction.
+    
+    Returns:
+        tuple: (conforming value, list of error strings)
+    """
+    errors = []
+    expected = schema.get('type', '').upper()
+    
+    if data is None:
+        if not schema.get('nullable') and expected not in ('OBJECT', 'ARRAY'):
+            errors.append(f"{path}: null not allowed")
+        return None, errors
+    
+    if expected == 'OBJECT':
+        if not isinstance(data, dict):
+            return None, [f"{path}: expected object"]
+        conformed = {}
+        properties = schema.get('properties', {})
+        for name in schema.get('required', []):
+            if name not in data:
+                errors.append(f"{path}.{name}: missing")
+        for name, value in data.items():
+            if name not in properties:
+                continue
+            conformed[name], field_errors = conform_to_schema(value, properties[name], f"{path}.{name}")
+            errors.extend(field_errors)
+        return conformed, errors
+    
+    if expected == 'ARRAY':
+        if not isinstance(data, list):
+            return [], [f"{path}: expected array"]
+        conformed = []
+        for position, item in enumerate(data):
+            value, item_errors = conform_to_schema(item, schema.get('items', {}), f"{path}[{position}]")
+            errors.extend(item_errors)
+            if value is not None:
+                conformed.append(value)
+        return conformed, errors
+    
+    if expected == 'STRING':
+        if isinstance(data, (int, float)) and not isinstance(data, bool):
+            return str(data), errors
+        valid = isinstance(data, str)
+    elif expected == 'NUMBER':
+        valid = isinstance(data, (int, float)) and not isinstance(data, bool)
+    elif expected == 'INTEGER':
+        valid = isinstance(data, int) and not isinstance(data, bool)
+    elif expected == 'BOOLEAN':
+        valid = isinstance(data, bool)
+    else:
+        valid = True
+    
+    if not valid:
+        return None, [f"{path}: expected {expected.lower()}"]
+    return data, errors
+
+
+def normalize_invoice_data(data):
+    """Map a parsed model JSON object onto the invoice dict returned by the extractors."""
+    return {
+        'vendor': data.get('vendor'),
+        'date': data.get('date'),
+        'total': data.get('total'),
+        'invoice_number': data.get('invoice_number'),
+        'tax': data.get('tax'),
+        'subtotal': data.get('subtotal'),
+        'summary': data.get('summary'),
+        'line_items': data.get('line_items', []),
+        '_ai_used': True,
+        '_method': 'gemini_vision'
+    }
+
+
+def split_pdf(file_bytes, pages_per_chunk=1):
+    """
+    Split a PDF into standalone PDFs of at most pages_per_chunk pages each.
+    
+    Args:
+        file_bytes (bytes-like): Raw PDF bytes
+        pages_per_chunk (int): Pages per output document
+    
+    Returns:
+        list: (first_page, last_page, pdf_bytes) tuples with 1-based page numbers,
+              or None if pypdf is not installed
+    """
+    try:
+        from pypdf import PdfReader, PdfWriter
+    except ImportError:
+        return None
+    
+    reader = PdfReader(io.BytesIO(file_bytes))
+    page_count = len(reader.pages)
+    chunks = []
+    for start in range(0, page_count, pages_per_chunk):
+        end = min(start + pages_per_chunk, page_count)
+        writer = PdfWriter()
+        for index in range(start, end):
+            writer.add_page(reader.pages[index])
+        buffer = io.BytesIO()
+        writer.write(buffer)
+        chunks.append((start + 1, end, buffer.getvalue()))
+    return chunks
+
+
+def merge_page_results(page_results):
+    """
+    Deterministically merge per-page extractions into one invoice.
+    
+    Header fields come from the first page that has them, line items are
+    concatenated in page order, and totals come from the last page that has them.
+    
+    Args:
+        page_results (list): Extraction dicts in page order
+    
+    Returns:
+        dict: Merged invoice data
+    """
+    def first(field):
+        return next((r.get(field) for r in page_results if r.get(field)), None)
+    
+    def last(field):
+        return next((r.get(field) for r in reversed(page_results) if r.get(field)), None)
+    
+    line_items = []
+    for r in page_results:
+        line_items.extend(r.get('line_items') or [])
+    
+    merged = {
+        'vendor': first('vendor'),
+        'date': first('date'),
+        'total': last('total'),
+        'invoice_number': first('invoice_number'),
+        'tax': last('tax'),
+        'subtotal': last('subtotal'),
+        'summary': first('summary'),
+        'line_items': line_items,
+        '_ai_used': True,
+        '_method': 'gemini_vision_pages'
+    }
+    usage = combine_usage(r.get('_usage') for r in page_results)
+    if usage:
+        merged['_usage'] = usage
+    return merged
+
+
+def extract_pdf_pages(file_bytes, api_key=None, client=None, cache=None, pages_per_chunk=1, max_concurrency=4,
+                      backend=None):
+    """
+    Extract a multi-page PDF by splitting it into page groups and extracting
+    them concurrently, so line items are not cut off by the per-call output
+    token limit and latency does not grow with page count.
+    
+    Falls back to a single whole-document call for one-page PDFs or when
+    pypdf is not installed.
+    
+    Args:
+        file_bytes (bytes-like): Raw PDF bytes
+        api_key (str, optional): Gemini API key (default: the client's key)
+        client (GeminiVisionClient, optional): Client to use (default: shared client)
+        cache (ExtractionCache, optional): Result cache (default: shared cache)
+        pages_per_chunk (int): Pages sent per Gemini call
+        max_concurrency (int): Max page groups extracted at once
+        backend (ExtractionBackend, optional): Backend to use (default: Gemini over client,
+            or the EXTRACTION_BACKEND backend when no client is given)
+    
+    Returns:
+        dict: Merged invoice data with _pages (per-group timings) and _timings
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    
+    backend = backend or get_extraction_backend(client)
+    started = time.perf_counter()
+    try:
+        chunks = split_pdf(file_bytes, pages_per_chunk)
+    except Exception as e:
+        logger.warning("Could not split PDF, sending whole document: %s", e)
+        chunks = None
+    split_ms = (time.perf_counter() - started) * 1000
+    
+    if not chunks or len(chunks) == 1:
+        return extract_with_gemini_vision(file_bytes, api_key, cache=cache, mime_type='application/pdf',
+                                          backend=backend)
+    
+    logger.debug("Extracting %d page groups (max %d concurrent)", len(chunks), max_concurrency)
+    
+    def extract_chunk(chunk):
+        first_page, last_page, chunk_bytes = chunk
+        chunk_started = time.perf_counter()
+        info = {'pages': [first_page, last_page]}
         try:
-            data = json.loads(generated_text)
-            print(f"✅ Successfully parsed invoice data")
+            data = extract_with_gemini_vision(chunk_bytes, api_key, cache=cache, mime_type='application/pdf',
+                                              backend=backend)
+        except Exception as e:
+            data = None
+            info['error'] = str(e)
+        info['elapsed_ms'] = round((time.perf_counter() - chunk_started) * 1000, 2)
+        return data, info
+    
+    extract_started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, max_concurrency)) as executor:
+        futures = [submit_in_context(executor, extract_chunk, chunk) for chunk in chunks]
+        outcomes = [future.result() for future in futures]
+    extract_ms = (time.perf_counter() - extract_started) * 1000
+    
+    page_results = [data for data, _ in outcomes if data is not None]
+    if not page_results:
+        raise Exception(f"All {len(chunks)} PDF page groups failed: {outcomes[0][1].get('error')}")
+    
+    merge_started = time.perf_counter()
+    result = merge_page_results(page_results)
+    merge_ms = (time.perf_counter() - merge_started) * 1000
+    
+    result['_pages'] = [info for _, info in outcomes]
+    result['_timings'] = {
+        'split_ms': round(split_ms, 2),
+        'extract_ms': round(extract_ms, 2),
+        'merge_ms': round(merge_ms, 2),
+        'total_ms': round((time.perf_counter() - started) * 1000, 2)
+    }
+    return result
+
+
+def read_pdf_text(file_bytes, max_chars=None):
+    """
+    Extract the embedded text layer of a PDF.
+    
+    When reading stops early at max_chars, the last page is read as well and
+    appended, since that is where totals usually are.
+    
+    Args:
+        file_bytes (bytes-like): Raw PDF bytes
+        max_chars (int, optional): Stop reading pages once this much text is collected
+    
+    Returns:
+        tuple: (text, pages_read, page_count), or None if pypdf is missing or the PDF cannot be read
+    """
+    try:
+        from pypdf import PdfReader
+    except ImportError:
+        return None
+    
+    try:
+        reader = PdfReader(io.BytesIO(file_bytes))
+        if reader.is_encrypted:
+            return None
+        page_count = len(reader.pages)
+        pages = []
+        length = 0
+        for page in reader.pages:
+            page_text = page.extract_text() or ''
+            pages.append(page_text)
+            length += len(page_text)
+            if max_chars and length > max_chars:
+                break
+        if len(pages) < page_count:
+            pages.append(reader.pages[-1].extract_text() or '')
+        return '\n'.join(pages), len(pages), page_count
+    except Exception as e:
+        logger.debug("Could not read PDF text layer: %s", e)
+        return None
+
+
+def pdf_text_is_usable(text, page_count, min_chars_per_page=200):
+    """
+    Decide whether a PDF text layer covers the document well enough to extract from.
+    
+    Scanned PDFs have little or no text; PDFs with broken font encodings
+    produce mostly symbols. Both go to the vision path instead.
+    
+    Args:
+        text (str): Text of the pages read
+        page_count (int): Number of pages text holds (pages_read from read_pdf_text)
+        min_chars_per_page (int): Minimum non-whitespace characters per page
+    """
+    stripped = ''.join(text.split())
+    if not page_count or len(stripped) < min_chars_per_page * page_count:
+        return False
+    readable = sum(1 for char in stripped if char.isalnum())
+    return readable / len(stripped) >= 0.5
+
+
+_CURRENCY_SYMBOLS = '$€£₹¥'
+_AMOUNT = rf"(?:[A-Z]{{3}}[ \t]?)?[{_CURRENCY_SYMBOLS}]?[ \t]?-?\d(?:[\d,.' ]*\d)?(?:[ \t]?[A-Z]{{3}}\b)?"
+_LABEL_GAP = rf"[ \t]*(?:\([^)\n]*\))?[^\n\d{_CURRENCY_SYMBOLS}]{{0,20}}?"
+
+# Strongest total label first; a plain "Total" line is the last resort
+_TOTAL_LABELS = [
+    r'grand[ \t]+total', r'amount[ \t]+due', r'total[ \t]+due', r'balance[ \t]+due',
+    r'invoice[ \t]+total', r'total[ \t]+amount', r'total'
+]
+_SUBTOTAL_PATTERN = re.compile(rf"(?im)^[ \t]*sub[ \t-]?total\b{_LABEL_GAP}({_AMOUNT})[ \t]*$")
+_TAX_PATTERN = re.compile(
+    rf"(?im)^[ \t]*(?:sales[ \t]+tax|tax|vat|gst|igst|cgst|sgst)\b{_LABEL_GAP}({_AMOUNT})[ \t]*$")
+_DATE_PATTERN = re.compile(
+    r"(?im)^[ \t]*(?:invoice[ \t]+date|date[ \t]+of[ \t]+issue|issue[ \t]+date|date)\b[ \t]*[:\-]?[ \t]*(.+?)[ \t]*$")
+_INVOICE_NUMBER_PATTERN = re.compile(
+    r"(?i)\binvoice[ \t]*(?:no\.?|number|num\.?|#)[ \t]*[:#]?[ \t]*([A-Z0-9][A-Z0-9\-/]*)")
+_VENDOR_LABEL_PATTERN = re.compile(
+    r"(?im)^[ \t]*(?:from|vendor|seller|supplier|billed[ \t]+by|bill[ \t]+from|sold[ \t]+by)[ \t]*:[ \t]*(.+?)[ \t]*$")
+_COMPANY_SUFFIX_PATTERN = re.compile(
+    r"(?i)\b(?:inc|llc|llp|ltd|limited|gmbh|corp|corporation|company|co|plc|pvt|pty|s\.?a|b\.?v|ag|srl|oy|ab)\b\.?\s*$")
+
+_MONTHS = {name: index for index, names in enumerate([
+    ('jan', 'january'), ('feb', 'february'), ('mar', 'march'), ('apr', 'april'), ('may',), ('jun', 'june'),
+    ('jul', 'july'), ('aug', 'august'), ('sep', 'sept', 'september'), ('oct', 'october'),
+    ('nov', 'november'), ('dec', 'december')
+], start=1) for name in names}
+
+
+def truncate_pdf_text(text, max_chars):
+    """
+    Cut a PDF text layer to max_chars, keeping its start and its end.
+    
+    The end carries the last page's totals; the middle (usually more line
+    items) is dropped and marked.
+    """
+    if len(text) <= max_chars:
+        return text
+    marker = '\n[...]\n'
+    tail = max_chars // 4
+    head = max(0, max_chars - tail - len(marker))
+    return text[:head] + marker + text[-tail:]
+
+
+def _parse_text_date(value):
+    """Return an unambiguous date string as YYYY-MM-DD, else None."""
+    import datetime
+    
+    def build(year, month, day):
+        try:
+            return datetime.date(int(year), int(month), int(day)).isoformat()
+        except ValueError:
+            return None
+    
+    match = re.search(r'\b(\d{4})-(\d{1,2})-(\d{1,2})\b', value)
+    if match:
+        return build(*match.groups())
+    
+    match = re.search(r'\b(\d{1,2})[/.\-](\d{1,2})[/.\-](\d{4})\b', value)
+    if match:
+        first, second, year = (int(g) for g in match.groups())
+        if first > 12 >= second:
+            return build(year, second, first)
+        if second > 12 >= first:
+            return build(year, first, second)
+        # 03/04/2024 could be either order
+        return None
+    
+    match = re.search(r'\b(\d{1,2})(?:st|nd|rd|th)?[ \-]([A-Za-z]{3,9})\.?,?[ \-](\d{4})\b', value)
+    if match and match.group(2).lower() in _MONTHS:
+        return build(match.group(3), _MONTHS[match.group(2).lower()], match.group(1))
+    
+    match = re.search(r'\b([A-Za-z]{3,9})\.?[ \-](\d{1,2})(?:st|nd|rd|th)?,?[ \-](\d{4})\b', value)
+    if match and match.group(1).lower() in _MONTHS:
+        return build(match.group(3), _MONTHS[match.group(1).lower()], match.group(2))
+    return None
+
+
+def parse_invoice_text(text):
+    """
+    Deterministically pull invoice fields out of a PDF text layer.
+    
+    Only labelled values are trusted: the total must sit on a "Total"/
+    "Amount due"-style line, the date must be labelled and unambiguous, and
+    the vendor must be labelled or the first line must end in a company
+    suffix. When subtotal and tax are found they must add up to the total.
+    
+    Args:
+        text (str): PDF text layer
+    
+    Returns:
+        tuple: (invoice dict, confident) - confident is True only when
+               vendor, date and total were all found and agree
+    """
+    def search(pattern):
+        match = pattern.search(text)
+        return match.group(1).strip() if match else None
+    
+    total = None
+    for label in _TOTAL_LABELS:
+        matches = re.findall(rf"(?im)^[ \t]*{label}\b{_LABEL_GAP}({_AMOUNT})[ \t]*$", text)
+        if matches:
+            total = matches[-1].strip()
+            break
+    
+    date = None
+    for match in _DATE_PATTERN.finditer(text):
+        date = _parse_text_date(match.group(1))
+        if date:
+            break
+    
+    vendor = search(_VENDOR_LABEL_PATTERN)
+    if not vendor:
+        lines = [line.strip() for line in text.splitlines() if line.strip()]
+        for line in lines[:5]:
+            if len(line) <= 80 and _COMPANY_SUFFIX_PATTERN.search(line):
+                vendor = line
+                break
+    
+    subtotal = search(_SUBTOTAL_PATTERN)
+    tax = search(_TAX_PATTERN)
+    
+    consistent = True
+    if total and subtotal and tax:
+        amounts = normalize_amounts({'total': total, 'subtotal': subtotal, 'tax': tax})
+        values = [amounts['subtotal_minor'], amounts['tax_minor'], amounts['total_minor']]
+        if None not in values:
+            consistent = abs(values[0] + values[1] - values[2]) <= max(1, abs(values[2]) // 200)
+    
+    data = {
+        'vendor': vendor,
+        'date': date,
+        'total': total,
+        'invoice_number': search(_INVOICE_NUMBER_PATTERN),
+        'tax': tax,
+        'subtotal': subtotal,
+        'summary': None,
+        'line_items': []
+    }
+    return data, bool(vendor and date and total and consistent)
+
+
+def extract_pdf_text(file_bytes, api_key=None, client=None, cache=None, backend=None, mode=None):
+    """
+    Fast path for digital PDFs: extract from the embedded text layer instead
+    of sending the file to the vision model.
+    
+    In 'parse' mode a confident deterministic parse skips the model
+    entirely; otherwise (or in 'prompt' mode) only the text is sent, which
+    is a fraction of the base64-encoded PDF. Text longer than
+    PDF_TEXT_MAX_CHARS is cut with truncate_pdf_text. Results are tagged
+    _method='pdf_text'.
+    
+    Args:
+        file_bytes (bytes-like): Raw PDF bytes
+        api_key (str, optional): Per-call credential override
+        client (GeminiVisionClient, optional): Client to use (default: shared client)
+        cache (ExtractionCache, optional): Result cache (default: shared cache)
+        backend (ExtractionBackend, optional): Backend to use (default: Gemini over client,
+            or the EXTRACTION_BACKEND backend when no client is given)
+        mode (str, optional): 'prompt' or 'parse' (default: PDF_TEXT_MODE)
+    
+    Returns:
+        dict or None: Invoice data, or None when the PDF has no usable text
+                      layer and should go through the regular path
+    """
+    backend = backend or get_extraction_backend(client)
+    mode = mode or PDF_TEXT_MODE
+    cache = cache or get_extraction_cache()
+    
+    cache_key, cached = cached_extraction(cache, file_bytes, backend.model,
+                                          f"text-{mode}-{TEXT_PROMPT_VERSION}-{extraction_prompt_version()}")
+    if cached is not None:
+        return cached
+    
+    with stage('preprocess'):
+        extracted = read_pdf_text(file_bytes, max_chars=PDF_TEXT_MAX_CHARS)
+    if extracted is None:
+        return None
+    text, pages_read, page_count = extracted
+    if not pdf_text_is_usable(text, pages_read, PDF_TEXT_MIN_CHARS_PER_PAGE):
+        logger.debug("PDF text layer not usable (%d chars, %d of %d pages)", len(text), pages_read, page_count)
+        return None
+    truncated = len(text) > PDF_TEXT_MAX_CHARS
+    text = truncate_pdf_text(text, PDF_TEXT_MAX_CHARS)
+    
+    info = {'pages': page_count, 'chars': len(text), 'file_bytes': len(file_bytes)}
+    if truncated:
+        info.update(truncated=True, pages_read=pages_read)
+    result = None
+    if mode == 'parse':
+        with stage('parse'):
+            data, confident = parse_invoice_text(text)
+        if confident:
+            with stage('normalize'):
+                result = normalize_invoice_data(data)
+            result['_ai_used'] = False
+            info['source'] = 'parser'
+    
+    if result is None:
+        if not backend.supports_text():
+            return None
+        result = backend.extract_text(text, api_key=api_key)
+        info['source'] = 'prompt'
+    
+    result['_method'] = 'pdf_text'
+    result['_pdf_text'] = info
+    if cache is not None:
+        cache.put(cache_key, result)
+    return result
+
+
+def extract_packed_invoices(items, api_key=None, client=None, cache=None, preprocessor=None):
+    """
+    Extract several small invoice images with a single generateContent call.
+    
+    The model returns a JSON array keyed by image index, which is
+    demultiplexed back to the input order. Images missing from the array, or
+    the whole pack if the call or the array is malformed, come back as None
+    so the caller can fall back to single-file extraction.
+    
+    Args:
+        items (list): (file_bytes, mime_type) tuples
+        api_key (str, optional): Gemini API key (default: the client's key)
+        client (GeminiVisionClient, optional): Client to use (default: shared client)
+        cache (ExtractionCache, optional): Result cache (default: shared cache)
+        preprocessor (ImagePreprocessor, optional): Image pre-processing stage (default: shared)
+    
+    Returns:
+        list: Invoice dict or None for each item, in input order
+    """
+    client = client or get_gemini_client()
+    cache = cache or get_extraction_cache()
+    preprocessor = preprocessor or get_image_preprocessor()
+    results = [None] * len(items)
+    
+    # Serve cache hits first and only pack the rest. A single-file result is
+    # as good as a packed one, so it is used too; packed results are only
+    # stored under the packed key.
+    pending = []
+    for position, (file_bytes, mime_type) in enumerate(items):
+        cache_key, cached = cached_extraction(cache, file_bytes, client.model, f"packed-{PACKED_PROMPT_VERSION}",
+                                              extraction_prompt_version())
+        if cached is not None:
+            results[position] = cached
+            continue
+        pending.append((position, cache_key, file_bytes, mime_type))
+    
+    if not pending:
+        return results
+    
+    parts = [{"text": PACKED_EXTRACTION_PROMPT}]
+    for index, (_, _, file_bytes, mime_type) in enumerate(pending):
+        file_bytes, mime_type, _ = preprocessor.process(file_bytes, mime_type)
+        parts.append({"text": f"Image {index}:"})
+        parts.append({"inline_data": {"mime_type": mime_type, "data": file_bytes}})
+    
+    payload = StreamingJSONBody({
+        "contents": [{"parts": parts}],
+        "generationConfig": generation_config(False, min(8192, 2048 * len(pending)))
+    })
+    
+    logger.debug("Sending %d packed images to Gemini Vision API (model: %s)", len(pending), client.model)
+    started = time.perf_counter()
+    try:
+        response = client.generate_content(payload, api_key=api_key)
+        latency = time.perf_counter() - started
+        body = read_response_json(response)
+        entries = json.loads(generated_text_from(body))
+    except Exception as e:
+        logger.warning("Packed extraction failed, falling back to single-file calls: %s", e)
+        return results
+    
+    if not isinstance(entries, list):
+        logger.warning("Packed extraction returned %s, expected a list", type(entries).__name__)
+        return results
+    
+    by_index = {}
+    conflicted = set()
+    for entry in entries:
+        if not isinstance(entry, dict):
+            continue
+        index = entry.get('index')
+        if not isinstance(index, int) or not 0 <= index < len(pending):
+            continue
+        if index in by_index:
+            # Duplicate index - the model confused images, so trust neither
+            conflicted.add(index)
+        by_index[index] = entry
+    
+    for index, entry in by_index.items():
+        if index in conflicted:
+            continue
+        result = normalize_invoice_data(entry)
+        result['_method'] = 'gemini_vision_packed'
+        usage = usage_from_response(body)
+        if usage:
+            result['_usage'] = usage
+        record_call_usage(result, latency, len(payload), shared_by=len(pending))
+        results[pending[index][0]] = result
+    
+    for position, cache_key, _, _ in pending:
+        if results[position] is not None and cache is not None:
+            cache.put(cache_key, results[position])
+    
+    missing = sum(1 for position, _, _, _ in pending if results[position] is None)
+    if missing:
+        logger.warning("%d of %d packed images missing from response", missing, len(pending))
+    return results
+
+
+class AsyncGeminiVisionClient(GeminiClientBase):
+    """
+    asyncio counterpart of GeminiVisionClient built on httpx.AsyncClient.
+    
+    One instance can keep hundreds of requests in flight on a single event
+    loop over a bounded connection pool. The underlying httpx client is bound
+    to the loop it is first used on; call aclose() before the loop exits.
+    Takes the GeminiClientBase arguments; pool_size bounds concurrent connections.
+    """
+    
+    DEFAULT_POOL_SIZE = 100
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._http = None
+    
+    @property
+    def http(self):
+        """Lazily created httpx.AsyncClient (requires the optional httpx dependency)."""
+        if self._http is None:
+            import httpx
+            self._http = httpx.AsyncClient(
+                limits=httpx.Limits(max_connections=self.pool_size, max_keepalive_connections=self.pool_size),
+                timeout=httpx.Timeout(self.read_timeout, connect=self.connect_timeout)
+            )
+        return self._http
+    
+    async def generate_content(self, payload, api_key=None):
+        """
+        POST a generateContent payload with the same rate limiting, retries,
+        hedging and circuit breaking as GeminiVisionClient.generate_content.
+        
+        Args:
+            payload (dict or StreamingJSONBody): Request payload; StreamingJSONBody is
+                streamed chunk by chunk with an explicit Content-Length
+            api_key (str, optional): Override the client's API key
+        """
+        url = self.generate_content_url(api_key)
+        breaker = self.circuit_breaker
+        token = breaker.before_request() if breaker is not None else None
+        
+        try:
+            response = await self._generate_with_retries(url, payload)
+        except BaseException:
+            # Includes cancellation (e.g. asyncio.wait_for), so a half-open probe is always released
+            if breaker is not None:
+                breaker.record(False, token)
+            raise
+        if breaker is not None:
+            breaker.record(response.status_code < 500, token)
+        return response
+    
+    async def _generate_with_retries(self, url, payload):
+        limiter = self.rate_limiter
+        attempt = 0
+        while True:
+            response = await self._post_hedged(url, payload)
+            if limiter is None or not limiter.should_retry(response.status_code, attempt):
+                return response
+            retry_after = parse_retry_after(response.headers.get('Retry-After'))
+            await asyncio.sleep(limiter.backoff_delay(attempt, retry_after))
+            attempt += 1
+    
+    async def _post_hedged(self, url, payload):
+        """Send one attempt, racing a duplicate if it outlives the hedging percentile."""
+        hedge_after = self.hedging.hedge_delay() if self.hedging else None
+        if hedge_after is None:
+            return await self._timed_post(url, payload)
+        
+        primary = asyncio.ensure_future(self._timed_post(url, payload))
+        done, _ = await asyncio.wait([primary], timeout=hedge_after)
+        limiter = self.rate_limiter
+        if done or (limiter is not None and limiter.try_acquire() > 0):
+            return await primary
+        
+        hedge = asyncio.ensure_future(self._timed_post(url, payload, True))
+        done, _ = await asyncio.wait([primary, hedge], return_when=asyncio.FIRST_COMPLETED)
+        winner = hedge if hedge in done and primary not in done else primary
+        loser = primary if winner is hedge else hedge
+        
+        if winner.exception() is not None:
+            winner, loser = loser, winner
+        else:
+            loser.cancel()
+        self.hedging.record(winner is hedge)
+        return await winner
+    
+    async def _timed_post(self, url, payload, acquired=False):
+        """Send one HTTP attempt through the rate limiter, recording its latency."""
+        limiter = self.rate_limiter
+        if limiter is not None and not acquired:
+            await limiter.acquire_async()
+        started = time.perf_counter()
+        try:
+            response = await self._post(url, payload)
+        except asyncio.CancelledError:
+            # A cancelled losing hedge (or abandoned call) says nothing about upstream health
+            if limiter is not None:
+                limiter.release(cancelled=True)
+            raise
+        except BaseException:
+            if limiter is not None:
+                limiter.release(None)
+            raise
+        self.latency.observe(time.perf_counter() - started)
+        if limiter is not None:
+            limiter.release(response.status_code, parse_retry_after(response.headers.get('Retry-After')))
+        return response
+    
+    async def _post(self, url, payload):
+        if isinstance(payload, StreamingJSONBody):
+            payload.seek(0)
             
-            return {
-                'vendor': data.get('vendor'),
-                'date': data.get('date'),
-                'total': data.get('total'),
-                'invoice_number': data.get('invoice_number'),
-                'tax': data.get('tax'),
-                'subtotal': data.get('subtotal'),
-                'summary': data.get('summary'),
-                'line_items': data.get('line_items', []),
-                '_ai_used': True,
-                '_method': 'gemini_vision'
-            }
-        except json.JSONDecodeError as e:
-            print(f"❌ Failed to parse JSON response: {str(e)}")
-            print(f"Raw response: {generated_text[:500]}...")
-            raise Exception(f"Invalid JSON response from Gemini: {str(e)}")
+            async def body():
+                for chunk in payload:
+                    yield chunk
+            
+            headers = {'Content-Type': 'application/json', 'Content-Length': str(len(payload))}
+            return await self.http.post(url, content=body(), headers=headers)
+        return await self.http.post(url, json=payload)
     
-    print("❌ No candidates in Gemini response")
-    raise Exception("No valid response from Gemini Vision API")
+    async def aclose(self):
+        """Close all pooled connections."""
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
+
+
+async def extract_invoice_data_async(source, client, cache=None, mime_type=None, preprocessor=None):
+    """
+    Async version of extract_invoice_data; never raises, errors are returned in the dict.
+    
+    Args:
+        source: Invoice file path, bytes/bytearray/memoryview, or file-like object
+        client (AsyncGeminiVisionClient): Async client to use
+        cache (ExtractionCache, optional): Result cache (default: shared cache)
+        mime_type (str, optional): Mime type of in-memory sources (default: guessed from file name)
+        preprocessor (ImagePreprocessor, optional): Image pre-processing stage (default: shared)
+    
+    Returns:
+        dict: Dictionary containing vendor, date, total, and other invoice fields
+    """
+    if not client.api_key:
+        return {
+            'vendor': None,
+            'date': None,
+            'total': None,
+            'error': 'GEMINI_API_KEY environment variable not set'
+        }
+    
+    try:
+        return await extract_with_gemini_vision_async(source, client, cache=cache, mime_type=mime_type,
+                                                      preprocessor=preprocessor)
+    except Exception as e:
+        logger.exception("Gemini Vision extraction failed: %s", e)
+        return {
+            'vendor': None,
+            'date': None,
+            'total': None,
+            'error': f'Gemini Vision API failed: {str(e)}'
+        }
+
+
+async def extract_with_gemini_vision_async(source, client, cache=None, mime_type=None, preprocessor=None):
+    """
+    Async version of extract_with_gemini_vision with the same caching,
+    pre-processing and response validation. File reads and image
+    pre-processing run in worker threads so the event loop is never blocked.
+    
+    Args:
+        source: Image file path, bytes/bytearray/memoryview, or file-like object
+        client (AsyncGeminiVisionClient): Async client to use
+        cache (ExtractionCache, optional): Result cache (default: shared cache)
+        mime_type (str, optional): Mime type of in-memory sources (default: guessed from file name)
+        preprocessor (ImagePreprocessor, optional): Image pre-processing stage (default: shared)
+    
+    Returns:
+        dict: Extracted invoice data with all fields
+    """
+    cache = cache or get_extraction_cache()
+    
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        file_bytes, mime_type = load_invoice_source(source, mime_type)
+    else:
+        file_bytes, mime_type = await asyncio.to_thread(load_invoice_source, source, mime_type)
+    
+    cache_key, cached = cached_extraction(cache, file_bytes, client.model, extraction_prompt_version())
+    if cached is not None:
+        return cached
+    
+    preprocessor = preprocessor or get_image_preprocessor()
+    file_bytes, mime_type, preprocess_report = await asyncio.to_thread(preprocessor.process, file_bytes, mime_type)
+    
+    payload = build_extraction_payload(file_bytes, mime_type)
+    started = time.perf_counter()
+    response = await client.generate_content(payload)
+    latency = time.perf_counter() - started
+    result = parse_extraction_response(response)
+    record_call_usage(result, latency, len(payload))
+    if preprocess_report:
+        result['_preprocessing'] = preprocess_report
+    
+    if cache is not None:
+        cache.put(cache_key, result)
+    return result
+
+
+async def extract_invoices_async(sources, client=None, max_concurrency=100, cache=None, preprocessor=None):
+    """
+    Extract many invoices on one event loop with at most max_concurrency in flight.
+    
+    Args:
+        sources (list): File paths, byte buffers, file-like objects, or (source, mime_type) tuples
+        client (AsyncGeminiVisionClient, optional): Client to use (default: a new client, closed on return)
+        max_concurrency (int): Max extractions in flight at once
+        cache (ExtractionCache, optional): Result cache (default: shared cache)
+        preprocessor (ImagePreprocessor, optional): Image pre-processing stage (default: shared)
+    
+    Returns:
+        list: Invoice dicts in input order (failures carry an 'error' key)
+    """
+    owns_client = client is None
+    if owns_client:
+        latency, hedging, circuit_breaker = get_resilience_settings()
+        client = AsyncGeminiVisionClient(pool_size=max_concurrency, rate_limiter=get_rate_limiter(),
+                                         hedging=hedging, circuit_breaker=circuit_breaker, latency=latency)
+    semaphore = asyncio.Semaphore(max_concurrency)
+    
+    async def run(item):
+        source, mime_type = item if isinstance(item, tuple) else (item, None)
+        async with semaphore:
+            return await extract_invoice_data_async(source, client, cache=cache, mime_type=mime_type,
+                                                    preprocessor=preprocessor)
+    
+    try:
+        return await asyncio.gather(*(run(item) for item in sources))
+    finally:
+        if owns_client:
+            await client.aclose()
+
 
+def run_async_batch(sources, max_concurrency=100, **kwargs):
+    """Synchronous entry point for backfills: run extract_invoices_async on a fresh event loop."""
+    return asyncio.run(extract_invoices_async(sources, max_concurrency=max_concurrency, **kwargs))
@@ -0,0 +1,275 @@
+"""
+Gemini Rate Limiter
+Shared token bucket, concurrency limit and retry policy for Gemini API calls.
+"""
+
+import os
+import time
+import random
+import asyncio
+import threading
+from collections import deque
+from email.utils import parsedate_to_datetime
+
+
+# Responses worth retrying; 429/503 also mean "slow down" and shrink the request rate
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+THROTTLE_STATUS_CODES = {429, 503}
+
+
+def parse_retry_after(value):
+    """
+    Parse a Retry-After header (delta-seconds or HTTP-date).
+    
+    Returns:
+        float or None: Seconds to wait
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class GeminiRateLimiter:
+    """
+    Adaptive limiter shared by every Gemini call in the process.
+    
+    Requests must take a token from a bucket refilled at the current rate and
+    a concurrency slot. The rate adapts AIMD-style: throttling responses
+    (429/503) halve it, while successes add back a fixed step up to the
+    ceiling as long as the recent error rate stays low. A Retry-After header
+    pauses the whole bucket, not just the caller that saw it.
+    
+    Without a configured ceiling the limiter does not limit until Gemini
+    throttles: the first 429/503 starts the bucket at half the rate actually
+    sent over the last minute, and once the rate has grown back to that
+    level requests flow unlimited again.
+    """
+    
+    def __init__(self, requests_per_minute=None, max_concurrent=None, min_requests_per_minute=6,
+                 max_retries=3, base_delay=1.0, max_delay=30.0, window_size=20,
+                 error_rate_threshold=0.1, decrease_factor=0.5, decrease_cooldown=1.0):
+        """
+        Args:
+            requests_per_minute (float, optional): Rate ceiling for the token bucket
+                (None: unlimited until throttled)
+            max_concurrent (int, optional): Max requests in flight at once (None: no cap)
+            min_requests_per_minute (float): Floor the adaptive rate never drops below
+            max_retries (int): Retries for 429/5xx responses before giving up
+            base_delay (float): First backoff delay in seconds
+            max_delay (float): Backoff cap in seconds
+            window_size (int): Recent outcomes used to compute the error rate
+            error_rate_threshold (float): Rate only grows while errors stay below this fraction
+            decrease_factor (float): Multiplier applied to the rate on throttling
+            decrease_cooldown (float): Min seconds between decreases, so one burst of 429s counts once
+        """
+        self.max_rate = float(requests_per_minute) if requests_per_minute else None
+        self.min_rate = float(min(min_requests_per_minute, self.max_rate or min_requests_per_minute))
+        self.max_concurrent = max_concurrent or None
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.error_rate_threshold = error_rate_threshold
+        self.decrease_factor = decrease_factor
+        self.decrease_cooldown = decrease_cooldown
+        
+        # rate is None while unlimited; _recovery_rate is where an unlimited limiter lets go again
+        self.rate = self.max_rate
+        self._recovery_rate = None
+        self._set_ceiling(self.max_rate)
+        self._tokens = self.burst
+        self._sent = deque(maxlen=10000)
+        self._last_refill = time.monotonic()
+        self._blocked_until = 0.0
+        self._last_decrease = 0.0
+        self._in_flight = 0
+        self._outcomes = deque(maxlen=window_size)
+        self._counters = {'requests': 0, 'throttled': 0, 'errors': 0, 'retries': 0}
+        self._condition = threading.Condition()
+    
+    def _set_ceiling(self, rate):
+        """Size the increase step and burst for a rate ceiling (None: unlimited). Caller holds the lock."""
+        self.increase_step = max(1.0, rate / 20) if rate else None
+        burst = rate / 60 if rate else 1.0
+        if self.max_concurrent is not None:
+            burst = min(self.max_concurrent, burst)
+        self.burst = max(1.0, burst)
+    
+    def _sent_per_minute(self, now):
+        """Requests sent over the last minute (or since the first one), per minute. Caller holds the lock."""
+        while self._sent and self._sent[0] < now - 60:
+            self._sent.popleft()
+        if not self._sent:
+            return self.min_rate
+        window = max(1.0, now - self._sent[0])
+        return len(self._sent) * 60 / window
+    
+    def _refill(self, now):
+        """Add tokens for the time elapsed since the last refill. Caller holds the lock."""
+        elapsed = now - self._last_refill
+        self._last_refill = now
+        if self.rate is not None:
+            self._tokens = min(self.burst, self._tokens + elapsed * self.rate / 60)
+    
+    def try_acquire(self):
+        """
+        Take a token and a concurrency slot if both are available.
+        
+        Returns:
+            float: 0 if acquired, otherwise seconds to wait before trying again
+        """
+        with self._condition:
+            now = time.monotonic()
+            if now < self._blocked_until:
+                return self._blocked_until - now
+            if self.max_concurrent is not None and self._in_flight >= self.max_concurrent:
+                return 0.05
+            self._refill(now)
+            if self.rate is not None:
+                if self._tokens < 1:
+                    return (1 - self._tokens) * 60 / self.rate
+                self._tokens -= 1
+            self._sent.append(now)
+            self._in_flight += 1
+            self._counters['requests'] += 1
+            return 0
+    
+    def acquire(self):
+        """Block the calling thread until a request may be sent."""
+        while True:
+            wait = self.try_acquire()
+            if wait <= 0:
+                return
+            with self._condition:
+                self._condition.wait(timeout=wait)
+    
+    async def acquire_async(self):
+        """Wait on the event loop until a request may be sent."""
+        while True:
+            wait = self.try_acquire()
+            if wait <= 0:
+                return
+            await asyncio.sleep(wait)
+    
+    def release(self, status_code=None, retry_after=None, cancelled=False):
+        """
+        Return the concurrency slot and feed the outcome into the adaptive rate.
+        
+        Args:
+            status_code (int, optional): HTTP status, or None for a transport error
+            retry_after (float, optional): Parsed Retry-After seconds
+            cancelled (bool): The request was abandoned by the caller (e.g. a losing
+                hedge); only the slot is returned and no outcome is recorded
+        """
+        with self._condition:
+            now = time.monotonic()
+            self._in_flight = max(0, self._in_flight - 1)
+            if cancelled:
+                self._condition.notify_all()
+                return
+            
+            failed = status_code is None or status_code in RETRY_STATUS_CODES
+            self._outcomes.append(failed)
+            if failed:
+                self._counters['errors'] += 1
+            
+            if status_code in THROTTLE_STATUS_CODES:
+                self._counters['throttled'] += 1
+                if now - self._last_decrease >= self.decrease_cooldown:
+                    if self.rate is None:
+                        # First throttle without a ceiling: start from what was actually being sent
+                        self._recovery_rate = self._sent_per_minute(now)
+                        self._set_ceiling(self._recovery_rate)
+                        self.rate = self._recovery_rate
+                        self._tokens = 0
+                    self.rate = max(self.min_rate, self.rate * self.decrease_factor)
+                    self._tokens = min(self._tokens, 0)
+                    self._last_decrease = now
+                if retry_after:
+                    self._blocked_until = max(self._blocked_until, now + retry_after)
+            elif not failed and self.rate is not None and self.error_rate() < self.error_rate_threshold:
+                self.rate += self.increase_step
+                if self.max_rate is not None:
+                    self.rate = min(self.max_rate, self.rate)
+                elif self.rate >= self._recovery_rate:
+                    self.rate = None
+                    self._set_ceiling(None)
+            
+            self._condition.notify_all()
+    
+    def error_rate(self):
+        """Fraction of failed requests in the recent window."""
+        if not self._outcomes:
+            return 0.0
+        return sum(self._outcomes) / len(self._outcomes)
+    
+    def should_retry(self, status_code, attempt):
+        """Whether a response with this status should be retried after `attempt` retries."""
+        return status_code in RETRY_STATUS_CODES and attempt < self.max_retries
+    
+    def backoff_delay(self, attempt, retry_after=None):
+        """
+        Exponential backoff with full jitter, never shorter than Retry-After.
+        
+        Args:
+            attempt (int): Zero-based retry number
+            retry_after (float, optional): Parsed Retry-After seconds
+        """
+        with self._condition:
+            self._counters['retries'] += 1
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.max_delay))
+        return delay
+    
+    def state(self):
+        """Return the limiter's current rate, in-flight count and counters."""
+        with self._condition:
+            now = time.monotonic()
+            self._refill(now)
+            state = dict(self._counters)
+            state.update({
+                'requests_per_minute': round(self.rate, 2) if self.rate is not None else None,
+                'max_requests_per_minute': self.max_rate,
+                'min_requests_per_minute': self.min_rate,
+                'tokens': round(self._tokens, 2) if self.rate is not None else None,
+                'in_flight': self._in_flight,
+                'max_concurrent': self.max_concurrent,
+                'blocked_for': round(max(0.0, self._blocked_until - now), 2),
+                'error_rate': round(self.error_rate(), 3),
+                'max_retries': self.max_retries
+            })
+            return state
+
+
+_default_limiter = None
+_default_limiter_lock = threading.Lock()
+
+
+def get_rate_limiter():
+    """
+    Return the process-wide GeminiRateLimiter, or None when disabled.
+    
+    Configured once from GEMINI_RATE_LIMIT (true/false), GEMINI_RPM,
+    GEMINI_MAX_CONCURRENT and GEMINI_MAX_RETRIES. GEMINI_RPM and
+    GEMINI_MAX_CONCURRENT are unset by default, so calls are only slowed
+    down after Gemini throttles them.
+    """
+    global _default_limiter
+    if os.environ.get('GEMINI_RATE_LIMIT', 'true').lower() != 'true':
+        return None
+    if _default_limiter is None:
+        with _default_limiter_lock:
+            if _default_limiter is None:
+                _default_limiter = GeminiRateLimiter(
+                    requests_per_minute=float(os.environ.get('GEMINI_RPM') or 0),
+                    max_concurrent=int(os.environ.get('GEMINI_MAX_CONCURRENT') or 0),
+                    max_retries=int(os.environ.get('GEMINI_MAX_RETRIES', '3'))
+                )
+    return _default_limiter
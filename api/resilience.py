@@ -0,0 +1,280 @@
+"""
+Gemini Tail-Latency Controls
+Latency histogram, hedged-request policy and circuit breaker for Gemini API calls.
+"""
+
+import os
+import time
+import bisect
+import threading
+from collections import deque
+
+
+class LatencyHistogram:
+    """
+    Thread-safe latency recorder.
+    
+    Keeps cumulative counts in fixed millisecond buckets for reporting, plus
+    a window of the most recent samples so percentiles track current
+    upstream behaviour rather than the whole process lifetime.
+    """
+    
+    BUCKETS_MS = (50, 100, 250, 500, 1000, 2000, 4000, 8000, 15000, 30000, 60000)
+    
+    def __init__(self, window_size=500):
+        """
+        Args:
+            window_size (int): Recent samples used for percentiles
+        """
+        self._counts = [0] * (len(self.BUCKETS_MS) + 1)
+        self._recent = deque(maxlen=window_size)
+        self._total = 0
+        self._lock = threading.Lock()
+    
+    def observe(self, seconds):
+        """Record one call's latency in seconds."""
+        ms = seconds * 1000
+        with self._lock:
+            self._counts[bisect.bisect_left(self.BUCKETS_MS, ms)] += 1
+            self._recent.append(ms)
+            self._total += 1
+    
+    def percentile(self, pct):
+        """
+        Return the pct-th percentile of recent latency in seconds.
+        
+        Returns:
+            float or None: None when no samples have been recorded
+        """
+        with self._lock:
+            samples = sorted(self._recent)
+        if not samples:
+            return None
+        index = min(len(samples) - 1, max(0, int(round(pct / 100 * len(samples))) - 1))
+        return samples[index] / 1000
+    
+    def sample_count(self):
+        """Number of samples in the recent window."""
+        with self._lock:
+            return len(self._recent)
+    
+    def snapshot(self):
+        """Return bucket counts and recent p50/p95/p99 in ms."""
+        with self._lock:
+            counts = list(self._counts)
+            total = self._total
+        buckets = {f"le_{bound}ms": count for bound, count in zip(self.BUCKETS_MS, counts)}
+        buckets['gt_60000ms'] = counts[-1]
+        summary = {'count': total, 'buckets': buckets}
+        for pct in (50, 95, 99):
+            value = self.percentile(pct)
+            summary[f"p{pct}_ms"] = round(value * 1000, 1) if value is not None else None
+        return summary
+
+
+class HedgingPolicy:
+    """
+    Decides when to fire a duplicate (hedged) request.
+    
+    Once a call has been outstanding longer than the configured percentile
+    of recent latency, a second identical request is sent and whichever
+    finishes first wins. Hedging stays off until enough samples exist.
+    """
+    
+    def __init__(self, histogram, percentile=95, min_samples=20, min_delay=0.5):
+        """
+        Args:
+            histogram (LatencyHistogram): Source of recent latency
+            percentile (float): Latency percentile after which a hedge is fired
+            min_samples (int): Samples required before hedging starts
+            min_delay (float): Never hedge earlier than this many seconds
+        """
+        self.histogram = histogram
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.min_delay = min_delay
+        self._counters = {'hedged': 0, 'hedge_wins': 0}
+        self._lock = threading.Lock()
+    
+    def hedge_delay(self):
+        """
+        Seconds to wait on the primary request before hedging.
+        
+        Returns:
+            float or None: None when there is not enough data to hedge
+        """
+        if self.histogram.sample_count() < self.min_samples:
+            return None
+        return max(self.min_delay, self.histogram.percentile(self.percentile))
+    
+    def record(self, hedge_won):
+        """Count a fired hedge and whether it beat the primary."""
+        with self._lock:
+            self._counters['hedged'] += 1
+            if hedge_won:
+                self._counters['hedge_wins'] += 1
+    
+    def state(self):
+        """Return hedging settings and counters."""
+        with self._lock:
+            state = dict(self._counters)
+        delay = self.hedge_delay()
+        state.update({
+            'percentile': self.percentile,
+            'min_samples': self.min_samples,
+            'hedge_after_ms': round(delay * 1000, 1) if delay is not None else None
+        })
+        return state
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling Gemini while the circuit breaker is open."""
+
+
+class CircuitBreaker:
+    """
+    Fails fast when the upstream error rate crosses a threshold.
+    
+    Closed: calls pass through and outcomes are tracked in a sliding window.
+    Open: calls raise CircuitOpenError until reset_timeout has elapsed.
+    Half-open: a single probe call is let through; success closes the
+    circuit, failure re-opens it.
+    
+    Every transition starts a new generation. before_request returns the
+    current one as a token and record ignores outcomes from earlier
+    generations, so a slow call sent before the circuit opened cannot
+    close or re-open it in place of the probe.
+    """
+    
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+    
+    def __init__(self, error_rate_threshold=0.5, min_requests=10, window_size=50, reset_timeout=30.0):
+        """
+        Args:
+            error_rate_threshold (float): Error fraction in the window that opens the circuit
+            min_requests (int): Outcomes required in the window before it can open
+            window_size (int): Recent outcomes considered
+            reset_timeout (float): Seconds to stay open before allowing a probe
+        """
+        self.error_rate_threshold = error_rate_threshold
+        self.min_requests = min_requests
+        self.reset_timeout = reset_timeout
+        self.state_name = self.CLOSED
+        self._outcomes = deque(maxlen=window_size)
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._generation = 0
+        self._counters = {'rejected': 0, 'opened': 0}
+        self._lock = threading.Lock()
+    
+    def before_request(self):
+        """
+        Raise CircuitOpenError if the call should not be sent.
+        
+        Returns:
+            int: Token to pass to record with this call's outcome
+        """
+        with self._lock:
+            if self.state_name == self.OPEN:
+                remaining = self._opened_at + self.reset_timeout - time.monotonic()
+                if remaining > 0:
+                    self._counters['rejected'] += 1
+                    raise CircuitOpenError(
+                        f"Gemini API circuit open after {self._error_rate():.0%} recent errors; "
+                        f"retrying in {remaining:.0f}s"
+                    )
+                self.state_name = self.HALF_OPEN
+                self._generation += 1
+            if self.state_name == self.HALF_OPEN:
+                if self._probe_in_flight:
+                    self._counters['rejected'] += 1
+                    raise CircuitOpenError("Gemini API circuit half-open; waiting on probe request")
+                self._probe_in_flight = True
+            return self._generation
+    
+    def record(self, success, token):
+        """
+        Feed one call's outcome into the breaker.
+        
+        Args:
+            success (bool): Whether the call succeeded
+            token (int): What before_request returned for the call
+        """
+        with self._lock:
+            if token != self._generation:
+                # Sent before the last transition; says nothing about the current state
+                return
+            if self.state_name == self.HALF_OPEN:
+                self._probe_in_flight = False
+                if success:
+                    self.state_name = self.CLOSED
+                    self._generation += 1
+                    self._outcomes.clear()
+                else:
+                    self._open()
+                return
+            
+            self._outcomes.append(not success)
+            if (self.state_name == self.CLOSED and len(self._outcomes) >= self.min_requests
+                    and self._error_rate() >= self.error_rate_threshold):
+                self._open()
+    
+    def _open(self):
+        """Trip the breaker. Caller holds the lock."""
+        self.state_name = self.OPEN
+        self._generation += 1
+        self._opened_at = time.monotonic()
+        self._counters['opened'] += 1
+    
+    def _error_rate(self):
+        if not self._outcomes:
+            return 0.0
+        return sum(self._outcomes) / len(self._outcomes)
+    
+    def state(self):
+        """Return the breaker state, error rate and counters."""
+        with self._lock:
+            state = dict(self._counters)
+            state.update({
+                'state': self.state_name,
+                'error_rate': round(self._error_rate(), 3),
+                'error_rate_threshold': self.error_rate_threshold,
+                'window': len(self._outcomes)
+            })
+            return state
+
+
+def get_resilience_settings():
+    """
+    Build the latency histogram, hedging policy and circuit breaker for the
+    shared Gemini client from environment variables.
+    
+    GEMINI_HEDGE (default false), GEMINI_HEDGE_PERCENTILE and
+    GEMINI_HEDGE_MIN_SAMPLES tune hedging; GEMINI_CIRCUIT_BREAKER (default
+    true), GEMINI_BREAKER_ERROR_RATE, GEMINI_BREAKER_MIN_REQUESTS and
+    GEMINI_BREAKER_RESET_TIMEOUT tune the breaker.
+    
+    Returns:
+        tuple: (LatencyHistogram, HedgingPolicy or None, CircuitBreaker or None)
+    """
+    histogram = LatencyHistogram()
+    
+    hedging = None
+    if os.environ.get('GEMINI_HEDGE', 'false').lower() == 'true':
+        hedging = HedgingPolicy(
+            histogram,
+            percentile=float(os.environ.get('GEMINI_HEDGE_PERCENTILE', '95')),
+            min_samples=int(os.environ.get('GEMINI_HEDGE_MIN_SAMPLES', '20'))
+        )
+    
+    breaker = None
+    if os.environ.get('GEMINI_CIRCUIT_BREAKER', 'true').lower() == 'true':
+        breaker = CircuitBreaker(
+            error_rate_threshold=float(os.environ.get('GEMINI_BREAKER_ERROR_RATE', '0.5')),
+            min_requests=int(os.environ.get('GEMINI_BREAKER_MIN_REQUESTS', '10')),
+            reset_timeout=float(os.environ.get('GEMINI_BREAKER_RESET_TIMEOUT', '30'))
+        )
+    
+    return histogram, hedging, breaker
@@ -0,0 +1,121 @@
+"""
+Pipeline Stage Timing
+Per-request wall-time breakdown of the invoice extraction pipeline.
+"""
+
+import time
+import functools
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
+
+
+# Reporting order; stages not listed here are appended after these
+STAGES = (
+    'upload_read',
+    'hash',
+    'duplicate_check',
+    'preprocess',
+    'encode',
+    'network',
+    'parse',
+    'normalize',
+    'db_save'
+)
+
+_current_timings = ContextVar('stage_timings', default=None)
+
+
+class StageTimings:
+    """
+    Accumulated wall time per pipeline stage for one request.
+    
+    A stage entered more than once (e.g. retries, or several files) adds up.
+    Stages timed concurrently in worker threads (see submit_in_context) each
+    add their own wall time, so stages can sum to more than total_ms.
+    """
+    
+    def __init__(self):
+        self._started = time.perf_counter()
+        self._elapsed = {}
+        self._lock = threading.Lock()
+    
+    def add(self, stage, seconds):
+        """Add seconds of wall time to a stage."""
+        with self._lock:
+            self._elapsed[stage] = self._elapsed.get(stage, 0.0) + seconds
+    
+    def as_dict(self):
+        """
+        Return the breakdown as JSON-friendly data.
+        
+        Stages are a list in pipeline order (JSON encoders may sort dict
+        keys); unaccounted_ms is wall time since collection started that no
+        stage covered.
+        """
+        with self._lock:
+            elapsed = dict(self._elapsed)
+        names = [s for s in STAGES if s in elapsed]
+        names += [s for s in elapsed if s not in STAGES]
+        total = time.perf_counter() - self._started
+        return {
+            'stages': [{'stage': name, 'ms': round(elapsed[name] * 1000, 3)} for name in names],
+            'total_ms': round(total * 1000, 3),
+            'unaccounted_ms': round(max(0.0, total - sum(elapsed.values())) * 1000, 3)
+        }
+
+
+def submit_in_context(executor, fn, *args, **kwargs):
+    """
+    executor.submit(fn, ...) run in a copy of the caller's context.
+    
+    Executor threads do not inherit contextvars, so without this stages timed
+    in the worker would not reach the caller's StageTimings.
+    
+    Returns:
+        concurrent.futures.Future
+    """
+    return executor.submit(copy_context().run, fn, *args, **kwargs)
+
+
+def current_timings():
+    """Return the StageTimings being collected in this context, or None."""
+    return _current_timings.get()
+
+
+@contextmanager
+def stage(name):
+    """
+    Time the enclosed block as pipeline stage `name`.
+    
+    Only records while timings are being collected (see collect_stage_timings);
+    otherwise it just runs the block.
+    """
+    timings = _current_timings.get()
+    if timings is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.add(name, time.perf_counter() - started)
+
+
+def record_stage(name, seconds):
+    """Add an already measured duration to a stage, if timings are being collected."""
+    timings = _current_timings.get()
+    if timings is not None:
+        timings.add(name, seconds)
+
+
+def collect_stage_timings(f):
+    """Decorator: collect stage timings for the duration of each call to f."""
+    @functools.wraps(f)
+    def decorated(*args, **kwargs):
+        token = _current_timings.set(StageTimings())
+        try:
+            return f(*args, **kwargs)
+        finally:
+            _current_timings.reset(token)
+    return decorated
@@ -0,0 +1,8 @@
+"""
+Shared pytest setup: the API modules import each other by bare name (see api/index.py).
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'api'))
@@ -0,0 +1,79 @@
+"""
+Amount parsing into minor units: locale grouping, 0/2/3-decimal currencies and negatives.
+"""
+
+import logging
+
+import pytest
+
+from amounts import normalize_amounts, parse_amount
+from index import InvoiceDatabase
+
+
+@pytest.mark.parametrize('text, currency, expected', [
+    # Grouping and decimal conventions
+    ('$1,234.50', None, (123450, 'USD')),
+    ('1.234,50 €', None, (123450, 'EUR')),
+    ('1 234,50 EUR', None, (123450, 'EUR')),
+    ("CHF 1'234.50", None, (123450, 'CHF')),
+    ('₹1,23,456.00', None, (12345600, 'INR')),
+    ('Rs.500', None, (50000, 'INR')),
+    ('1,250', 'USD', (125000, 'USD')),
+    ('12,5 €', None, (1250, 'EUR')),
+    # Leading decimal point
+    ('$.99', 'USD', (99, 'USD')),
+    ('.50 EUR', None, (50, 'EUR')),
+    (',50 €', None, (50, 'EUR')),
+    # Zero- and three-decimal currencies
+    ('¥1,250', None, (1250, 'JPY')),
+    ('₩15000', None, (15000, 'KRW')),
+    ('1.250 KWD', None, (1250, 'KWD')),
+    ('KWD 1,250.500', None, (1250500, 'KWD')),
+    # Negatives
+    ('(12.00)', 'USD', (-1200, 'USD')),
+    ('-$5.00', None, (-500, 'USD')),
+    ('−3,50 €', None, (-350, 'EUR')),
+    ('-.25', 'USD', (-25, 'USD')),
+    # Numbers and missing values
+    (12.5, 'USD', (1250, 'USD')),
+    (1250, 'JPY', (1250, 'JPY')),
+    (None, 'USD', (None, 'USD')),
+    ('n/a', 'USD', (None, 'USD')),
+    ('.', 'USD', (None, 'USD')),
+])
+def test_parse_amount(text, currency, expected):
+    assert parse_amount(text, currency) == expected
+
+
+def test_normalize_amounts_uses_the_invoice_currency():
+    amounts = normalize_amounts({'total': '€1.234,50', 'subtotal': '1.000,00', 'tax': '234,50'})
+    assert amounts == {'currency': 'EUR', 'total_minor': 123450, 'subtotal_minor': 100000, 'tax_minor': 23450}
+
+
+def test_normalize_amounts_drops_amounts_in_another_currency():
+    amounts = normalize_amounts({'total': '€1.234,50', 'subtotal': '1.000,00', 'tax': '$234.50'})
+    assert amounts['tax_minor'] is None
+    assert amounts['total_minor'] == 123450
+
+
+def test_normalize_amounts_falls_back_to_default_currency():
+    amounts = normalize_amounts({'total': '.99', 'subtotal': None, 'tax': None}, default_currency='GBP')
+    assert amounts == {'currency': 'GBP', 'total_minor': 99, 'subtotal_minor': None, 'tax_minor': None}
+
+
+def test_database_repairs_leading_decimal_amounts():
+    logging.disable(logging.WARNING)
+    try:
+        db = InvoiceDatabase('')
+        invoice_id = db.save_invoice({'vendor': 'Acme', 'total': '$.99', 'tax': '$1.00'}, 'u1', 'abc')
+        # What the old parser stored
+        with db.writing() as cursor:
+            cursor.execute('UPDATE invoices SET total_minor = 9900 WHERE id = ?', (invoice_id,))
+        
+        assert db.repair_leading_decimal_amounts() == 1
+        assert db.repair_leading_decimal_amounts() == 0
+        row = db.conn.execute('SELECT total_minor, tax_minor, currency FROM invoices WHERE id = ?',
+                              (invoice_id,)).fetchone()
+        assert tuple(row) == (99, 100, 'USD')
+    finally:
+        logging.disable(logging.NOTSET)
@@ -0,0 +1,51 @@
+"""
+Extraction cache keys: results are only reused for the prompt that produced them.
+"""
+
+import json
+
+import httpx
+
+from extraction_cache import ExtractionCache
+from processor import ImagePreprocessor, extract_packed_invoices, extract_with_gemini_vision
+
+
+class FakeClient:
+    """Stands in for GeminiVisionClient, answering every call with the next queued JSON text."""
+    
+    model = 'fake-model'
+    api_key = 'test'
+    
+    def __init__(self, *texts):
+        self.texts = list(texts)
+        self.calls = 0
+    
+    def generate_content(self, payload, api_key=None):
+        self.calls += 1
+        text = self.texts.pop(0)
+        return httpx.Response(200, json={'candidates': [{'content': {'parts': [{'text': text}]}}]})
+
+
+INVOICE = {'vendor': 'Acme', 'date': '2026-01-02', 'total': '$10.00'}
+NO_PREPROCESSING = ImagePreprocessor(enabled=False)
+
+
+def test_packed_results_are_not_served_to_single_file_extraction():
+    cache = ExtractionCache()
+    items = [(b'first image', 'image/png'), (b'second image', 'image/png')]
+    packed = json.dumps([dict(INVOICE, index=0), dict(INVOICE, index=1, vendor='Globex')])
+    client = FakeClient(packed, json.dumps(INVOICE))
+    
+    results = extract_packed_invoices(items, client=client, cache=cache, preprocessor=NO_PREPROCESSING)
+    assert [result['vendor'] for result in results] == ['Acme', 'Globex']
+    
+    # The packed prompt's result must not stand in for the single-file prompt
+    result = extract_with_gemini_vision(b'first image', client=client, cache=cache, mime_type='image/png',
+                                        preprocessor=NO_PREPROCESSING)
+    assert client.calls == 2
+    assert result['_method'] != 'cache'
+    
+    # Packs reuse both their own results and single-file results
+    results = extract_packed_invoices(items, client=client, cache=cache, preprocessor=NO_PREPROCESSING)
+    assert client.calls == 2
+    assert [result['_method'] for result in results] == ['cache', 'cache']
@@ -0,0 +1,73 @@
+"""
+Per-user near-duplicate index: kept current by this process's inserts, rebuilt for anything else.
+"""
+
+import io
+import logging
+
+import pytest
+from PIL import Image, ImageDraw
+
+from index import InvoiceDatabase
+from near_duplicates import fingerprint
+
+
+def invoice_image(seed):
+    """A distinct PNG per seed."""
+    image = Image.new('L', (240, 320), 255)
+    draw = ImageDraw.Draw(image)
+    for row in range(12):
+        width = 40 + (seed * 37 + row * 53) % 160
+        draw.rectangle([20, 20 + row * 24, 20 + width, 32 + row * 24], fill=0)
+    buffer = io.BytesIO()
+    image.save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+@pytest.fixture
+def db():
+    logging.disable(logging.WARNING)
+    database = InvoiceDatabase('', near_duplicate_distance=2)
+    yield database
+    database.conn.close()
+    logging.disable(logging.NOTSET)
+
+
+def save(db, seed, user_id='u1'):
+    image = invoice_image(seed)
+    return db.save_invoice({'vendor': f'Vendor {seed}'}, user_id, f'hash-{seed}', image_fingerprint=fingerprint(image))
+
+
+def test_uploads_extend_the_cached_index_without_a_rebuild(db):
+    first = save(db, 1)
+    index = db._near_duplicate_index('u1')
+    
+    second = save(db, 2)
+    assert db._near_duplicate_index('u1') is index
+    assert len(index) == 2
+    match, distance = db.find_near_duplicate(fingerprint(invoice_image(2)), 'u1')
+    assert match['id'] == second and distance == 0
+    assert db.find_near_duplicate(fingerprint(invoice_image(1)), 'u1')[0]['id'] == first
+    # Other users' uploads neither touch nor show up in this index
+    save(db, 3, user_id='u2')
+    assert db._near_duplicate_index('u1') is index
+    assert db.find_near_duplicate(fingerprint(invoice_image(3)), 'u1') is None
+
+
+def test_outside_writes_and_deletes_rebuild_the_index(db):
+    save(db, 1)
+    index = db._near_duplicate_index('u1')
+    
+    # Another worker's insert never went through this instance
+    image_hash, thumbnail = fingerprint(invoice_image(2))
+    with db.writing() as cursor:
+        cursor.execute('INSERT INTO invoices (user_id, file_hash, perceptual_hash, perceptual_thumbnail) '
+                       'VALUES (?, ?, ?, ?)', ('u1', 'hash-2', f'{image_hash:016x}', thumbnail))
+        outside = cursor.lastrowid
+    rebuilt = db._near_duplicate_index('u1')
+    assert rebuilt is not index
+    assert db.find_near_duplicate((image_hash, thumbnail), 'u1')[0]['id'] == outside
+    
+    db.delete_invoice(outside)
+    assert db._near_duplicate_index('u1') is not rebuilt
+    assert db.find_near_duplicate((image_hash, thumbnail), 'u1') is None
@@ -0,0 +1,61 @@
+"""
+PDF text-layer fast path on long, text-rich documents.
+"""
+
+import io
+
+from reportlab.lib.pagesizes import letter
+from reportlab.pdfgen import canvas
+
+from extraction_cache import ExtractionCache
+from processor import PDF_TEXT_MAX_CHARS, extract_pdf_text, read_pdf_text
+
+
+def long_invoice_pdf(pages=40, lines_per_page=45):
+    buffer = io.BytesIO()
+    pdf = canvas.Canvas(buffer, pagesize=letter)
+    item = 0
+    for page in range(pages):
+        for line in range(lines_per_page):
+            item += 1
+            pdf.drawString(40, 750 - line * 16, f"Item {item:05d} consulting services rendered   1 x $10.00   $10.00")
+        if page == pages - 1:
+            pdf.drawString(40, 20, "Grand Total: $18,000.00")
+        pdf.showPage()
+    pdf.save()
+    return buffer.getvalue()
+
+
+class TextBackend:
+    """Extraction backend that records the text it was sent."""
+    
+    model = 'fake-model'
+    
+    def __init__(self):
+        self.texts = []
+    
+    def supports_text(self):
+        return True
+    
+    def extract_text(self, text, api_key=None):
+        self.texts.append(text)
+        return {'vendor': 'Acme', 'total': '$18,000.00', 'line_items': []}
+
+
+def test_read_pdf_text_stops_early_but_keeps_last_page():
+    text, pages_read, page_count = read_pdf_text(long_invoice_pdf(), max_chars=PDF_TEXT_MAX_CHARS)
+    assert page_count == 40
+    assert pages_read < page_count
+    assert 'Grand Total' in text
+
+
+def test_long_pdf_uses_text_path_with_truncated_text():
+    backend = TextBackend()
+    result = extract_pdf_text(long_invoice_pdf(), cache=ExtractionCache(), backend=backend, mode='prompt')
+    
+    assert result is not None and result['_method'] == 'pdf_text'
+    assert result['_pdf_text']['truncated'] is True
+    assert result['_pdf_text']['pages'] == 40
+    sent, = backend.texts
+    assert len(sent) <= PDF_TEXT_MAX_CHARS
+    assert sent.startswith('Item 00001') and 'Grand Total: $18,000.00' in sent
@@ -0,0 +1,90 @@
+"""
+EXPLAIN QUERY PLAN checks: each listing, duplicate and reset query must use its index.
+"""
+
+import logging
+import re
+
+import pytest
+
+from index import InvoiceDatabase, encode_cursor
+
+
+@pytest.fixture
+def db():
+    logging.disable(logging.WARNING)
+    database = InvoiceDatabase('')
+    yield database
+    database.conn.close()
+    logging.disable(logging.NOTSET)
+
+
+def query_plans(db, call):
+    """
+    Run call(db) and return the query plan of every statement it executed.
+    
+    Returns:
+        list: (sql, plan) tuples, plan being the plan rows' details joined by newlines
+    """
+    statements = []
+    db.conn.set_trace_callback(statements.append)
+    try:
+        call(db)
+    finally:
+        db.conn.set_trace_callback(None)
+    plans = []
+    for sql in statements:
+        if sql.split(' ', 1)[0].upper() in ('SELECT', 'DELETE', 'UPDATE'):
+            rows = db.conn.execute('EXPLAIN QUERY PLAN ' + sql).fetchall()
+            plans.append((sql, '\n'.join(row[3] for row in rows)))
+    return plans
+
+
+def assert_uses_index(db, call, indexes, sorted_by_index=False):
+    """Assert that the first query call(db) runs reads one of indexes (a name or tuple of names)."""
+    plans = query_plans(db, call)
+    assert plans, 'no query was executed'
+    sql, plan = plans[0]
+    names = (indexes,) if isinstance(indexes, str) else indexes
+    assert any(re.search(rf'INDEX {name}\b', plan) for name in names), f'{sql}\n{plan}'
+    if sorted_by_index:
+        assert 'TEMP B-TREE' not in plan, f'{sql}\n{plan}'
+
+
+CURSOR = {'created_at': '2026-01-01 00:00:00', 'id': 10}
+
+
+@pytest.mark.parametrize('filters, index', [
+    ({'user_id': 'u1'}, 'idx_invoices_user_created'),
+    ({'user_id': 'u1', 'upload_type': 'batch'}, 'idx_invoices_user_type_created'),
+    ({'user_id': 'u1', 'status': 'completed'}, 'idx_invoices_user_status_created'),
+    ({'upload_type': 'batch'}, 'idx_invoices_type_created'),
+    ({}, 'idx_invoices_created'),
+])
+@pytest.mark.parametrize('page', ['offset', 'keyset'])
+def test_listing_uses_sorted_index(db, filters, index, page):
+    paging = {'offset': 20} if page == 'offset' else {'after': encode_cursor(CURSOR['created_at'], CURSOR['id'])}
+    assert_uses_index(db, lambda d: d.list_invoices(**filters, **paging), index, sorted_by_index=True)
+    assert_uses_index(db, lambda d: d.list_invoice_payloads(**filters, **paging), index, sorted_by_index=True)
+
+
+def test_duplicate_lookup_uses_file_hash_user_index(db):
+    assert_uses_index(db, lambda d: d.check_duplicate('abc', 'u1'), 'idx_invoices_file_hash_user')
+
+
+def test_near_duplicate_signature_uses_partial_index(db):
+    db.near_duplicate_distance = 2
+    assert_uses_index(db, lambda d: d._near_duplicate_index('u1'), 'idx_invoices_user_phash')
+
+
+# Any index leading with user_id narrows a per-user reset equally well
+USER_INDEXES = ('idx_invoices_user_created', 'idx_invoices_user_type_created', 'idx_invoices_user_status_created')
+
+
+@pytest.mark.parametrize('filters, index', [
+    ({'user_id': 'u1'}, USER_INDEXES),
+    ({'user_id': 'u1', 'upload_type': 'batch'}, 'idx_invoices_user_type_created'),
+    ({'upload_type': 'batch'}, 'idx_invoices_type_created'),
+])
+def test_reset_uses_index(db, filters, index):
+    assert_uses_index(db, lambda d: d.clear_all(**filters), index)
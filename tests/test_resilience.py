@@ -0,0 +1,129 @@
+"""
+Circuit breaker, hedging and rate limiter behaviour of the Gemini clients.
+"""
+
+import asyncio
+import time
+
+import httpx
+import pytest
+import requests
+
+from processor import AsyncGeminiVisionClient, GeminiVisionClient
+from rate_limiter import GeminiRateLimiter
+from resilience import CircuitBreaker, CircuitOpenError, HedgingPolicy, LatencyHistogram
+
+
+def half_open_breaker():
+    """A breaker that has tripped and whose reset timeout has already passed."""
+    breaker = CircuitBreaker(min_requests=1, reset_timeout=0.01)
+    breaker.record(False, breaker.before_request())
+    time.sleep(0.02)
+    return breaker
+
+
+def test_cancelled_async_probe_releases_breaker():
+    breaker = half_open_breaker()
+    
+    async def slow(request):
+        await asyncio.sleep(5)
+        return httpx.Response(200, json={})
+    
+    async def fast(request):
+        return httpx.Response(200, json={})
+    
+    async def run():
+        client = AsyncGeminiVisionClient(api_key='test', base_url='http://gemini.test', circuit_breaker=breaker)
+        client._http = httpx.AsyncClient(transport=httpx.MockTransport(slow))
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(client.generate_content({}), timeout=0.05)
+        # The cancelled probe counts as a failure and re-opens the circuit
+        assert breaker.state()['state'] == CircuitBreaker.OPEN
+        
+        await asyncio.sleep(0.02)
+        await client.aclose()
+        client._http = httpx.AsyncClient(transport=httpx.MockTransport(fast))
+        response = await client.generate_content({})
+        await client.aclose()
+        return response
+    
+    assert asyncio.run(run()).status_code == 200
+    assert breaker.state()['state'] == CircuitBreaker.CLOSED
+
+
+def test_unexpected_sync_probe_error_releases_breaker(monkeypatch):
+    breaker = half_open_breaker()
+    client = GeminiVisionClient(api_key='test', base_url='http://gemini.test', circuit_breaker=breaker)
+    
+    def broken(*args, **kwargs):
+        raise RuntimeError('unexpected')
+    
+    monkeypatch.setattr(client.session, 'post', broken)
+    with pytest.raises(RuntimeError):
+        client.generate_content({})
+    assert breaker.state()['state'] == CircuitBreaker.OPEN
+    
+    time.sleep(0.02)
+    response = requests.Response()
+    response.status_code = 200
+    monkeypatch.setattr(client.session, 'post', lambda *args, **kwargs: response)
+    assert client.generate_content({}) is response
+    assert breaker.state()['state'] == CircuitBreaker.CLOSED
+
+
+def test_open_breaker_rejects_without_calling():
+    breaker = CircuitBreaker(min_requests=1, reset_timeout=60)
+    breaker.record(False, breaker.before_request())
+    client = GeminiVisionClient(api_key='test', base_url='http://gemini.test', circuit_breaker=breaker)
+    with pytest.raises(CircuitOpenError):
+        client.generate_content({})
+
+
+@pytest.mark.parametrize('stale_success', [True, False])
+def test_stale_outcome_does_not_settle_half_open_probe(stale_success):
+    breaker = CircuitBreaker(min_requests=2, reset_timeout=0.01)
+    slow = breaker.before_request()
+    failing = breaker.before_request()
+    breaker.record(False, failing)
+    breaker.record(False, breaker.before_request())
+    assert breaker.state()['state'] == CircuitBreaker.OPEN
+    time.sleep(0.02)
+    
+    probe = breaker.before_request()
+    # A call sent before the circuit opened finishes while the probe is in flight
+    breaker.record(stale_success, slow)
+    assert breaker.state()['state'] == CircuitBreaker.HALF_OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.before_request()
+    
+    breaker.record(True, probe)
+    assert breaker.state()['state'] == CircuitBreaker.CLOSED
+
+
+def test_cancelled_hedge_loser_is_not_counted_as_an_error():
+    histogram = LatencyHistogram()
+    for _ in range(20):
+        histogram.observe(0.01)
+    limiter = GeminiRateLimiter()
+    calls = []
+    
+    async def primary_slow(request):
+        calls.append(request)
+        if len(calls) == 1:
+            await asyncio.sleep(5)
+        return httpx.Response(200, json={})
+    
+    async def run():
+        client = AsyncGeminiVisionClient(api_key='test', base_url='http://gemini.test', rate_limiter=limiter,
+                                         hedging=HedgingPolicy(histogram, min_delay=0.05))
+        client._http = httpx.AsyncClient(transport=httpx.MockTransport(primary_slow))
+        response = await client.generate_content({})
+        await asyncio.sleep(0)
+        await client.aclose()
+        return response
+    
+    assert asyncio.run(run()).status_code == 200
+    assert len(calls) == 2
+    state = limiter.state()
+    assert state['in_flight'] == 0
+    assert state['errors'] == 0 and state['error_rate'] == 0
@@ -0,0 +1,76 @@
+"""
+Stage timings recorded in worker threads reach the request's breakdown.
+"""
+
+import io
+import time
+
+import requests
+from pypdf import PdfWriter
+
+from extraction_cache import ExtractionCache
+from processor import GeminiVisionClient, extract_pdf_pages
+from resilience import HedgingPolicy, LatencyHistogram
+from timing import collect_stage_timings, current_timings, stage
+
+
+def stage_names(timings):
+    return {entry['stage'] for entry in timings['stages']}
+
+
+class SlowBackend:
+    """Extraction backend that only spends time in the network stage."""
+    
+    model = 'fake-model'
+    
+    def extract(self, file_bytes, mime_type, api_key=None):
+        with stage('network'):
+            time.sleep(0.01)
+        return {'vendor': 'Acme', 'total': '$1.00', 'line_items': []}
+
+
+def three_page_pdf():
+    writer = PdfWriter()
+    for width in (200, 300, 400):
+        # Different sizes so the page groups do not share a cache key
+        writer.add_blank_page(width=width, height=200)
+    buffer = io.BytesIO()
+    writer.write(buffer)
+    return buffer.getvalue()
+
+
+def test_pdf_page_group_stages_are_recorded():
+    @collect_stage_timings
+    def run():
+        result = extract_pdf_pages(three_page_pdf(), cache=ExtractionCache(), backend=SlowBackend())
+        return result, current_timings().as_dict()
+    
+    result, timings = run()
+    assert len(result['_pages']) == 3
+    network = next(entry['ms'] for entry in timings['stages'] if entry['stage'] == 'network')
+    assert network >= 30
+    assert {'hash', 'network'} <= stage_names(timings)
+
+
+def test_hedged_attempt_stages_are_recorded(monkeypatch):
+    histogram = LatencyHistogram()
+    for _ in range(20):
+        histogram.observe(0.01)
+    client = GeminiVisionClient(api_key='test', base_url='http://gemini.test',
+                                hedging=HedgingPolicy(histogram, min_delay=1))
+    response = requests.Response()
+    response.status_code = 200
+    
+    def post(*args, **kwargs):
+        with stage('attempt'):
+            return response
+    
+    monkeypatch.setattr(client.session, 'post', post)
+    
+    @collect_stage_timings
+    def run():
+        client.generate_content({})
+        return current_timings().as_dict()
+    
+    assert 'attempt' in stage_names(run())
+    client.close()